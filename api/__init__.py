@@ -1,4 +1,3 @@
 from . import authentication
 from . import database
 from . import exceptions
-from . import index
\ No newline at end of file
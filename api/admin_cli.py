@@ -0,0 +1,95 @@
+# Bulk member administration from a shell on a machine that can reach the database, using the same
+# environment as the app (DATABASE_BACKEND, MONGO_DB_*, ...). Items are read from a JSON array or a
+# CSV file with a header row, "-" reads stdin:
+#   python -m api.admin_cli create-slots members.csv
+#   python -m api.admin_cli disable - < usernames.json
+# The CLI acts as a system administrator above every permission group unless told otherwise. Changes
+# are written to the audit log like the HTTP endpoints do, under the actor "cli:<login name>".
+from argparse import ArgumentParser
+from typing import Optional, TextIO
+import csv
+import getpass
+import json
+import sys
+from .database import Database
+from .permissions import Permissions, compile_permissions
+from .backends import create_database
+from .authentication import (
+    Settings,
+    BulkResult,
+    UserChange,
+    bulk_create_user_slots,
+    bulk_remove_unfilled_users,
+    bulk_disable_users,
+    bulk_edit_users,
+    audit_log
+)
+from .handlers import slot_requests, target_requests, change_requests, audit_events
+from .exceptions import MyError
+from .consts import FIELD_USERNAME, FIELD_SETTINGS, FIELD_PERMISSION_GROUP, BULK_MAX_ITEMS
+
+CLI_PERMISSION_GROUP = (1 << 31) - 1
+INTEGER_COLUMNS = (FIELD_SETTINGS, FIELD_PERMISSION_GROUP)
+# The audit actions of the matching bulk endpoints
+AUDIT_ACTIONS = {"create-slots": "add_user", "remove": "remove_user", "disable": "deactivate_user", "edit": "edit_user"}
+
+def read_items(file: TextIO, fmt: str) -> list[dict]:
+    if fmt == "json":
+        items = json.load(file)
+        return [item if isinstance(item, dict) else {FIELD_USERNAME: item} for item in items]
+    items = []
+    for row in csv.DictReader(file):
+        items.append({key: int(value) if key in INTEGER_COLUMNS else value for key, value in row.items() if value not in (None, "")})
+    return items
+
+# The results and what the audit log records for each item
+def run_batch(database: Database, command: str, actor: Permissions, items: list[dict]) -> tuple[list[BulkResult], list[dict]]:
+    if command == "create-slots":
+        slots, data = slot_requests(items)
+        return bulk_create_user_slots(database, actor, slots), data
+    if command == "edit":
+        changes, data = change_requests([UserChange.from_dict(item) for item in items])
+        return bulk_edit_users(database, actor, changes), data
+    usernames, data = target_requests([item[FIELD_USERNAME] for item in items])
+    if command == "remove":
+        return bulk_remove_unfilled_users(database, actor, usernames), data
+    return bulk_disable_users(database, actor, usernames), data
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = ArgumentParser(prog="python -m api.admin_cli", description="Bulk member administration")
+    parser.add_argument("command", choices=("create-slots", "remove", "disable", "edit"))
+    parser.add_argument("file", help="JSON array or CSV file with a header row, - for stdin")
+    parser.add_argument("--format", choices=("json", "csv"), help="defaults to the file extension, json for stdin")
+    parser.add_argument("--settings", type=int, default=Settings.SYS_ADMIN.value, help="settings to act with")
+    parser.add_argument("--permission-group", type=int, default=CLI_PERMISSION_GROUP, help="permission group to act with")
+    parser.add_argument("--actor", default="cli:" + getpass.getuser(), help="name the audit log records the changes under")
+    args = parser.parse_args(argv)
+    fmt = args.format or ("csv" if args.file.endswith(".csv") else "json")
+    if args.file == "-":
+        items = read_items(sys.stdin, fmt)
+    else:
+        with open(args.file, newline="") as file:
+            items = read_items(file, fmt)
+    database = create_database()
+    actor = compile_permissions(args.settings, args.permission_group)
+    failed = False
+    try:
+        # Larger files go through in batches of the size the HTTP endpoints accept
+        for start in range(0, len(items), BULK_MAX_ITEMS):
+            try:
+                results, data = run_batch(database, args.command, actor, items[start:start + BULK_MAX_ITEMS])
+            except MyError as exc:
+                print(exc.identifier, file=sys.stderr)
+                return 2
+            for event in audit_events(args.actor, AUDIT_ACTIONS[args.command], results, data):
+                audit_log.record(database, event)
+            for result in results:
+                print(json.dumps(result.to_dict()))
+                failed = failed or result.reason is not None
+    finally:
+        # Writes the queued events before the process exits
+        audit_log.close()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,426 @@
+from os import getenv
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable
+from typing import TYPE_CHECKING, cast
+from quart import (
+    Quart,
+    request,
+    redirect,
+    render_template,
+    make_response,
+    jsonify,
+    url_for,
+    after_this_request,
+    abort,
+    Response
+)
+from quart.wrappers.response import DataBody, IterableBody
+from .lazy import Lazy, import_modules
+from .compression import should_compress, negotiate_encoding, compress, compress_async_stream, COMPRESSION_MIN_SIZE
+from .tracing import TRACING, TracedTemplate, start_trace, finish_trace
+from .assets import AssetRegistry, SCRIPT_TEMPLATES, JAVASCRIPT, add_static_assets
+from .database import UserListEntry
+from .backends import create_async_database
+from .audit import AuditEvent
+from .async_database import AsyncDatabase
+from .async_authentication import login as auth_login
+from .async_authentication import old_login as old_auth_login
+from .async_authentication import sign_up as auth_sign_up
+from .async_authentication import logout as auth_logout
+from .async_authentication import bulk_edit_users as auth_bulk_edit_users
+from .async_authentication import (
+    extract_session,
+    extract_claimed_session,
+    get_user_profile,
+    get_session_user_profile,
+    verify_and_save_credential,
+    login_by_credential,
+    access_creation_credentials,
+    access_login_credentials,
+    access_login_type,
+    check_login_rate,
+    bulk_create_user_slots,
+    bulk_remove_unfilled_users,
+    bulk_disable_users,
+    decrypt_rsa
+)
+from .authentication import (
+    Session,
+    BulkResult,
+    UserChange,
+    set_session_claims,
+    add_csrf_token,
+    verify_csrf_token,
+    rsa_key_from_data,
+    session_name,
+    audit_log,
+    DEFERRED_MODULES
+)
+from .handlers import (
+    success,
+    failure,
+    require,
+    LoginForm,
+    session_cookie,
+    ensure_csrf_token,
+    page_context,
+    slot_requests,
+    target_requests,
+    change_requests,
+    settings_change,
+    permission_group_change,
+    audit_events,
+    bulk_body,
+    single_body,
+    user_list_query,
+    UserListWriter,
+    user_id_body,
+    user_body,
+    audit_log_query,
+    audit_log_body,
+    stats_body,
+    webauthn_options_body,
+    timed
+)
+from .exceptions import MyError, NoSession
+from .permissions import Permissions
+from .consts import FIELD_USERNAME, FIELD_USERS
+
+
+RSA_KEY = str(getenv("RSA_KEY")).encode()
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+
+rsa_key: "Lazy[RSAPrivateKey]" = Lazy(lambda: rsa_key_from_data(RSA_KEY))
+
+# Built when before_serving connects it, importing the app leaves the drivers alone
+db = cast(AsyncDatabase, Lazy(create_async_database))
+
+app = Quart(__name__, template_folder="templates")
+# Filled in before_serving
+assets = AssetRegistry()
+
+async def extract_read_session() -> Session:
+    session, claims = await extract_claimed_session(db, request)
+    if claims is not None:
+        after_this_request(lambda response: set_session_claims(response, claims))
+    return session
+
+async def extract_read_session_or_empty() -> Session:
+    try:
+        return await extract_read_session()
+    except NoSession:
+        return Session.create_empty_session()
+
+@app.before_serving
+async def connect_database():
+    await db.connect()
+    audit_log.start_async()
+
+@app.before_serving
+async def build_assets():
+    add_static_assets(assets)
+    async with app.test_request_context("/"):
+        for name in SCRIPT_TEMPLATES:
+            assets.add(name, await render_template(name, **page_context()), JAVASCRIPT)
+
+@app.after_serving
+async def close_database():
+    # Queued audit events still need the connection
+    await audit_log.close_async()
+    await db.close()
+
+async def compressed_body(body: IterableBody, encoding: str) -> AsyncIterator[bytes]:
+    async with body as chunks:
+        async for chunk in compress_async_stream(chunks, encoding):
+            yield chunk
+
+@app.after_request
+async def compress_response(response: Response) -> Response:
+    if not should_compress(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+    if isinstance(response.response, DataBody):
+        data = await response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    elif isinstance(response.response, IterableBody):
+        response.response = IterableBody(compressed_body(response.response, encoding))
+        response.headers.pop("Content-Length", None)
+    else:
+        return response
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+if TRACING:
+    app.jinja_env.template_class = TracedTemplate
+
+    # Both hooks are coroutines, a sync hook would run in a copied context and the trace would be lost
+    @app.before_request
+    async def begin_trace():
+        start_trace()
+
+    @app.after_request
+    async def end_trace(response: Response) -> Response:
+        return finish_trace(response, request.method, request.path)
+
+def webauthn_options_response(options) -> Response:
+    return Response(webauthn_options_body(options), mimetype="application/json")
+
+@app.get("/")
+async def home():
+    session = await extract_read_session_or_empty()
+    response = await make_response(await render_template("home.html", **page_context(session), assets=assets))
+    return ensure_csrf_token(request.cookies, response)
+
+@app.get("/control_panel/")
+async def control_panel():
+    session = await extract_read_session_or_empty()
+    if not session:
+        return redirect(url_for("home"))
+    response = await make_response(await render_template("controlPanel.html", **page_context(session), assets=assets))
+    return ensure_csrf_token(request.cookies, response)
+
+@app.post("/login/")
+async def login():
+    form = LoginForm.from_dict(await request.get_json())
+    try:
+        await check_login_rate(db, request, form.username)
+        password = await decrypt_rsa(form.password, rsa_key.get())
+        session_data = await auth_login(db, form.username, password, session_name(request))
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return session_cookie(jsonify(success()), session_data)
+
+@app.post("/old_login/")
+async def old_login():
+    form = LoginForm.from_dict(await request.get_json())
+    try:
+        await check_login_rate(db, request, form.username)
+        extra_password = await decrypt_rsa(form.hashed_password, rsa_key.get())
+        session_data = await old_auth_login(db, form.username, form.password, session_name(request), extra_password)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return session_cookie(jsonify(success()), session_data)
+
+@app.post("/login/login_type/")
+async def get_login_type():
+    form = LoginForm.from_dict(await request.get_json())
+    try:
+        await check_login_rate(db, request, form.username)
+        login_type = await access_login_type(db.read_only(), form.username)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return add_csrf_token(jsonify(success(login_type.value)))
+
+@app.get("/register/")
+async def registration():
+    return await render_template("register.html", **page_context(), assets=assets)
+
+@app.post("/register/")
+async def register():
+    form = LoginForm.from_dict(await request.get_json())
+    try:
+        session_data = await auth_sign_up(db, form.username, form.password, session_name(request), form.user_slot)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return session_cookie(jsonify(success()), session_data)
+
+@app.post("/logout/")
+async def logout():
+    try:
+        verify_csrf_token(request)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return await auth_logout(db, jsonify(success()), request)
+
+async def admin_action(action: str, run: Callable[[AsyncDatabase, Permissions, list], Awaitable[list[BulkResult]]], items: list, data: list[dict], respond: Callable[[list[BulkResult]], dict]) -> Response:
+    try:
+        verify_csrf_token(request)
+        session = await extract_session(db, request)
+        results = await run(db, session.permissions, items)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    for event in audit_events(session.username, action, results, data):
+        await audit_log.record_async(db, event)
+    return jsonify(respond(results))
+
+@app.post("/add_user/")
+async def add_user():
+    return await admin_action("add_user", bulk_create_user_slots, *slot_requests([await request.get_json()]), single_body)
+
+async def stream_user_list(entries: AsyncIterator[UserListEntry], limit: int) -> AsyncIterator[bytes]:
+    writer = UserListWriter(limit)
+    yield writer.head().encode()
+    async for entry in entries:
+        row = writer.row(entry)
+        if row is None:
+            break
+        yield row.encode()
+    yield writer.tail().encode()
+
+@app.get("/user_list/")
+async def get_user_list():
+    try:
+        session = await extract_read_session()
+        limit, query = user_list_query(session, request.args)
+        entries = db.read_only().iter_user_list(*query)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return Response(stream_user_list(entries, limit), mimetype="application/json")
+
+@app.post("/remove_user/")
+async def remove_user():
+    form_data = await request.get_json()
+    return await admin_action("remove_user", bulk_remove_unfilled_users, *target_requests([form_data[FIELD_USERNAME]]), single_body)
+
+@app.post("/deactivate_user/")
+async def deactivate_user():
+    form_data = await request.get_json()
+    return await admin_action("deactivate_user", bulk_disable_users, *target_requests([form_data[FIELD_USERNAME]]), single_body)
+
+@app.get("/get_user_id/<username>/")
+async def get_user_id(username):
+    try:
+        session = await extract_read_session()
+        require(session.permissions.view_members)
+        body = user_id_body(session, await get_user_profile(db.read_only(), username))
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return jsonify(body)
+
+@app.post("/edit_user_permission_group/")
+async def edit_user_permission_group():
+    return await admin_action("edit_user_permission_group", auth_bulk_edit_users, *change_requests([permission_group_change(await request.get_json())]), single_body)
+
+@app.post("/edit_user_settings/")
+async def edit_user_settings():
+    return await admin_action("edit_user_settings", auth_bulk_edit_users, *change_requests([settings_change(await request.get_json())]), single_body)
+
+@app.get("/get_user/<username>/")
+async def get_user(username):
+    try:
+        session = await extract_read_session()
+        require(session.permissions.view_members)
+        body = user_body(session, await get_user_profile(db.read_only(), username))
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return jsonify(body)
+
+@app.post("/bulk/add_users/")
+async def bulk_add_users():
+    form_data = await request.get_json()
+    return await admin_action("add_user", bulk_create_user_slots, *slot_requests(form_data[FIELD_USERS]), bulk_body)
+
+@app.post("/bulk/remove_users/")
+async def bulk_remove_users():
+    form_data = await request.get_json()
+    return await admin_action("remove_user", bulk_remove_unfilled_users, *target_requests(form_data[FIELD_USERS]), bulk_body)
+
+@app.post("/bulk/deactivate_users/")
+async def bulk_deactivate_users():
+    form_data = await request.get_json()
+    return await admin_action("deactivate_user", bulk_disable_users, *target_requests(form_data[FIELD_USERS]), bulk_body)
+
+# Covers both /edit_user_settings/ and /edit_user_permission_group/, an item may carry either or both
+@app.post("/bulk/edit_users/")
+async def bulk_edit_users():
+    form_data = await request.get_json()
+    return await admin_action("edit_user", auth_bulk_edit_users, *change_requests([UserChange.from_dict(item) for item in form_data[FIELD_USERS]]), bulk_body)
+
+@app.get("/audit_log/")
+async def get_audit_log():
+    try:
+        session = await extract_read_session()
+        limit, query = audit_log_query(session, request.args)
+        events = await db.read_only().list_audit_events(*query)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return jsonify(audit_log_body(events, limit))
+
+@app.get("/stats/")
+async def get_stats():
+    try:
+        body = stats_body(await extract_session(db, request))
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return jsonify(body)
+
+# The database connects in before_serving, everything else is built on first use unless warmed
+def warm() -> dict[str, float]:
+    return timed((
+        ("modules", lambda: import_modules(DEFERRED_MODULES)),
+        ("rsa_key", rsa_key.get),
+        ("assets", assets.precompress)
+    ))
+
+@app.get("/warm/")
+async def warm_instance():
+    return jsonify(success(await asyncio.to_thread(warm)))
+
+@app.get("/assets/<path:path>")
+async def get_asset(path):
+    asset = assets.find(path)
+    if asset is None:
+        abort(404)
+    body, headers = asset.select(request.accept_encodings)
+    return Response(body, content_type=asset.content_type, headers=headers)
+
+@app.get("/manifest/")
+async def get_manifest():
+    return await render_template("manifest.json")
+
+@app.get("/github_oauth_callback/")
+async def github_oauth_callback():
+    return "Not implemented"
+
+@app.get("/webauth/creation_credentials/")
+async def access_webauth_creator():
+    try:
+        session = await extract_session(db, request)
+        user_profile = await get_session_user_profile(db, session)
+        credentials = await access_creation_credentials(db, user_profile, request)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return webauthn_options_response(credentials)
+
+@app.post("/webauth/create_credentials/")
+async def create_webauth():
+    from webauthn.helpers import parse_registration_credential_json
+    form_data = await request.get_json()
+    try:
+        session = await extract_session(db, request)
+        user_profile = await get_session_user_profile(db, session)
+        credential = parse_registration_credential_json(form_data)
+        await verify_and_save_credential(db, user_profile, session, request, credential)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    await audit_log.record_async(db, AuditEvent.create(session.username, "create_credentials", session.username))
+    return jsonify(success())
+
+@app.get("/webauth/login_credentials/")
+async def access_webauth_login():
+    try:
+        session = await extract_session(db, request)
+        await get_session_user_profile(db, session)
+        credentials = await access_login_credentials(db, request)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return webauthn_options_response(credentials)
+
+@app.post("/webauth/login/")
+async def login_via_passkey():
+    from webauthn.helpers import parse_registration_credential_json
+    form_data = await request.get_json()
+    try:
+        await check_login_rate(db, request)
+        credential = parse_registration_credential_json(form_data)
+        session_data = await login_by_credential(db, credential, session_name(request), request)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return session_cookie(jsonify(success()), session_data)
@@ -0,0 +1,103 @@
+from __future__ import annotations
+from typing import Optional
+from dataclasses import dataclass
+from functools import cached_property
+from hashlib import sha256
+from werkzeug.datastructures import Accept
+import os
+import gzip
+import json
+import mimetypes
+from .authentication import Settings
+
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
+
+ASSET_URL_PREFIX = "/assets/"
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+JAVASCRIPT = "text/javascript; charset=utf-8"
+STATIC_FOLDER = os.path.join(os.path.dirname(__file__), "static")
+STATIC_ASSETS = ("common.js", "home_style.css", "controlpanel_style.css", "register_style.css")
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Rendered once per process, they only depend on constants and routes, never on the session
+SCRIPT_TEMPLATES = ("homeCode.js", "loginCode.js", "registerCode.js", "userList.js", "addUserForm.js")
+
+@dataclass(frozen=True)
+class Asset:
+    name: str
+    path: str
+    body: bytes
+    content_type: str
+
+    # Compressed on first request, so the maximum quality levels stay out of the cold start
+    @cached_property
+    def encodings(self) -> dict[str, bytes]:
+        return precompress(self.body, self.content_type)
+
+    def select(self, accept_encodings: Accept) -> tuple[bytes, dict[str, str]]:
+        headers = {"Cache-Control": ASSET_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+        for encoding, body in self.encodings.items():
+            if accept_encodings.quality(encoding) > 0:
+                headers["Content-Encoding"] = encoding
+                return body, headers
+        return self.body, headers
+
+class AssetRegistry:
+    def __init__(self):
+        self.assets: dict[str, Asset] = {}
+        self.paths: dict[str, Asset] = {}
+
+    def add(self, name: str, body: str | bytes, content_type: str) -> Asset:
+        encoded = body.encode("utf-8") if isinstance(body, str) else body
+        stem, _, extension = name.rpartition(".")
+        asset = Asset(name, f"{stem}.{sha256(encoded).hexdigest()[:16]}.{extension}", encoded, content_type)
+        self.assets[name] = asset
+        self.paths[asset.path] = asset
+        return asset
+
+    def add_file(self, name: str, directory: str = STATIC_FOLDER) -> Asset:
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if content_type.startswith("text/"):
+            content_type += "; charset=utf-8"
+        with open(os.path.join(directory, name), "rb") as file:
+            return self.add(name, file.read(), content_type)
+
+    def url(self, name: str) -> str:
+        return ASSET_URL_PREFIX + self.assets[name].path
+
+    def find(self, path: str) -> Optional[Asset]:
+        return self.paths.get(path)
+
+    def precompress(self) -> None:
+        for asset in self.assets.values():
+            asset.encodings
+
+# Everything but the script templates, which need the web app to render
+def add_static_assets(registry: AssetRegistry) -> None:
+    registry.add("settings.js", settings_tables(), JAVASCRIPT)
+    for name in STATIC_ASSETS:
+        registry.add_file(name)
+
+def settings_tables() -> str:
+    settings = Settings.__members__.values()
+    values = {f"setting_{setting.name}": setting.value for setting in settings}
+    names = {f"setting_{setting.name}": setting.get_translated_name() for setting in settings}
+    return (
+        f"const settingsValues = {json.dumps(values)};\n"
+        f"const settingsNames = {json.dumps(names, ensure_ascii=False)};\n"
+        "function settingsInclude(settings, name) {\n"
+        "    return (settings & settingsValues[name]) === settingsValues[name];\n"
+        "}\n"
+    )
+
+def precompress(body: bytes, content_type: str) -> dict[str, bytes]:
+    # Ordered by preference, variants that do not save anything are left out
+    if not content_type.startswith(COMPRESSIBLE_TYPES):
+        return {}
+    encodings = {}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(body, quality=11)
+    encodings["gzip"] = gzip.compress(body, 9, mtime=0)
+    return {encoding: encoded for encoding, encoded in encodings.items() if len(encoded) < len(body)}
@@ -0,0 +1,259 @@
+from __future__ import annotations
+from typing import Optional, TYPE_CHECKING
+from collections.abc import Iterable
+from datetime import datetime
+import time
+import uuid
+from quart import Request, Response
+from .async_database import AsyncDatabase
+from .database import UserProfile
+from .session_claims import SessionClaims
+from .permissions import Permissions
+from .tracing import traced
+from .authentication import (
+    Session,
+    SessionData,
+    LoginData,
+    LoginType,
+    WebAuthnCredential,
+    SESSION_GENERATION,
+    session_cache,
+    crypto_pool,
+    revocations,
+    revocation_records,
+    session_cutoffs,
+    sweeper,
+    issue_session_claims,
+    session_from_claims,
+    signed_claims,
+    prehash_login_data,
+    derive_superhash,
+    superhashed_login_data,
+    weak_create_login_data,
+    auth_from_record,
+    require_login_type,
+    verify_login_data,
+    create_session_data,
+    validate_username_and_password,
+    clear_session_cookies,
+    rsa_decrypt,
+    prepare_credential_creation,
+    prepare_login_creation,
+    creation_challenge_key,
+    login_challenge_key,
+    credential_id_of,
+    verify_registration,
+    verify_authentication,
+    challenge_store,
+    login_limiter,
+    client_address,
+    TRUSTED_PROXIES,
+    BulkResult,
+    UserSlotRequest,
+    UserChange,
+    plan_user_slots,
+    settle_user_slots,
+    slot_rows,
+    plan_removals,
+    plan_disables,
+    plan_edits,
+    plan_targets,
+    settle_targets,
+    settle_edits
+)
+from .exceptions import NotFoundError, AlreadyExistsError, NoSession
+
+# The I/O around the steps in authentication.py, every check and every decision is made there so
+# both front ends behave the same.
+
+if TYPE_CHECKING:
+    from webauthn.helpers.structs import PublicKeyCredentialCreationOptions, RegistrationCredential, PublicKeyCredentialRequestOptions, AuthenticationCredential
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+
+@traced("rsa")
+async def decrypt_rsa(data: str, private_key: RSAPrivateKey) -> str:
+    return await crypto_pool.run_async(rsa_decrypt, data, private_key)
+
+@traced("pbkdf2")
+async def superhash(data: bytes, salt: bytes) -> bytes:
+    return await crypto_pool.run_async(derive_superhash, data, salt)
+
+async def create_login_data(username: str, password: str, login_token: Optional[str] = None) -> LoginData:
+    login_token = login_token or str(uuid.uuid4())
+    base64_hashed_data = prehash_login_data(username, password, login_token)
+    return superhashed_login_data(await superhash(base64_hashed_data, login_token.encode("utf-8")), login_token)
+
+async def session_generation(database: AsyncDatabase) -> int:
+    generation = session_cache.fresh_generation(database)
+    if generation is None:
+        checked_at = time.monotonic()
+        generation = await database.get_generation(SESSION_GENERATION)
+        session_cache.observe_generation(database, generation, checked_at)
+    if session_cache.needs_revocations(database, generation):
+        revocations.load(database, generation, await database.list_revocations(time.time()))
+    return generation
+
+async def session_from_session_data(database: AsyncDatabase, session_data: SessionData) -> Session:
+    await session_generation(database)
+    now = time.time()
+    session = session_cache.lookup(database, session_data.data)
+    if session is None or session.is_expired(now):
+        session = await database.get_session(session_data.data, *session_cutoffs(now))
+        if session is None:
+            raise NoSession()
+        session_cache.store(database, session_data.data, now, session)
+    if session.needs_touch(now):
+        await database.touch_session(session_data.data, now)
+        session.last_used = datetime.fromtimestamp(now)
+    return session
+
+async def revoke_sessions(database: AsyncDatabase, *, username: Optional[str] = None, session_data: Optional[str] = None, usernames: Iterable[str] = ()) -> None:
+    usernames = list(usernames)
+    records = revocation_records(username=username, session_data=session_data, usernames=usernames)
+    await database.add_revocations(records)
+    for key, revoked_at, _ in records:
+        revocations.add(database, key, revoked_at)
+    session_cache.evict(database, username=username, session_data=session_data, usernames=usernames)
+    session_cache.observe_increment(database, await database.increment_generation(SESSION_GENERATION))
+
+async def verify_session_claims(database: AsyncDatabase, request: Request, session_data: SessionData) -> Optional[SessionClaims]:
+    claims = signed_claims(request, session_data)
+    if claims is None:
+        return None
+    await session_generation(database)
+    if revocations.is_revoked(database, claims):
+        return None
+    return claims
+
+async def extract_claimed_session(database: AsyncDatabase, request: Request) -> tuple[Session, Optional[str]]:
+    session_data = SessionData.from_request(request)
+    if session_data is None:
+        raise NoSession()
+    claims = await verify_session_claims(database, request, session_data)
+    if claims is not None:
+        return session_from_claims(session_data, claims), None
+    session = await session_from_session_data(database, session_data)
+    return session, issue_session_claims(session_data, session)
+
+async def extract_session(database: AsyncDatabase, request: Request) -> Session:
+    session_data = SessionData.from_request(request)
+    if session_data is None:
+        raise NoSession()
+    return await session_from_session_data(database, session_data)
+
+async def lookup_user_auth(database: AsyncDatabase, username: str) -> tuple[str, LoginData]:
+    return auth_from_record(await database.get_auth_record(username))
+
+async def make_session(database: AsyncDatabase, username: str, session_name: str) -> SessionData:
+    session_data = create_session_data()
+    for pushed_out in await database.add_session(session_data.data, username, session_name):
+        await revoke_sessions(database, session_data=pushed_out)
+    sweeper.start_async(database)
+    return session_data
+
+async def make_user(database: AsyncDatabase, username: str, password: str, session_name: str, user_slot: str) -> SessionData:
+    if await database.has_username(username, except_user_id=user_slot):
+        raise AlreadyExistsError()
+    login_data = await create_login_data(username, password)
+    await database.create_user(username, login_data.data, login_data.login_token, login_data.login_type.value, user_slot)
+    return await make_session(database, username, session_name)
+
+async def sign_up(database: AsyncDatabase, username: str, password: str, session_name: str, user_slot: str) -> SessionData:
+    validate_username_and_password(username, password)
+    return await make_user(database, username, password, session_name, user_slot)
+
+async def old_login(database: AsyncDatabase, username: str, password: str, session_name: str, extra_password: Optional[str] = None) -> SessionData:
+    corrected_username, user_login_data = await lookup_user_auth(database, username)
+    require_login_type(user_login_data, LoginType.WEAK)
+    verify_login_data(user_login_data, weak_create_login_data(corrected_username, password, user_login_data.login_token))
+    migrated_login_data = await create_login_data(corrected_username, extra_password or password)
+    await database.migrate_login_data(corrected_username, migrated_login_data.data, migrated_login_data.login_token, migrated_login_data.login_type.value)
+    return await make_session(database, corrected_username, session_name)
+
+async def login(database: AsyncDatabase, username: str, password: str, session_name: str) -> SessionData:
+    corrected_username, user_login_data = await lookup_user_auth(database, username)
+    require_login_type(user_login_data, LoginType.SHA3_512_PBKDF2HMAC_100000)
+    verify_login_data(user_login_data, await create_login_data(corrected_username, password, user_login_data.login_token))
+    return await make_session(database, corrected_username, session_name)
+
+async def logout(database: AsyncDatabase, response: Response, request: Request) -> Response:
+    session_data = SessionData.from_request(request)
+    if session_data is None:
+        return response
+    await database.delete_session(session_data.data)
+    await revoke_sessions(database, session_data=session_data.data)
+    return clear_session_cookies(response)
+
+async def bulk_create_user_slots(database: AsyncDatabase, actor: Permissions, slots: list[UserSlotRequest]) -> list[BulkResult]:
+    results, pending = plan_user_slots(actor, slots)
+    return settle_user_slots(slots, results, pending, await database.create_user_slots(slot_rows(slots, pending)))
+
+async def bulk_remove_unfilled_users(database: AsyncDatabase, actor: Permissions, usernames: list[str]) -> list[BulkResult]:
+    plan_removals(actor, usernames)
+    removed = await database.remove_unfilled_users(usernames)
+    return settle_targets(usernames, [None] * len(usernames), list(range(len(usernames))), removed)
+
+async def bulk_disable_users(database: AsyncDatabase, actor: Permissions, usernames: list[str]) -> list[BulkResult]:
+    plan_disables(actor, usernames)
+    results, pending = plan_targets(actor, usernames, await database.get_user_profiles(usernames))
+    disabled = await database.disable_users([usernames[index] for index in pending])
+    if disabled:
+        await revoke_sessions(database, usernames=disabled)
+    return settle_targets(usernames, results, pending, disabled)
+
+async def bulk_edit_users(database: AsyncDatabase, actor: Permissions, changes: list[UserChange]) -> list[BulkResult]:
+    usernames = plan_edits(actor, changes)
+    results, pending = plan_targets(actor, usernames, await database.get_user_profiles(usernames), [change.permission_group for change in changes])
+    fields = {changes[index].username: changes[index].fields() for index in pending}
+    updated = await database.update_users({username: values for username, values in fields.items() if values})
+    if updated:
+        await revoke_sessions(database, usernames=updated)
+    return settle_edits(usernames, results, pending, fields, updated)
+
+async def check_login_rate(database: AsyncDatabase, request: Request, username: Optional[str] = None) -> None:
+    await login_limiter.check_async(database, client_address(request, TRUSTED_PROXIES), username)
+
+async def get_user_profile(database: AsyncDatabase, username: str) -> UserProfile:
+    user_profile = await database.get_user_profile(username)
+    if user_profile is None:
+        raise NotFoundError()
+    return user_profile
+
+async def get_session_user_profile(database: AsyncDatabase, session: Session) -> UserProfile:
+    user_profile = await database.get_user_profile(session.username)
+    if user_profile is None:
+        raise NoSession()
+    return user_profile
+
+async def access_login_type(database: AsyncDatabase, username: str) -> LoginType:
+    _, login_data = await lookup_user_auth(database, username)
+    return login_data.login_type
+
+async def access_creation_credentials(database: AsyncDatabase, user: UserProfile, request: Request) -> PublicKeyCredentialCreationOptions:
+    data = prepare_credential_creation(user, request)
+    await challenge_store.put_async(database, creation_challenge_key(user), data.challenge)
+    return data
+
+async def verify_and_save_credential(database: AsyncDatabase, user: UserProfile, session: Session, request: Request, registration_credential: RegistrationCredential):
+    credential = verify_registration(request, registration_credential, await challenge_store.consume_async(database, creation_challenge_key(user)))
+    await database.create_authkey(credential.to_string(), credential.credential_id, session.username, session.session_name)
+
+async def access_login_credentials(database: AsyncDatabase, request: Request) -> PublicKeyCredentialRequestOptions:
+    key = login_challenge_key(request)
+    data = prepare_login_creation(request)
+    await challenge_store.put_async(database, key, data.challenge)
+    return data
+
+async def login_by_credential(database: AsyncDatabase, authentication_credential: AuthenticationCredential, session_name: str, request: Request) -> SessionData:
+    expected_challenge = await challenge_store.consume_async(database, login_challenge_key(request))
+    if expected_challenge is None:
+        raise NoSession()
+    data = await database.find_credential_by_id(credential_id_of(authentication_credential))
+    if not data:
+        raise NoSession()
+    stored_credential = WebAuthnCredential.from_string(data)
+    verify_authentication(request, authentication_credential, expected_challenge, stored_credential)
+    user = await database.get_user_profile_by_credential_id(stored_credential.credential_id)
+    if not user:
+        raise NoSession()
+    return await make_session(database, user.username, session_name)
@@ -0,0 +1,605 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from typing import Optional
+from uuid import uuid4
+from collections.abc import Hashable, AsyncIterator, Callable
+import asyncio
+import time
+from pymongo import AsyncMongoClient, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.server_api import ServerApi
+from pymongo.read_preferences import _ServerMode
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from .exceptions import NotFoundError, UserSlotTakenError, AlreadyExistsError
+from .database import Database, MongoSchema, UserProfile, UserListEntry, AuthRecord
+from .audit import AuditEvent
+from .user_cache import UserDirectory, DirectoryState, USERS_GENERATION
+from . import authentication
+from .tracing import traced_methods
+from .consts import *
+
+# Only what the async front end calls, the maintenance-only methods of Database stay synchronous
+class AsyncDatabase(ABC, Hashable):
+    def __hash__(self) -> int:
+        return hash(id(self))
+
+    def read_only(self) -> AsyncDatabase:
+        return self
+
+    async def connect(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abstractmethod
+    async def get_auth_record(self, username: str) -> Optional[AuthRecord]:
+        pass
+
+    @abstractmethod
+    async def add_session(self, session_data: str, username: str, session_name: str) -> list[str]:
+        pass
+
+    @abstractmethod
+    async def create_user(self, username: str, login_data: str, login_token: str, login_type: int, user_slot: str) -> None:
+        pass
+
+    @abstractmethod
+    async def has_username(self, username: str, *, except_user_id: Optional[str] = None) -> bool:
+        pass
+
+    @abstractmethod
+    async def get_session(self, session_data: str, created_after: float = 0, used_after: float = 0) -> Optional[authentication.Session]:
+        pass
+
+    @abstractmethod
+    async def touch_session(self, session_data: str, now: float) -> None:
+        pass
+
+    @abstractmethod
+    async def delete_session(self, session_data: str) -> None:
+        pass
+
+    @abstractmethod
+    async def list_users(self) -> list[UserProfile]:
+        pass
+
+    @abstractmethod
+    def iter_user_list(self, viewer_permission_group: int, view_member_settings: bool, view_invited_members: bool, limit: int, after: Optional[str] = None) -> AsyncIterator[UserListEntry]:
+        pass
+
+    @abstractmethod
+    async def get_user_profile(self, username: str) -> Optional[UserProfile]:
+        pass
+
+    # Batch variants for member administration, usernames match case-insensitively and the returned
+    # sets hold lookup usernames
+    @abstractmethod
+    async def get_user_profiles(self, usernames: list[str]) -> dict[str, UserProfile]:
+        pass
+
+    # Holds None for every slot whose name is already taken
+    @abstractmethod
+    async def create_user_slots(self, slots: list[tuple[int, int, str]]) -> list[Optional[str]]:
+        pass
+
+    @abstractmethod
+    async def remove_unfilled_users(self, usernames: list[str]) -> set[str]:
+        pass
+
+    # Maps each username to the fields to set, FIELD_SETTINGS and/or FIELD_PERMISSION_GROUP
+    @abstractmethod
+    async def update_users(self, changes: dict[str, dict[str, int]]) -> set[str]:
+        pass
+
+    @abstractmethod
+    async def disable_users(self, usernames: list[str]) -> set[str]:
+        pass
+
+    @abstractmethod
+    async def create_authkey(self, data: str, credential_id: bytes, username: str, session_name: str) -> None:
+        pass
+
+    @abstractmethod
+    async def find_credential_by_id(self, credential_id: bytes) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    async def get_user_profile_by_credential_id(self, credential_id: bytes) -> Optional[UserProfile]:
+        pass
+
+    @abstractmethod
+    async def migrate_login_data(self, username: str, login_data: str, login_token: str, login_type: int) -> None:
+        pass
+
+    @abstractmethod
+    async def get_generation(self, name: str) -> int:
+        pass
+
+    @abstractmethod
+    async def increment_generation(self, name: str) -> int:
+        pass
+
+    @abstractmethod
+    async def add_revocations(self, revocations: list[tuple[str, float, float]]) -> None:
+        pass
+
+    @abstractmethod
+    async def list_revocations(self, now: float) -> dict[str, float]:
+        pass
+
+    @abstractmethod
+    async def put_challenge(self, key: str, challenge: bytes, expires_at: float) -> None:
+        pass
+
+    @abstractmethod
+    async def consume_challenge(self, key: str, now: float) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    async def delete_expired_sessions(self, created_before: float, used_before: float) -> None:
+        pass
+
+    @abstractmethod
+    async def delete_stale_user_slots(self, invited_before: float) -> set[str]:
+        pass
+
+    @abstractmethod
+    async def delete_orphaned_credentials(self) -> None:
+        pass
+
+    # Takes a token from the shared token bucket of key and returns whether there was one
+    @abstractmethod
+    async def take_token(self, key: str, burst: float, rate: float, now: float) -> bool:
+        pass
+
+    @abstractmethod
+    async def insert_audit_events(self, events: list[AuditEvent]) -> None:
+        pass
+
+    @abstractmethod
+    async def list_audit_events(self, limit: int, before: Optional[str] = None, actor: Optional[str] = None, target: Optional[str] = None) -> list[AuditEvent]:
+        pass
+
+@traced_methods("db")
+class AsyncMongoDB(MongoSchema, AsyncDatabase):
+    client: AsyncMongoClient
+
+    def __init__(self, uri: str, username: Optional[str] = None, password: Optional[str] = None, db: str = "main_db", ensure_indexes: bool = True, read_preference: Optional[_ServerMode] = None):
+        if username and password:
+            uri = uri.format(username, password)
+        # Constructing the client does no I/O, the connection is checked in connect()
+        self.client = AsyncMongoClient(uri, server_api=ServerApi('1'))
+        self.use_database(self.client[db])
+        self.reader = self if read_preference is None else self.with_read_preference(read_preference)
+        self.should_ensure_indexes = ensure_indexes
+
+    def read_only(self):
+        return self.reader
+
+    async def connect(self):
+        await self.client.admin.command('ping')
+        if self.should_ensure_indexes:
+            await self.ensure_indexes()
+
+    async def close(self):
+        await self.client.close()
+
+    async def ensure_indexes(self) -> None:
+        for collection, indexes in self.INDEXES.items():
+            await self.db[collection].create_indexes(indexes)
+
+    async def lookup_usernames(self, query: dict) -> set[str]:
+        return {document[FIELD_LOOKUP_USERNAME] async for document in self.users.find(query, self.LOOKUP_PROJECTION)}
+
+    async def create_user(self, username, login_data, login_token, login_type, user_slot):
+        try:
+            result = await self.users.update_one(*self.fill_user_slot(user_slot, username, login_data, login_token, login_type))
+        except DuplicateKeyError:
+            raise AlreadyExistsError()
+        if result.matched_count == 0:
+            if await self.users.find_one(self.by_user_id(user_slot), {"_id": 1}) is None:
+                raise NotFoundError()
+            raise UserSlotTakenError()
+
+    async def get_auth_record(self, username):
+        document = await self.users.find_one(self.by_username(username), self.AUTH_RECORD_PROJECTION)
+        if document is None:
+            return None
+        return self.auth_record_from_document(document)
+
+    async def has_username(self, username, *, except_user_id = None):
+        return await self.users.find_one(self.other_than_slot(username, except_user_id), {"_id": 1}) is not None
+
+    async def add_session(self, session_data, username, session_name):
+        bucket = await self.sessions.find_one_and_update(self.by_username(username), self.capped_push(username, FIELD_SESSIONS, self.session_entry(session_data, session_name)), self.SESSION_DATA_PROJECTION, upsert=True, return_document=ReturnDocument.BEFORE)
+        return self.pushed_out_sessions(bucket)
+
+    async def get_session(self, session_data, created_after = 0, used_after = 0):
+        async for document in await self.sessions.aggregate(self.session_pipeline(self.by_session_data(session_data), session_data, created_after, used_after)):
+            return self.session_from_document(document)
+        return None
+
+    async def touch_session(self, session_data, now):
+        await self.sessions.update_one(self.by_session_data(session_data), self.touch_update(now))
+
+    async def delete_session(self, session_data):
+        await self.sessions.update_one(self.by_session_data(session_data), self.session_removal(session_data))
+
+    async def list_users(self):
+        return [self.user_profile_from_document(document) async for document in self.users.find()]
+
+    async def iter_user_list(self, viewer_permission_group, view_member_settings, view_invited_members, limit, after = None):
+        async for document in await self.users.aggregate(self.user_list_pipeline(viewer_permission_group, view_member_settings, view_invited_members, limit, after)):
+            yield self.user_list_entry_from_document(document)
+
+    async def get_user_profile(self, username):
+        document = await self.users.find_one(self.by_username(username))
+        if document is None:
+            return None
+        return self.user_profile_from_document(document)
+
+    async def get_user_profiles(self, usernames):
+        return {document[FIELD_LOOKUP_USERNAME]: self.user_profile_from_document(document) async for document in self.users.find(self.by_usernames(usernames))}
+
+    async def create_user_slots(self, slots):
+        documents = [self.user_slot_document(slot_settings, permission_group, temp_name) for slot_settings, permission_group, temp_name in slots]
+        if not documents:
+            return []
+        taken = set()
+        try:
+            await self.users.insert_many(documents, ordered=False)
+        except BulkWriteError as exc:
+            taken = self.duplicate_indexes(exc)
+        return [None if index in taken else document[FIELD_USER_ID] for index, document in enumerate(documents)]
+
+    async def remove_unfilled_users(self, usernames):
+        found = await self.lookup_usernames(self.by_usernames(usernames, unfilled=True))
+        if not found:
+            return set()
+        result = await self.users.delete_many(self.by_usernames(found, unfilled=True))
+        if result.deleted_count == len(found):
+            return found
+        return found - await self.lookup_usernames(self.by_usernames(found))
+
+    async def update_users(self, changes):
+        changes = {username.lower(): fields for username, fields in changes.items()}
+        if not changes:
+            return set()
+        result = await self.users.bulk_write(self.user_updates(changes), ordered=False)
+        if result.matched_count == len(changes):
+            return set(changes)
+        return await self.lookup_usernames(self.by_usernames(changes))
+
+    async def disable_users(self, usernames):
+        slots = {username.lower(): str(uuid4()) for username in usernames}
+        if not slots:
+            return set()
+        await self.users.bulk_write([UpdateOne(*self.disable_update(username, user_id)) for username, user_id in slots.items()], ordered=False)
+        disabled = await self.lookup_usernames(self.by_user_ids(slots.values()))
+        if disabled:
+            await self.sessions.delete_many(self.by_usernames(disabled))
+            await self.authkeys.delete_many(self.by_usernames(disabled))
+        return disabled
+
+    async def create_authkey(self, data, credential_id, username, session_name):
+        await self.authkeys.update_one(self.by_username(username), self.capped_push(username, FIELD_AUTHKEYS, self.authkey_entry(data, credential_id, session_name)), upsert=True)
+
+    async def find_credential_by_id(self, credential_id):
+        return self.credential_data(await self.authkeys.find_one(self.by_credential_id(credential_id), self.CREDENTIAL_PROJECTION))
+
+    async def get_user_profile_by_credential_id(self, credential_id):
+        async for document in await self.authkeys.aggregate(self.credential_owner_pipeline(credential_id)):
+            return self.user_profile_from_document(document)
+        return None
+
+    async def migrate_login_data(self, username, login_data, login_token, login_type):
+        await self.users.update_one(self.by_username(username), self.login_data_update(login_data, login_token, login_type))
+
+    async def get_generation(self, name):
+        return self.generation_from_document(await self.generations.find_one(self.by_id(name)))
+
+    async def increment_generation(self, name):
+        return self.generation_from_document(await self.generations.find_one_and_update(self.by_id(name), self.GENERATION_INCREMENT, upsert=True, return_document=ReturnDocument.AFTER))
+
+    async def add_revocations(self, revocations):
+        if revocations:
+            await self.revocations.bulk_write(self.revocation_updates(revocations), ordered=False)
+
+    async def list_revocations(self, now):
+        return {document["_id"]: document[FIELD_REVOKED_AT] async for document in self.revocations.find(self.unexpired(now))}
+
+    async def put_challenge(self, key, challenge, expires_at):
+        await self.challenges.replace_one(self.by_id(key), self.challenge_document(challenge, expires_at), upsert=True)
+
+    async def consume_challenge(self, key, now):
+        document = await self.challenges.find_one_and_delete(self.unexpired(now, key))
+        if document is None:
+            return None
+        return document[FIELD_CHALLENGE]
+
+    async def delete_expired_sessions(self, created_before, used_before):
+        await self.sessions.update_many(*self.expired_sessions_update(created_before, used_before))
+
+    async def delete_stale_user_slots(self, invited_before):
+        query = self.stale_user_slots_query(invited_before)
+        stale = await self.lookup_usernames(query)
+        if stale:
+            await self.users.delete_many({**query, **self.by_usernames(stale)})
+        return stale
+
+    async def delete_orphaned_credentials(self):
+        for collection in (self.sessions, self.authkeys):
+            orphaned = [document["_id"] async for document in await collection.aggregate(self.orphaned_buckets_pipeline())]
+            if orphaned:
+                await collection.delete_many(self.by_ids(orphaned))
+
+    async def take_token(self, key, burst, rate, now):
+        try:
+            document = await self.rate_limits.find_one_and_update(self.by_id(key), self.token_bucket_update(burst, rate, now), self.ALLOWED_PROJECTION, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            document = await self.rate_limits.find_one_and_update(self.by_id(key), self.token_bucket_update(burst, rate, now), self.ALLOWED_PROJECTION, return_document=ReturnDocument.AFTER)
+        return document[FIELD_ALLOWED]
+
+    async def insert_audit_events(self, events):
+        await self.audit.insert_many([self.audit_document(event) for event in events], ordered=False)
+
+    async def list_audit_events(self, limit, before = None, actor = None, target = None):
+        cursor = self.audit.find(self.audit_query(before, actor, target)).sort("_id", DESCENDING).limit(limit)
+        return [self.audit_event_from_document(document) async for document in cursor]
+
+# Runs a synchronous backend (e.g. SQLiteDatabase) on worker threads so it can serve the async app
+# Not traced itself, the wrapped database records its calls from the worker thread
+class ThreadedAsyncDatabase(AsyncDatabase):
+    def __init__(self, database: Database):
+        self.database = database
+
+    async def get_auth_record(self, username):
+        return await asyncio.to_thread(self.database.get_auth_record, username)
+
+    async def add_session(self, session_data, username, session_name):
+        return await asyncio.to_thread(self.database.add_session, session_data, username, session_name)
+
+    async def create_user(self, username, login_data, login_token, login_type, user_slot):
+        await asyncio.to_thread(self.database.create_user, username, login_data, login_token, login_type, user_slot)
+
+    async def has_username(self, username, *, except_user_id = None):
+        return await asyncio.to_thread(self.database.has_username, username, except_user_id=except_user_id)
+
+    async def get_session(self, session_data, created_after = 0, used_after = 0):
+        return await asyncio.to_thread(self.database.get_session, session_data, created_after, used_after)
+
+    async def touch_session(self, session_data, now):
+        await asyncio.to_thread(self.database.touch_session, session_data, now)
+
+    async def delete_session(self, session_data):
+        await asyncio.to_thread(self.database.delete_session, session_data)
+
+    async def list_users(self):
+        return await asyncio.to_thread(self.database.list_users)
+
+    async def iter_user_list(self, viewer_permission_group, view_member_settings, view_invited_members, limit, after = None):
+        entries = await asyncio.to_thread(lambda: list(self.database.iter_user_list(viewer_permission_group, view_member_settings, view_invited_members, limit, after)))
+        for entry in entries:
+            yield entry
+
+    async def get_user_profile(self, username):
+        return await asyncio.to_thread(self.database.get_user_profile, username)
+
+    async def get_user_profiles(self, usernames):
+        return await asyncio.to_thread(self.database.get_user_profiles, usernames)
+
+    async def create_user_slots(self, slots):
+        return await asyncio.to_thread(self.database.create_user_slots, slots)
+
+    async def remove_unfilled_users(self, usernames):
+        return await asyncio.to_thread(self.database.remove_unfilled_users, usernames)
+
+    async def update_users(self, changes):
+        return await asyncio.to_thread(self.database.update_users, changes)
+
+    async def disable_users(self, usernames):
+        return await asyncio.to_thread(self.database.disable_users, usernames)
+
+    async def create_authkey(self, data, credential_id, username, session_name):
+        await asyncio.to_thread(self.database.create_authkey, data, credential_id, username, session_name)
+
+    async def find_credential_by_id(self, credential_id):
+        return await asyncio.to_thread(self.database.find_credential_by_id, credential_id)
+
+    async def get_user_profile_by_credential_id(self, credential_id):
+        return await asyncio.to_thread(self.database.get_user_profile_by_credential_id, credential_id)
+
+    async def migrate_login_data(self, username, login_data, login_token, login_type):
+        await asyncio.to_thread(self.database.migrate_login_data, username, login_data, login_token, login_type)
+
+    async def get_generation(self, name):
+        return await asyncio.to_thread(self.database.get_generation, name)
+
+    async def increment_generation(self, name):
+        return await asyncio.to_thread(self.database.increment_generation, name)
+
+    async def add_revocations(self, revocations):
+        await asyncio.to_thread(self.database.add_revocations, revocations)
+
+    async def list_revocations(self, now):
+        return await asyncio.to_thread(self.database.list_revocations, now)
+
+    async def put_challenge(self, key, challenge, expires_at):
+        await asyncio.to_thread(self.database.put_challenge, key, challenge, expires_at)
+
+    async def consume_challenge(self, key, now):
+        return await asyncio.to_thread(self.database.consume_challenge, key, now)
+
+    async def take_token(self, key, burst, rate, now):
+        return await asyncio.to_thread(self.database.take_token, key, burst, rate, now)
+
+    async def delete_expired_sessions(self, created_before, used_before):
+        await asyncio.to_thread(self.database.delete_expired_sessions, created_before, used_before)
+
+    async def delete_stale_user_slots(self, invited_before):
+        return await asyncio.to_thread(self.database.delete_stale_user_slots, invited_before)
+
+    async def delete_orphaned_credentials(self):
+        await asyncio.to_thread(self.database.delete_orphaned_credentials)
+
+    async def insert_audit_events(self, events):
+        await asyncio.to_thread(self.database.insert_audit_events, events)
+
+    async def list_audit_events(self, limit, before = None, actor = None, target = None):
+        return await asyncio.to_thread(self.database.list_audit_events, limit, before, actor, target)
+
+# The async counterpart of CachingDatabase for AsyncMongoDB, it shares the directory and the users
+# generation with the sync wrapper, so Flask and Quart workers on the same database see each other's
+# writes
+class AsyncCachingDatabase(DirectoryState, AsyncDatabase):
+    def __init__(self, database: AsyncDatabase, check_interval: float = 1):
+        super().__init__(check_interval)
+        self.database = database
+
+    def __getattr__(self, name: str):
+        return getattr(self.database, name)
+
+    def read_only(self):
+        # Misses load from the primary, a directory read from a secondary could miss our own writes
+        return self
+
+    async def connect(self):
+        await self.database.connect()
+
+    async def close(self):
+        await self.database.close()
+
+    async def current_directory(self) -> UserDirectory:
+        if self.check_due():
+            checked_at = time.monotonic()
+            self.observe_generation(await self.database.get_generation(USERS_GENERATION), checked_at)
+        directory = self.directory
+        if directory is not None:
+            return directory
+        epoch = self.epoch
+        return self.loaded(epoch, UserDirectory(await self.database.list_users()))
+
+    async def changed(self, apply: Optional[Callable[[UserDirectory], UserDirectory]] = None) -> None:
+        known = self.begin_change(apply)
+        self.end_change(known, await self.database.increment_generation(USERS_GENERATION))
+
+    async def get_user_profile(self, username):
+        return (await self.current_directory()).profiles.get(username.lower())
+
+    async def get_user_profiles(self, usernames):
+        return (await self.current_directory()).get_user_profiles(usernames)
+
+    async def has_username(self, username, *, except_user_id = None):
+        return (await self.current_directory()).has_username(username, except_user_id)
+
+    async def list_users(self):
+        return list((await self.current_directory()).profiles.values())
+
+    async def iter_user_list(self, viewer_permission_group, view_member_settings, view_invited_members, limit, after = None):
+        directory = await self.current_directory()
+        for entry in directory.iter_user_list(viewer_permission_group, view_member_settings, view_invited_members, limit, after):
+            yield entry
+
+    async def get_auth_record(self, username):
+        directory = await self.current_directory()
+        if username.lower() in directory.auth_records:
+            return directory.auth_records[username.lower()]
+        epoch = self.epoch
+        record = await self.database.get_auth_record(username)
+        self.store_auth_record(epoch, directory, username, record)
+        return record
+
+    async def create_user(self, username, login_data, login_token, login_type, user_slot):
+        try:
+            await self.database.create_user(username, login_data, login_token, login_type, user_slot)
+        finally:
+            await self.changed()
+
+    async def create_user_slots(self, slots):
+        user_ids = await self.database.create_user_slots(slots)
+        await self.changed(lambda directory: directory.with_slots(slots, user_ids))
+        return user_ids
+
+    async def remove_unfilled_users(self, usernames):
+        removed = await self.database.remove_unfilled_users(usernames)
+        if removed:
+            await self.changed(lambda directory: directory.replaced(removed=removed))
+        return removed
+
+    async def update_users(self, changes):
+        updated = await self.database.update_users(changes)
+        if updated:
+            await self.changed(lambda directory: directory.updated({username: fields for username, fields in changes.items() if username.lower() in updated}))
+        return updated
+
+    # Disabling hands out a new user id, the next read loads it
+    async def disable_users(self, usernames):
+        disabled = await self.database.disable_users(usernames)
+        if disabled:
+            await self.changed()
+        return disabled
+
+    async def migrate_login_data(self, username, login_data, login_token, login_type):
+        await self.database.migrate_login_data(username, login_data, login_token, login_type)
+        await self.changed(lambda directory: directory.without_auth_record(username))
+
+    async def add_session(self, session_data, username, session_name):
+        return await self.database.add_session(session_data, username, session_name)
+
+    async def get_session(self, session_data, created_after = 0, used_after = 0):
+        return await self.database.get_session(session_data, created_after, used_after)
+
+    async def touch_session(self, session_data, now):
+        await self.database.touch_session(session_data, now)
+
+    async def delete_session(self, session_data):
+        await self.database.delete_session(session_data)
+
+    async def create_authkey(self, data, credential_id, username, session_name):
+        await self.database.create_authkey(data, credential_id, username, session_name)
+
+    async def find_credential_by_id(self, credential_id):
+        return await self.database.find_credential_by_id(credential_id)
+
+    async def get_user_profile_by_credential_id(self, credential_id):
+        return await self.database.get_user_profile_by_credential_id(credential_id)
+
+    async def get_generation(self, name):
+        return await self.database.get_generation(name)
+
+    async def increment_generation(self, name):
+        return await self.database.increment_generation(name)
+
+    async def add_revocations(self, revocations):
+        await self.database.add_revocations(revocations)
+
+    async def list_revocations(self, now):
+        return await self.database.list_revocations(now)
+
+    async def put_challenge(self, key, challenge, expires_at):
+        await self.database.put_challenge(key, challenge, expires_at)
+
+    async def consume_challenge(self, key, now):
+        return await self.database.consume_challenge(key, now)
+
+    async def take_token(self, key, burst, rate, now):
+        return await self.database.take_token(key, burst, rate, now)
+
+    async def delete_expired_sessions(self, created_before, used_before):
+        await self.database.delete_expired_sessions(created_before, used_before)
+
+    # Sweeps are rare, the directory is simply loaded again
+    async def delete_stale_user_slots(self, invited_before):
+        removed = await self.database.delete_stale_user_slots(invited_before)
+        if removed:
+            await self.changed()
+        return removed
+
+    async def delete_orphaned_credentials(self):
+        await self.database.delete_orphaned_credentials()
+
+    async def insert_audit_events(self, events):
+        await self.database.insert_audit_events(events)
+
+    async def list_audit_events(self, limit, before = None, actor = None, target = None):
+        return await self.database.list_audit_events(limit, before, actor, target)
@@ -0,0 +1,187 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Optional, Self, TYPE_CHECKING
+from collections.abc import Hashable
+import asyncio
+import atexit
+import queue
+import secrets
+import threading
+import time
+from .consts import FIELD_EVENT_ID, FIELD_TIME, FIELD_ACTOR, FIELD_ACTION, FIELD_TARGET, FIELD_DATA
+
+if TYPE_CHECKING:
+    from .database import Database
+    from .async_database import AsyncDatabase
+
+@dataclass(frozen=True)
+class AuditEvent:
+    # Hex nanoseconds first, so ids sort by time and serve as the page key
+    event_id: str
+    time: float
+    actor: str
+    action: str
+    target: Optional[str] = None
+    data: dict = field(default_factory=dict)
+
+    @classmethod
+    def create(cls, actor: str, action: str, target: Optional[str] = None, data: Optional[dict] = None) -> Self:
+        now = time.time_ns()
+        return cls(f"{now:016x}{secrets.token_hex(4)}", now / 1e9, actor, action, target, data or {})
+
+    def to_dict(self) -> dict:
+        return {FIELD_EVENT_ID: self.event_id, FIELD_TIME: self.time, FIELD_ACTOR: self.actor, FIELD_ACTION: self.action, FIELD_TARGET: self.target, FIELD_DATA: self.data}
+
+# Admin handlers hand their events over without waiting for the database, a single flusher writes them
+# in batches. A full queue makes record wait up to block_timeout for room and then drops the event, so
+# a stalled database slows admin calls down a little instead of growing the queue without bound.
+# The Flask app flushes on a daemon thread started by the first event and drained at exit, the Quart
+# app runs the flusher as a task between before_serving and after_serving.
+class AuditLog:
+    def __init__(self, maxsize: int, batch_size: int, flush_interval: float, block_timeout: float):
+        self.queue: queue.Queue[Optional[tuple[Hashable, AuditEvent]]] = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self.thread: Optional[threading.Thread] = None
+        self.task: Optional[asyncio.Task] = None
+        self.counters = {"recorded": 0, "written": 0, "dropped": 0, "failed": 0}
+        self.lock = threading.Lock()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += amount
+
+    def record(self, database: Database, event: AuditEvent) -> None:
+        self.start()
+        try:
+            self.queue.put((database, event), timeout=self.block_timeout)
+        except queue.Full:
+            self.count("dropped")
+            return
+        self.count("recorded")
+
+    async def record_async(self, database: AsyncDatabase, event: AuditEvent) -> None:
+        try:
+            self.queue.put_nowait((database, event))
+        except queue.Full:
+            try:
+                await asyncio.to_thread(self.queue.put, (database, event), timeout=self.block_timeout)
+            except queue.Full:
+                self.count("dropped")
+                return
+        self.count("recorded")
+
+    def drain(self) -> list[tuple[Hashable, AuditEvent]]:
+        items = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return items
+            if item is not None:
+                items.append(item)
+
+    # Waits for an event, then collects more for up to flush_interval. None in the queue asks the
+    # flusher to write whatever is left and stop. An idle wait also ends after flush_interval, so a
+    # cancelled async flusher does not leave an executor thread blocked on the queue.
+    def take_batch(self) -> tuple[list[tuple[Hashable, AuditEvent]], bool]:
+        try:
+            item = self.queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return [], False
+        if item is None:
+            return self.drain(), True
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch + self.drain(), True
+            batch.append(item)
+        return batch, False
+
+    def groups(self, batch: list[tuple[Hashable, AuditEvent]]) -> list[tuple[Hashable, list[AuditEvent]]]:
+        grouped: dict[Hashable, list[AuditEvent]] = {}
+        for database, event in batch:
+            grouped.setdefault(database, []).append(event)
+        return [(database, events[start:start + self.batch_size]) for database, events in grouped.items() for start in range(0, len(events), self.batch_size)]
+
+    def write(self, batch: list[tuple[Hashable, AuditEvent]]) -> None:
+        for database, events in self.groups(batch):
+            try:
+                database.insert_audit_events(events)
+            except Exception:
+                self.count("failed", len(events))
+            else:
+                self.count("written", len(events))
+
+    async def write_async(self, batch: list[tuple[Hashable, AuditEvent]]) -> None:
+        for database, events in self.groups(batch):
+            try:
+                await database.insert_audit_events(events)
+            except Exception:
+                self.count("failed", len(events))
+            else:
+                self.count("written", len(events))
+
+    def run(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = self.take_batch()
+            self.write(batch)
+
+    async def run_async(self) -> None:
+        stop = False
+        while not stop:
+            batch, stop = await asyncio.to_thread(self.take_batch)
+            await self.write_async(batch)
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="audit-flusher", daemon=True)
+                self.thread.start()
+                # Writes the events still queued when the process exits
+                atexit.register(self.close)
+
+    def start_async(self) -> None:
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self.run_async())
+
+    def close(self, timeout: float = 10) -> None:
+        with self.lock:
+            thread, self.thread = self.thread, None
+        if thread is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    async def close_async(self, timeout: float = 10) -> None:
+        task, self.task = self.task, None
+        if task is None:
+            return
+        try:
+            await asyncio.to_thread(self.queue.put, None, timeout=timeout)
+        except queue.Full:
+            task.cancel()
+            return
+        try:
+            await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {**self.counters, "queued": self.queue.qsize()}
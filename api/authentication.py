@@ -1,9 +1,11 @@
 from __future__ import annotations
 from hashlib import sha3_512
 from io import BytesIO
-from typing import Optional, Self
+from typing import Optional, Self, TYPE_CHECKING, cast
+from collections.abc import Hashable, Iterable
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 from dataclasses import dataclass, field
+from functools import cached_property
 from hmac import compare_digest
 from enum import Flag, auto, Enum
 from datetime import datetime
@@ -14,19 +16,20 @@ import base64
 import secrets
 import uuid
 import sys
-import webauthn
+import threading
+import time
 from cachetools import LRUCache, cached, TTLCache
 from flask import Response, Request
-from webauthn.helpers.structs import PublicKeyCredentialCreationOptions, RegistrationCredential, PublicKeyCredentialRequestOptions, AuthenticationCredential
-from webauthn.helpers.exceptions import InvalidRegistrationResponse
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.hashes import SHA3_512
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import padding
 from . import database as _database
 from . import consts
+from .crypto_pool import CryptoPool
+from .permissions import Permissions, compile_permissions
+from .tracing import traced
+from .user_agent_cache import UserAgentCache
+from .challenge_store import ChallengeStore, MemoryChallengeStore, DatabaseChallengeStore
+from .lazy import Lazy
+from .ratelimit import RateLimit, RateLimiter, RateLimitStore, MemoryRateLimitStore, DatabaseRateLimitStore, client_address
+from .session_claims import ClaimSigner, RevocationList, SessionClaims, session_id, session_revocation_key, user_revocation_key
 from .exceptions import (
     NotFoundError,
     AlreadyExistsError,
@@ -39,10 +42,62 @@ from .exceptions import (
     NoSession,
     CannotBeNamedAnonymous,
     NeedsNotOldLogin,
-    NeedsOldLogin
+    NeedsOldLogin,
+    Unauthorized,
+    TooManyItems,
+    MyError
+)
+
+# webauthn, cryptography and user_agents are imported where they are used, most requests never need
+# them and importing them eagerly costs a serverless cold start several hundred milliseconds
+if TYPE_CHECKING:
+    from webauthn.helpers.structs import PublicKeyCredentialCreationOptions, RegistrationCredential, PublicKeyCredentialRequestOptions, AuthenticationCredential
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+    from .sweeper import Sweeper
+    from .audit import AuditLog
+
+DEFERRED_MODULES = (
+    "webauthn",
+    "webauthn.helpers.exceptions",
+    "cryptography.hazmat.primitives.kdf.pbkdf2",
+    "cryptography.hazmat.primitives.serialization",
+    "user_agents"
 )
 
 AUTH_SALT = str(os.getenv("AUTH_SALT"))
+CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS") or os.cpu_count() or 1)
+CRYPTO_QUEUE_LIMIT = int(os.getenv("CRYPTO_QUEUE_LIMIT") or 4 * CRYPTO_WORKERS)
+CRYPTO_TIMEOUT = float(os.getenv("CRYPTO_TIMEOUT") or 10)
+
+SESSION_CLAIMS_SECRET = os.getenv("SESSION_CLAIMS_SECRET")
+SESSION_CLAIMS_TTL = int(os.getenv("SESSION_CLAIMS_TTL") or 60)
+# "database" lets the options and verify requests of a ceremony land on different workers
+CHALLENGE_STORE = os.getenv("CHALLENGE_STORE") or "database"
+CHALLENGE_TTL = int(os.getenv("CHALLENGE_TTL") or 600)
+CHALLENGE_STORE_SIZE = int(os.getenv("CHALLENGE_STORE_SIZE") or 65536)
+# "memory" limits per worker, "database" shares the buckets between workers, "off" disables the limits
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE") or "memory"
+RATE_LIMIT_IP = RateLimit.parse(os.getenv("RATE_LIMIT_IP") or "30/60")
+RATE_LIMIT_USERNAME = RateLimit.parse(os.getenv("RATE_LIMIT_USERNAME") or "10/300")
+RATE_LIMIT_STORE_SIZE = int(os.getenv("RATE_LIMIT_STORE_SIZE") or 65536)
+# Number of reverse proxies in front of the app whose X-Forwarded-For entries are trusted
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES") or 0)
+
+SESSION_MAX_AGE = int(os.getenv("SESSION_MAX_AGE") or consts.COOKIE_AGE)
+SESSION_IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT") or consts.COOKIE_AGE)
+# How stale a session's last use may get before a lookup writes it, only written while the idle
+# timeout is the shorter of the two
+SESSION_TOUCH_INTERVAL = int(os.getenv("SESSION_TOUCH_INTERVAL") or 3600)
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL") or 3600)
+USER_SLOT_MAX_AGE = int(os.getenv("USER_SLOT_MAX_AGE") or 0)
+
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE") or 10000)
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE") or 100)
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL") or 1)
+AUDIT_BLOCK_TIMEOUT = float(os.getenv("AUDIT_BLOCK_TIMEOUT") or 0.05)
+
+crypto_pool = CryptoPool(CRYPTO_WORKERS, CRYPTO_QUEUE_LIMIT, CRYPTO_TIMEOUT)
+claim_signer = ClaimSigner(SESSION_CLAIMS_SECRET.encode(), SESSION_CLAIMS_TTL) if SESSION_CLAIMS_SECRET else None
 
 class LoginType(Enum):
     WEAK = 0
@@ -71,23 +126,34 @@ class Session:
     session_name: str
     settings: Settings
     permission_group: int
+    last_used: Optional[datetime] = None
     @classmethod
     def create_empty_session(cls) -> Self:
         return cls(SessionData(""), datetime.now(), ANONYMOUS_USERNAME, ANONYMOUS_USERNAME, Settings.NONE, 1 - (1 << 31))
     
-    @cached(TTLCache(256, 60))
     @staticmethod
     def from_session_data(database: _database.Database, session_data: SessionData) -> Session:
-        session = database.get_session(session_data.data)
+        session = session_cache.get(database, session_data.data)
         if session is None:
             raise NoSession
         return session
     
     def is_empty(self) -> bool:
         return not self
+
+    def is_expired(self, now: float) -> bool:
+        created_after, used_after = session_cutoffs(now)
+        return self.creation_time.timestamp() <= created_after or (self.last_used or self.creation_time).timestamp() <= used_after
+
+    def needs_touch(self, now: float) -> bool:
+        return SESSION_IDLE_TIMEOUT < SESSION_MAX_AGE and now - (self.last_used or self.creation_time).timestamp() >= SESSION_TOUCH_INTERVAL
     
     def __bool__(self) -> bool:
         return self.username != ANONYMOUS_USERNAME
+
+    @cached_property
+    def permissions(self) -> Permissions:
+        return compile_permissions(self.settings.value, self.permission_group)
     
     def get_user_profile(self, database: _database.Database) -> _database.UserProfile:
         user_profile = database.get_user_profile(self.username)
@@ -95,6 +161,93 @@ class Session:
             raise NoSession()
         return user_profile
 
+# Entries remember when they were read. Revoking sessions records the revoked users and sessions and
+# moves the shared session generation, a worker that sees it move reloads the records and from then on
+# skips the entries read before a revocation that covers them, every other entry stays valid.
+# The bookkeeping methods never do I/O so the sync and async front ends can share one cache.
+class SessionCache:
+    def __init__(self, maxsize: int, ttl: float, generation_check_interval: float, revocations: RevocationList):
+        self.entries: TTLCache[tuple[Hashable, str], tuple[float, tuple[str, str], Session]] = TTLCache(maxsize, ttl)
+        self.session_keys: dict[tuple[Hashable, str], set[str]] = {}
+        self.known_generations: dict[Hashable, tuple[int, float]] = {}
+        self.generation_check_interval = generation_check_interval
+        self.revocations = revocations
+        self.lock = threading.Lock()
+
+    def fresh_generation(self, database: Hashable) -> Optional[int]:
+        with self.lock:
+            known = self.known_generations.get(database)
+            if known is not None and time.monotonic() - known[1] < self.generation_check_interval:
+                return known[0]
+        return None
+
+    def observe_generation(self, database: Hashable, generation: int, checked_at: float) -> None:
+        with self.lock:
+            self.known_generations[database] = (generation, checked_at)
+
+    # The records are read after the generation, so they include every revocation it counts
+    def needs_revocations(self, database: Hashable, generation: int) -> bool:
+        return not self.revocations.is_loaded(database, generation)
+
+    def lookup(self, database: Hashable, session_data: str) -> Optional[Session]:
+        with self.lock:
+            entry = self.entries.get((database, session_data))
+        if entry is None:
+            return None
+        read_at, keys, session = entry
+        if self.revocations.revoked_since(database, keys, read_at):
+            return None
+        return session
+
+    # read_at is taken before the database read, a revocation racing with it still covers the entry
+    def store(self, database: Hashable, session_data: str, read_at: float, session: Session) -> None:
+        with self.lock:
+            self.entries[(database, session_data)] = (read_at, (session_revocation_key(session_id(session_data)), user_revocation_key(session.username)), session)
+            keys = self.session_keys.setdefault((database, session.username.lower()), set())
+            keys.difference_update([key for key in keys if (database, key) not in self.entries])
+            keys.add(session_data)
+
+    def evict(self, database: Hashable, *, username: Optional[str] = None, session_data: Optional[str] = None, usernames: Iterable[str] = ()) -> None:
+        with self.lock:
+            keys = set()
+            if session_data is not None:
+                keys.add(session_data)
+            for name in [username, *usernames] if username is not None else usernames:
+                keys |= self.session_keys.pop((database, name.lower()), set())
+            for key in keys:
+                self.entries.pop((database, key), None)
+
+    def observe_increment(self, database: Hashable, generation: int) -> None:
+        self.observe_generation(database, generation, time.monotonic())
+
+    def generation(self, database: _database.Database) -> int:
+        generation = self.fresh_generation(database)
+        if generation is None:
+            checked_at = time.monotonic()
+            generation = database.get_generation(SESSION_GENERATION)
+            self.observe_generation(database, generation, checked_at)
+        if self.needs_revocations(database, generation):
+            self.revocations.load(database, generation, database.list_revocations(time.time()))
+        return generation
+
+    def get(self, database: _database.Database, session_data: str) -> Optional[Session]:
+        self.generation(database)
+        now = time.time()
+        session = self.lookup(database, session_data)
+        if session is None or session.is_expired(now):
+            session = database.get_session(session_data, *session_cutoffs(now))
+            if session is None:
+                return None
+            self.store(database, session_data, now, session)
+        if session.needs_touch(now):
+            database.touch_session(session_data, now)
+            session.last_used = datetime.fromtimestamp(now)
+        return session
+
+    def invalidate(self, database: _database.Database, *, username: Optional[str] = None, session_data: Optional[str] = None, usernames: Iterable[str] = ()) -> None:
+        self.evict(database, username=username, session_data=session_data, usernames=usernames)
+        self.observe_increment(database, database.increment_generation(SESSION_GENERATION))
+
 @dataclass(frozen=True)
 class WebAuthnCredential:
     credential_public_key: bytes
@@ -155,12 +308,48 @@ encode_b64 = urlsafe_b64encode
 decode_b64 = urlsafe_b64decode
 
 SESSION_DATA_COOKIE_NAME = "session"
+SESSION_CLAIMS_COOKIE_NAME = "session_claims"
+SESSION_GENERATION = "sessions"
+SESSION_CACHE_SIZE = 1 << 16
+SESSION_CACHE_TTL = 900
+SESSION_GENERATION_CHECK_INTERVAL = 1
 VALID_CHARACTERS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_-"
 ANONYMOUS_USERNAME = "anonymous"
+TEST_USERNAME_PREFIX = "TEST_USERNAME_USING_THIS_NAME_WILL_NOT_CREATE_A_USER"
+TEST_USER_SLOT = "NO_USER_SLOT_GENERATED"
 USERNAME_MAX_LENGTH = 32
 USERNAME_MIN_LENGTH = 3
 PASSWORD_MAX_LENGTH = 1024
 PASSWORD_MIN_LENGTH = 5
+USER_AGENT_CACHE_SIZE = 4096
+USER_AGENT_MAX_LENGTH = 1024
+
+# Claims issued shortly after a revocation may stem from a cache that had not seen the new generation yet
+revocations = RevocationList(SESSION_GENERATION_CHECK_INTERVAL + 1)
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL, SESSION_GENERATION_CHECK_INTERVAL, revocations)
+user_agent_cache = UserAgentCache(USER_AGENT_CACHE_SIZE, USER_AGENT_MAX_LENGTH)
+challenge_store: ChallengeStore = MemoryChallengeStore(CHALLENGE_STORE_SIZE, CHALLENGE_TTL) if CHALLENGE_STORE == "memory" else DatabaseChallengeStore(CHALLENGE_TTL)
+rate_limit_store: Optional[RateLimitStore] = None
+if RATE_LIMIT_STORE == "database":
+    rate_limit_store = DatabaseRateLimitStore()
+elif RATE_LIMIT_STORE != "off":
+    rate_limit_store = MemoryRateLimitStore(RATE_LIMIT_STORE_SIZE, max(RATE_LIMIT_IP.refill_time, RATE_LIMIT_USERNAME.refill_time))
+login_limiter = RateLimiter(rate_limit_store, RATE_LIMIT_IP, RATE_LIMIT_USERNAME)
+
+def create_sweeper() -> Sweeper:
+    from .sweeper import Sweeper
+    return Sweeper(SWEEP_INTERVAL, SESSION_MAX_AGE, SESSION_IDLE_TIMEOUT, USER_SLOT_MAX_AGE)
+
+def create_audit_log() -> AuditLog:
+    from .audit import AuditLog
+    return AuditLog(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_BLOCK_TIMEOUT)
+
+# Built by the first login or admin action, a cold start serving anything else never pays for them
+sweeper = cast("Sweeper", Lazy(create_sweeper))
+audit_log = cast("AuditLog", Lazy(create_audit_log))
+
+def session_cutoffs(now: float) -> tuple[float, float]:
+    return now - SESSION_MAX_AGE, now - SESSION_IDLE_TIMEOUT
 
 def validate_username_and_password(username: str, password: str) -> None:
     username_constraints(username)
@@ -183,7 +372,13 @@ def password_constraints(password: str):
     if len(password) > PASSWORD_MAX_LENGTH:
         raise PasswordTooLong(f"Password must be between {PASSWORD_MIN_LENGTH} and {PASSWORD_MAX_LENGTH} characters long.")
 
+@traced("pbkdf2")
 def superhash(data: bytes, salt: bytes) -> bytes:
+    return crypto_pool.run(derive_superhash, data, salt)
+
+def derive_superhash(data: bytes, salt: bytes) -> bytes:
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+    from cryptography.hazmat.primitives.hashes import SHA3_512
     kdf = PBKDF2HMAC(
         SHA3_512(),
         64,
@@ -203,28 +398,45 @@ def weak_create_login_data(username: str, password: str, login_token: Optional[s
     hashed_data = sha3_512(unhashed_data.getbuffer()).digest()
     return LoginData(encode_b64(hashed_data).decode("utf-8"), login_token, LoginType.WEAK)
 
-def create_login_data(username: str, password: str, login_token: Optional[str] = None) -> LoginData:
+def prehash_login_data(username: str, password: str, login_token: str) -> bytes:
     unhashed_data = BytesIO()
     unhashed_data.write(len(username).to_bytes(1))
     unhashed_data.write(username.encode("utf-8"))
     unhashed_data.write(len(password).to_bytes(2))
     unhashed_data.write(password.encode("utf-8"))
-    login_token = login_token or str(uuid.uuid4())
     unhashed_data.write(login_token.encode("utf-8"))
     unhashed_data.write(len(AUTH_SALT).to_bytes(8))
     unhashed_data.write(AUTH_SALT.encode("utf-8"))
     hashed_data = sha3_512(unhashed_data.getbuffer()).digest()
-    base64_hashed_data = encode_b64(hashed_data)
-    superhashed = superhash(base64_hashed_data, login_token.encode("utf-8"))
-    encoded_superhash = encode_b64(superhashed).decode("utf-8")
-    return LoginData(encoded_superhash, login_token, LoginType.SHA3_512_PBKDF2HMAC_100000)
+    return encode_b64(hashed_data)
 
-def lookup_user_login_data(database: _database.Database, username: str) -> LoginData:
-    data = database.get_login_data_by_username(username)
-    if data is None:
+def superhashed_login_data(superhashed: bytes, login_token: str) -> LoginData:
+    return LoginData(encode_b64(superhashed).decode("utf-8"), login_token, LoginType.SHA3_512_PBKDF2HMAC_100000)
+
+def create_login_data(username: str, password: str, login_token: Optional[str] = None) -> LoginData:
+    login_token = login_token or str(uuid.uuid4())
+    base64_hashed_data = prehash_login_data(username, password, login_token)
+    return superhashed_login_data(superhash(base64_hashed_data, login_token.encode("utf-8")), login_token)
+
+def auth_from_record(record: Optional[_database.AuthRecord]) -> tuple[str, LoginData]:
+    if record is None or record.login_data is None or record.login_token is None:
         raise NotFoundError()
-    login_data, login_token, login_type_raw = data
-    return LoginData(login_data, login_token, LoginType(login_type_raw))
+    return record.username, LoginData(record.login_data, record.login_token, LoginType(record.login_type))
+
+def require_login_type(login_data: LoginData, login_type: LoginType) -> None:
+    if login_data.login_type != login_type:
+        raise NeedsNotOldLogin() if login_type == LoginType.WEAK else NeedsOldLogin()
+
+def verify_login_data(user_login_data: LoginData, generated_login_data: LoginData) -> None:
+    if not compare_digest(user_login_data.data, generated_login_data.data):
+        raise InvalidCredentials()
+
+def lookup_user_auth(database: _database.Database, username: str) -> tuple[str, LoginData]:
+    return auth_from_record(database.get_auth_record(username))
+
+def lookup_user_login_data(database: _database.Database, username: str) -> LoginData:
+    _, login_data = lookup_user_auth(database, username)
+    return login_data
 
 def create_session_data() -> SessionData:
     return SessionData(secrets.token_urlsafe(256))
@@ -235,6 +447,7 @@ def lookup_user_by_session_data(database: _database.Database, session_data: str)
         raise NotFoundError()
     return user
 
+# The pre-check keeps a taken name from costing a PBKDF2 run, the unique index still settles races
 def make_user(database: _database.Database, username: str, password: str, session_name: str, user_slot: str) -> SessionData:
     if database.has_username(username, except_user_id=user_slot):
         raise AlreadyExistsError()
@@ -244,7 +457,10 @@ def make_user(database: _database.Database, username: str, password: str, sessio
 
 def make_session(database: _database.Database, username: str, session_name: str) -> SessionData:
     session_data = create_session_data()
-    database.add_session(session_data.data, username, session_name)
+    # A session the cap pushed out may still be cached or carry claims on any worker
+    for pushed_out in database.add_session(session_data.data, username, session_name):
+        revoke_sessions(database, session_data=pushed_out)
+    sweeper.start(database)
     return session_data
 
 def remove_unfilled_user(database: _database.Database, username: str) -> None:
@@ -256,18 +472,46 @@ def set_permission_group(database: _database.Database, username: str, permission
     success = database.set_permission_group(username, permission_group)
     if not success:
         raise NotFoundError()
+    revoke_sessions(database, username=username)
 
 def set_settings(database: _database.Database, username: str, settings: Settings) -> None:
     success = database.set_settings(username, settings.value)
     if not success:
         raise NotFoundError()
+    revoke_sessions(database, username=username)
 
 def disable_user(database: _database.Database, username: str) -> str:
     success = database.disable_user(username)
     if not success:
         raise NotFoundError()
+    revoke_sessions(database, username=username)
     return success
 
+# A batch of usernames costs one write and one generation increment, not one per user. The records are
+# written first, a worker that sees the new generation has to find them.
+def revoke_sessions(database: _database.Database, *, username: Optional[str] = None, session_data: Optional[str] = None, usernames: Iterable[str] = ()) -> None:
+    usernames = list(usernames)
+    records = revocation_records(username=username, session_data=session_data, usernames=usernames)
+    database.add_revocations(records)
+    for key, revoked_at, _ in records:
+        revocations.add(database, key, revoked_at)
+    session_cache.invalidate(database, username=username, session_data=session_data, usernames=usernames)
+
+# Kept until neither a cached session nor a claim from before the revocation can be used any more
+def revocation_records(*, username: Optional[str] = None, session_data: Optional[str] = None, usernames: Iterable[str] = ()) -> list[tuple[str, float, float]]:
+    revoked_at = time.time()
+    expires_at = revoked_at + max(SESSION_CACHE_TTL, claim_signer.ttl if claim_signer is not None else 0) + revocations.grace
+    return [(key, revoked_at, expires_at) for key in revocation_keys(username=username, session_data=session_data, usernames=usernames)]
+
+def revocation_keys(*, username: Optional[str] = None, session_data: Optional[str] = None, usernames: Iterable[str] = ()) -> list[str]:
+    keys = []
+    if username is not None:
+        keys.append(user_revocation_key(username))
+    keys.extend(user_revocation_key(name) for name in usernames)
+    if session_data is not None:
+        keys.append(session_revocation_key(session_id(session_data)))
+    return keys
+
 @cached(cache=LRUCache(1<<16, sys.getsizeof))
 def check_session(database: _database.Database, session_data: SessionData) -> str:
     user = lookup_user_by_session_data(database, session_data.data)
@@ -281,34 +525,17 @@ def migrate_user_login_data(database: _database.Database, username: str, passwor
     database.migrate_login_data(username, generated_login_data.data, generated_login_data.login_token, generated_login_data.login_type.value)
 
 def old_login(database: _database.Database, username: str, password: str, session_name: str, extra_password: Optional[str] = None) -> SessionData:
-    if not database.has_username(username):
-        raise NotFoundError()
-    user_login_data = lookup_user_login_data(database, username)
-    if user_login_data.login_type != LoginType.WEAK:
-        raise NeedsNotOldLogin()
-    corrected_username = database.get_correctly_cased_username(username)
-    if corrected_username is None:
-        raise NotFoundError()
-    generated_login_data = weak_create_login_data(corrected_username, password, user_login_data.login_token)
-    success = compare_digest(user_login_data.data, generated_login_data.data)
-    if not success:
-        raise InvalidCredentials()
-    migrate_user_login_data(database, username, extra_password or password)
+    corrected_username, user_login_data = lookup_user_auth(database, username)
+    require_login_type(user_login_data, LoginType.WEAK)
+    verify_login_data(user_login_data, weak_create_login_data(corrected_username, password, user_login_data.login_token))
+    migrated_login_data = create_login_data(corrected_username, extra_password or password)
+    database.migrate_login_data(corrected_username, migrated_login_data.data, migrated_login_data.login_token, migrated_login_data.login_type.value)
     return make_session(database, corrected_username, session_name)
 
 def login(database: _database.Database, username: str, password: str, session_name: str) -> SessionData:
-    if not database.has_username(username):
-        raise NotFoundError()
-    user_login_data = lookup_user_login_data(database, username)
-    if user_login_data.login_type != LoginType.SHA3_512_PBKDF2HMAC_100000:
-        raise NeedsOldLogin()
-    corrected_username = database.get_correctly_cased_username(username)
-    if corrected_username is None:
-        raise NotFoundError()
-    generated_login_data = create_login_data(corrected_username, password, user_login_data.login_token)
-    success = compare_digest(user_login_data.data, generated_login_data.data)
-    if not success:
-        raise InvalidCredentials()
+    corrected_username, user_login_data = lookup_user_auth(database, username)
+    require_login_type(user_login_data, LoginType.SHA3_512_PBKDF2HMAC_100000)
+    verify_login_data(user_login_data, create_login_data(corrected_username, password, user_login_data.login_token))
     return make_session(database, corrected_username, session_name)
 
 def sign_up(database: _database.Database, username: str, password: str, session_name: str, user_slot: str) -> SessionData:
@@ -321,12 +548,162 @@ def create_user_slot(database: _database.Database, settings: Settings, permissio
     numeric_settings = settings.value
     return database.create_user_slot(numeric_settings, permission_group, temp_name)
 
+@dataclass(frozen=True)
+class BulkResult:
+    username: str
+    reason: Optional[str] = None
+    data: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        result: dict = {consts.FIELD_USERNAME: self.username, consts.FIELD_SUCCESS: self.reason is None}
+        if self.reason is not None:
+            result[consts.FIELD_REASON] = self.reason
+        if self.data is not None:
+            result[consts.FIELD_DATA] = self.data
+        return result
+
+@dataclass(frozen=True)
+class UserSlotRequest:
+    username: str
+    settings: Settings
+    permission_group: int
+    @classmethod
+    def from_dict(cls, item: dict) -> Self:
+        return cls(item[consts.FIELD_USERNAME], Settings(item[consts.FIELD_SETTINGS]), item[consts.FIELD_PERMISSION_GROUP])
+
+@dataclass(frozen=True)
+class UserChange:
+    username: str
+    settings: Optional[Settings] = None
+    permission_group: Optional[int] = None
+    @classmethod
+    def from_dict(cls, item: dict) -> Self:
+        settings = item.get(consts.FIELD_SETTINGS)
+        return cls(item[consts.FIELD_USERNAME], Settings(settings) if settings is not None else None, item.get(consts.FIELD_PERMISSION_GROUP))
+
+    def fields(self) -> dict[str, int]:
+        fields = {}
+        if self.settings is not None:
+            fields[consts.FIELD_SETTINGS] = self.settings.value
+        if self.permission_group is not None:
+            fields[consts.FIELD_PERMISSION_GROUP] = self.permission_group
+        return fields
+
+# The bulk operations check the same rules as their single-user endpoints, the caller's capability
+# once up front and everything that depends on the item per item. Items that fail a check get a
+# result with the reason and the rest of the batch goes to the database in one round trip.
+def check_bulk_size(items: list) -> None:
+    if len(items) > consts.BULK_MAX_ITEMS:
+        raise TooManyItems()
+
+def plan_user_slots(actor: Permissions, slots: list[UserSlotRequest]) -> tuple[list[Optional[BulkResult]], list[int]]:
+    check_bulk_size(slots)
+    if not actor.create_members:
+        raise Unauthorized()
+    results: list[Optional[BulkResult]] = [None] * len(slots)
+    pending = []
+    seen = set()
+    for index, slot in enumerate(slots):
+        try:
+            if not actor.grants(slot.settings.value) or not actor.outranks(slot.permission_group):
+                raise Unauthorized()
+            if slot.username.startswith(TEST_USERNAME_PREFIX):
+                results[index] = BulkResult(slot.username, data=TEST_USER_SLOT)
+                continue
+            username_constraints(slot.username)
+            if slot.username.lower() in seen:
+                raise AlreadyExistsError()
+        except MyError as exc:
+            results[index] = BulkResult(slot.username, exc.identifier)
+            continue
+        seen.add(slot.username.lower())
+        pending.append(index)
+    return results, pending
+
+def settle_user_slots(slots: list[UserSlotRequest], results: list[Optional[BulkResult]], pending: list[int], user_ids: list[Optional[str]]) -> list[BulkResult]:
+    for index, user_id in zip(pending, user_ids):
+        results[index] = BulkResult(slots[index].username, None if user_id is not None else AlreadyExistsError.identifier, user_id)
+    return [result for result in results if result is not None]
+
+def plan_removals(actor: Permissions, usernames: list[str]) -> None:
+    check_bulk_size(usernames)
+    if not actor.uninvite_members:
+        raise Unauthorized()
+
+def plan_disables(actor: Permissions, usernames: list[str]) -> None:
+    check_bulk_size(usernames)
+    if not actor.disable_members:
+        raise Unauthorized()
+
+def plan_edits(actor: Permissions, changes: list[UserChange]) -> list[str]:
+    check_bulk_size(changes)
+    if not actor.edit_member_settings:
+        raise Unauthorized()
+    return [change.username for change in changes]
+
+def plan_targets(actor: Permissions, usernames: list[str], profiles: dict[str, _database.UserProfile], new_permission_groups: Optional[list[Optional[int]]] = None) -> tuple[list[Optional[BulkResult]], list[int]]:
+    results: list[Optional[BulkResult]] = [None] * len(usernames)
+    pending = []
+    for index, username in enumerate(usernames):
+        profile = profiles.get(username.lower())
+        new_permission_group = new_permission_groups[index] if new_permission_groups is not None else None
+        if profile is None:
+            results[index] = BulkResult(username, NotFoundError.identifier)
+        elif not actor.outranks(profile.permission_group) or (new_permission_group is not None and not actor.outranks(new_permission_group)):
+            results[index] = BulkResult(username, Unauthorized.identifier)
+        else:
+            pending.append(index)
+    return results, pending
+
+def settle_targets(usernames: list[str], results: list[Optional[BulkResult]], pending: list[int], done: set[str]) -> list[BulkResult]:
+    for index in pending:
+        results[index] = BulkResult(usernames[index], None if usernames[index].lower() in done else NotFoundError.identifier)
+    return [result for result in results if result is not None]
+
+def slot_rows(slots: list[UserSlotRequest], pending: list[int]) -> list[tuple[int, int, str]]:
+    return [(slots[index].settings.value, slots[index].permission_group, slots[index].username) for index in pending]
+
+# An item without changes is done as soon as its user exists
+def settle_edits(usernames: list[str], results: list[Optional[BulkResult]], pending: list[int], fields: dict[str, dict[str, int]], updated: set[str]) -> list[BulkResult]:
+    return settle_targets(usernames, results, pending, updated | {username.lower() for username, values in fields.items() if not values})
+
+def bulk_create_user_slots(database: _database.Database, actor: Permissions, slots: list[UserSlotRequest]) -> list[BulkResult]:
+    results, pending = plan_user_slots(actor, slots)
+    return settle_user_slots(slots, results, pending, database.create_user_slots(slot_rows(slots, pending)))
+
+def bulk_remove_unfilled_users(database: _database.Database, actor: Permissions, usernames: list[str]) -> list[BulkResult]:
+    plan_removals(actor, usernames)
+    removed = database.remove_unfilled_users(usernames)
+    return settle_targets(usernames, [None] * len(usernames), list(range(len(usernames))), removed)
+
+def bulk_disable_users(database: _database.Database, actor: Permissions, usernames: list[str]) -> list[BulkResult]:
+    plan_disables(actor, usernames)
+    results, pending = plan_targets(actor, usernames, database.get_user_profiles(usernames))
+    disabled = database.disable_users([usernames[index] for index in pending])
+    if disabled:
+        revoke_sessions(database, usernames=disabled)
+    return settle_targets(usernames, results, pending, disabled)
+
+def bulk_edit_users(database: _database.Database, actor: Permissions, changes: list[UserChange]) -> list[BulkResult]:
+    usernames = plan_edits(actor, changes)
+    results, pending = plan_targets(actor, usernames, database.get_user_profiles(usernames), [change.permission_group for change in changes])
+    fields = {changes[index].username: changes[index].fields() for index in pending}
+    updated = database.update_users({username: values for username, values in fields.items() if values})
+    if updated:
+        revoke_sessions(database, usernames=updated)
+    return settle_edits(usernames, results, pending, fields, updated)
+
 def logout(database: _database.Database, response: Response, request: Request) -> Response:
     session_data = SessionData.from_request(request)
     if session_data is None:
         return response
     database.delete_session(session_data.data)
+    revoke_sessions(database, session_data=session_data.data)
+    return clear_session_cookies(response)
+
+def clear_session_cookies(response: Response) -> Response:
     response.set_cookie(SESSION_DATA_COOKIE_NAME, "", expires=0)
+    response.set_cookie(SESSION_CLAIMS_COOKIE_NAME, "", expires=0)
     return response
 
 def extract_session(database: _database.Database, request: Request) -> Session:
@@ -341,6 +718,49 @@ def extract_session_or_empty(database: _database.Database, request: Request) ->
     except NoSession:
         return Session.create_empty_session()
 
+def issue_session_claims(session_data: SessionData, session: Session) -> Optional[str]:
+    if claim_signer is None:
+        return None
+    return claim_signer.issue(session_data.data, session.username, session.session_name, session.settings.value, session.permission_group, session.creation_time.timestamp())
+
+def session_from_claims(session_data: SessionData, claims: SessionClaims) -> Session:
+    return Session(session_data, datetime.fromtimestamp(claims.creation_time), claims.username, claims.session_name, Settings(claims.settings), claims.permission_group)
+
+def signed_claims(request: Request, session_data: SessionData) -> Optional[SessionClaims]:
+    token = request.cookies.get(SESSION_CLAIMS_COOKIE_NAME)
+    if claim_signer is None or not token:
+        return None
+    claims = claim_signer.verify(token, session_data.data)
+    # Claims are only reissued by a session lookup, which also enforces the idle timeout
+    if claims is None or claims.creation_time <= session_cutoffs(time.time())[0]:
+        return None
+    return claims
+
+def verify_session_claims(database: _database.Database, request: Request, session_data: SessionData) -> Optional[SessionClaims]:
+    claims = signed_claims(request, session_data)
+    if claims is None:
+        return None
+    session_cache.generation(database)
+    if revocations.is_revoked(database, claims):
+        return None
+    return claims
+
+# For read-only endpoints: a valid claims cookie answers without the database, otherwise the session is
+# loaded as usual and fresh claims are returned for the caller to set.
+def extract_claimed_session(database: _database.Database, request: Request) -> tuple[Session, Optional[str]]:
+    session_data = SessionData.from_request(request)
+    if session_data is None:
+        raise NoSession()
+    claims = verify_session_claims(database, request, session_data)
+    if claims is not None:
+        return session_from_claims(session_data, claims), None
+    session = Session.from_session_data(database, session_data)
+    return session, issue_session_claims(session_data, session)
+
+def set_session_claims(response: Response, claims: str) -> Response:
+    response.set_cookie(SESSION_CLAIMS_COOKIE_NAME, claims, max_age=SESSION_CLAIMS_TTL)
+    return response
+
 def add_csrf_token(response: Response) -> Response:
     response.set_cookie(consts.FIELD_CSRF_TOKEN, secrets.token_urlsafe(128), max_age=consts.COOKIE_AGE * 2)
     return response
@@ -357,6 +777,12 @@ def verify_csrf_token(req: Request) -> None:
 def extract_hostname(request: Request):
     return str(urlparse(request.base_url).hostname)
 
+def check_login_rate(database: _database.Database, request: Request, username: Optional[str] = None) -> None:
+    login_limiter.check(database, client_address(request, TRUSTED_PROXIES), username)
+
+def session_name(request: Request) -> str:
+    return user_agent_cache.get(request.user_agent.string)
+
 def get_user_profile(database: _database.Database, username: str) -> _database.UserProfile:
     user_profile = database.get_user_profile(username)
     if user_profile is None:
@@ -364,6 +790,7 @@ def get_user_profile(database: _database.Database, username: str) -> _database.U
     return user_profile
 
 def prepare_credential_creation(user: _database.UserProfile, request: Request) -> PublicKeyCredentialCreationOptions:
+    import webauthn
     return webauthn.generate_registration_options(
         rp_id=extract_hostname(request),
         rp_name="Inconspicuous",
@@ -371,77 +798,90 @@ def prepare_credential_creation(user: _database.UserProfile, request: Request) -
         user_name=user.username,
     )
 
-access_creation_credentials_cache: TTLCache[str, PublicKeyCredentialCreationOptions] = TTLCache(1024, 600)
+def creation_challenge_key(user: _database.UserProfile) -> str:
+    return "creation:" + user.username.lower()
 
-def access_creation_credentials(user: _database.UserProfile, request: Request) -> PublicKeyCredentialCreationOptions:
-    if user.username in access_creation_credentials_cache:
-        data = access_creation_credentials_cache[user.username]
-    else:
-        data = prepare_credential_creation(user, request)
-        access_creation_credentials_cache[user.username] = data
+def login_challenge_key(request: Request) -> str:
+    csrf_token = request.cookies.get(consts.FIELD_CSRF_TOKEN)
+    if not csrf_token:
+        raise NoSession()
+    return "login:" + csrf_token
+
+# A new options request replaces the pending challenge of the same ceremony
+def access_creation_credentials(database: _database.Database, user: _database.UserProfile, request: Request) -> PublicKeyCredentialCreationOptions:
+    data = prepare_credential_creation(user, request)
+    challenge_store.put(database, creation_challenge_key(user), data.challenge)
     return data
 
 def verify_and_save_credential(database: _database.Database, user: _database.UserProfile, session: Session, request: Request, registration_credential: RegistrationCredential):
-    expected_challenge = access_creation_credentials(user, request)
+    credential = verify_registration(request, registration_credential, challenge_store.consume(database, creation_challenge_key(user)))
+    credential.save_to_database(database, session)
+
+def verify_registration(request: Request, registration_credential: RegistrationCredential, expected_challenge: Optional[bytes]) -> WebAuthnCredential:
+    import webauthn
+    from webauthn.helpers.exceptions import InvalidRegistrationResponse
+    if expected_challenge is None:
+        raise NoSession()
     try:
         auth_verification = webauthn.verify_registration_response(
             credential=registration_credential,
-            expected_challenge=expected_challenge.challenge,
+            expected_challenge=expected_challenge,
             expected_origin=f"https://{extract_hostname(request)}",
             expected_rp_id=extract_hostname(request),
         )
     except InvalidRegistrationResponse:
         raise NoSession()
-    credential = WebAuthnCredential(
+    return WebAuthnCredential(
         credential_public_key=auth_verification.credential_public_key,
         credential_id=auth_verification.credential_id,
     )
-    credential.save_to_database(database, session)
 
 def prepare_login_creation(request: Request) -> PublicKeyCredentialRequestOptions:
+    import webauthn
     authentication_options = webauthn.generate_authentication_options(
         rp_id=extract_hostname(request)
     )
     return authentication_options
 
-access_login_credentials_cache: TTLCache[str, PublicKeyCredentialRequestOptions] = TTLCache(1024, 600)
+def access_login_credentials(database: _database.Database, request: Request) -> PublicKeyCredentialRequestOptions:
+    key = login_challenge_key(request)
+    data = prepare_login_creation(request)
+    challenge_store.put(database, key, data.challenge)
+    return data
 
-def access_login_credentials(request: Request) -> PublicKeyCredentialRequestOptions:
-    csrf_token = request.cookies.get(consts.FIELD_CSRF_TOKEN)
-    if not csrf_token:
+def login_by_credential(database: _database.Database, authentication_credential: AuthenticationCredential, session_name: str, request: Request) -> SessionData:
+    # Consumed before verifying, a failed attempt needs new options
+    expected_challenge = challenge_store.consume(database, login_challenge_key(request))
+    if expected_challenge is None:
         raise NoSession()
-    if csrf_token in access_login_credentials_cache:
-        data = access_login_credentials_cache[csrf_token]
-    else:
-        data = prepare_login_creation(request)
-        access_login_credentials_cache[csrf_token] = data
-    return data
+    stored_credential = WebAuthnCredential.get_from_id(database, credential_id_of(authentication_credential))
+    verify_authentication(request, authentication_credential, expected_challenge, stored_credential)
+    user = stored_credential.get_user_profile(database)
+    return make_session(database, user.username, session_name)
 
-def delete_current_login_credentials(request: Request) -> None:
-    csrf_token = request.cookies.get(consts.FIELD_CSRF_TOKEN)
-    if csrf_token and csrf_token in access_login_credentials_cache:
-        access_login_credentials_cache.pop(csrf_token)
+def credential_id_of(authentication_credential: AuthenticationCredential) -> bytes:
+    import webauthn
+    return webauthn.base64url_to_bytes(authentication_credential.id)
 
-def login_by_credential(database: _database.Database, authentication_credential: AuthenticationCredential, session_name: str, request: Request) -> SessionData:
-    expected_challenge = access_login_credentials(request)
-    stored_credential = WebAuthnCredential.get_from_id(database, webauthn.base64url_to_bytes(authentication_credential.id))
+def verify_authentication(request: Request, authentication_credential: AuthenticationCredential, expected_challenge: bytes, stored_credential: WebAuthnCredential) -> None:
+    import webauthn
     webauthn.verify_authentication_response(
         credential=authentication_credential,
-        expected_challenge=expected_challenge.challenge,
+        expected_challenge=expected_challenge,
         expected_origin=f"https://{extract_hostname(request)}",
         expected_rp_id=extract_hostname(request),
         credential_public_key=stored_credential.credential_public_key,
         credential_current_sign_count=0
     )
-    delete_current_login_credentials(request)
-    user = stored_credential.get_user_profile(database)
-    return make_session(database, user.username, session_name)
 
 def access_login_type(database: _database.Database, username: str) -> LoginType:
     login_data = lookup_user_login_data(database, username)
     return login_data.login_type
 
 def rsa_key_from_data(data: bytes) -> RSAPrivateKey:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+    from cryptography.hazmat.backends import default_backend
     key = serialization.load_pem_private_key(
         data,
         password=None,
@@ -450,7 +890,13 @@ def rsa_key_from_data(data: bytes) -> RSAPrivateKey:
     assert isinstance(key, RSAPrivateKey)
     return key
 
+@traced("rsa")
 def decrypt_rsa(data: str, private_key: RSAPrivateKey) -> str:
+    return crypto_pool.run(rsa_decrypt, data, private_key)
+
+def rsa_decrypt(data: str, private_key: RSAPrivateKey) -> str:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
     ciphertext = base64.b64decode(data)
     plaintext = private_key.decrypt(
         ciphertext,
@@ -0,0 +1,50 @@
+# Builds the configured database for the web apps and the command line tools, so a tool does not have
+# to import a web app just to reach the database.
+from os import environ, getenv
+from typing import TYPE_CHECKING
+from .database import Database, MongoDB, SQLiteDatabase, read_preference_from_name
+from .user_cache import CachingDatabase
+
+if TYPE_CHECKING:
+    from .async_database import AsyncDatabase
+
+DATABASE_BACKEND = getenv("DATABASE_BACKEND", "mongodb").lower()
+
+def mongo_settings() -> tuple:
+    MONGO_DB_CONNECTION_URI = environ["MONGO_DB_CONNECTION_URI"]
+    MONGO_DB_PASSWORD = environ["MONGO_DB_PASSWORD"]
+    MONGO_DB_USERNAME = environ["MONGO_DB_USERNAME"]
+    # Only the read-only endpoints use it, sessions and writes always go to the primary
+    MONGO_READ_PREFERENCE = read_preference_from_name(getenv("MONGO_READ_PREFERENCE"), int(getenv("MONGO_MAX_STALENESS") or 90))
+    return MONGO_DB_CONNECTION_URI, MONGO_DB_USERNAME, MONGO_DB_PASSWORD, MONGO_READ_PREFERENCE
+
+USER_CACHE = bool(getenv("USER_CACHE"))
+USER_CACHE_CHECK_INTERVAL = float(getenv("USER_CACHE_CHECK_INTERVAL") or 1)
+
+def cached(database: Database) -> Database:
+    # Every worker and tool writing users has to run with it, only the cache marks users as changed
+    if USER_CACHE:
+        return CachingDatabase(database, USER_CACHE_CHECK_INTERVAL)
+    return database
+
+def create_database(ensure_indexes: bool = True) -> Database:
+    database: Database
+    if DATABASE_BACKEND == "sqlite":
+        database = SQLiteDatabase(getenv("SQLITE_DATABASE_PATH", "inconspicuous.db"))
+    else:
+        uri, username, password, read_preference = mongo_settings()
+        database = MongoDB(uri, username, password, ensure_indexes=ensure_indexes, read_preference=read_preference)
+        if getenv("VERIFY_QUERY_PLANS"):
+            database.verify_query_plans()
+    return cached(database)
+
+# Nothing is connected yet, the Quart app connects in before_serving
+def create_async_database() -> "AsyncDatabase":
+    from .async_database import AsyncMongoDB, ThreadedAsyncDatabase, AsyncCachingDatabase
+    if DATABASE_BACKEND == "sqlite":
+        return ThreadedAsyncDatabase(cached(SQLiteDatabase(getenv("SQLITE_DATABASE_PATH", "inconspicuous.db"))))
+    uri, username, password, read_preference = mongo_settings()
+    database = AsyncMongoDB(uri, username, password, read_preference=read_preference)
+    if USER_CACHE:
+        return AsyncCachingDatabase(database, USER_CACHE_CHECK_INTERVAL)
+    return database
@@ -0,0 +1,65 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from typing import Optional, TYPE_CHECKING
+from collections.abc import Hashable
+from cachetools import TTLCache
+import threading
+import time
+
+if TYPE_CHECKING:
+    from .database import Database
+    from .async_database import AsyncDatabase
+
+# WebAuthn challenges are single-use: consume returns a challenge at most once and only before it expires.
+class ChallengeStore(ABC):
+    @abstractmethod
+    def put(self, database: Database, key: str, challenge: bytes) -> None:
+        pass
+
+    @abstractmethod
+    def consume(self, database: Database, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    async def put_async(self, database: AsyncDatabase, key: str, challenge: bytes) -> None:
+        pass
+
+    @abstractmethod
+    async def consume_async(self, database: AsyncDatabase, key: str) -> Optional[bytes]:
+        pass
+
+# Only correct when every request of a ceremony reaches the same process
+class MemoryChallengeStore(ChallengeStore):
+    def __init__(self, maxsize: int, ttl: float):
+        self.challenges: TTLCache[tuple[Hashable, str], bytes] = TTLCache(maxsize, ttl)
+        self.lock = threading.Lock()
+
+    def put(self, database, key, challenge):
+        with self.lock:
+            self.challenges[(database, key)] = challenge
+
+    def consume(self, database, key):
+        with self.lock:
+            return self.challenges.pop((database, key), None)
+
+    async def put_async(self, database, key, challenge):
+        self.put(database, key, challenge)
+
+    async def consume_async(self, database, key):
+        return self.consume(database, key)
+
+class DatabaseChallengeStore(ChallengeStore):
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+
+    def put(self, database, key, challenge):
+        database.put_challenge(key, challenge, time.time() + self.ttl)
+
+    def consume(self, database, key):
+        return database.consume_challenge(key, time.time())
+
+    async def put_async(self, database, key, challenge):
+        await database.put_challenge(key, challenge, time.time() + self.ttl)
+
+    async def consume_async(self, database, key):
+        return await database.consume_challenge(key, time.time())
@@ -0,0 +1,79 @@
+from __future__ import annotations
+from typing import Callable, Optional
+from collections.abc import Iterable, Iterator, AsyncIterable, AsyncIterator
+from werkzeug.datastructures import Accept
+from werkzeug.sansio.response import Response as BaseResponse
+from flask import Response
+import os
+import zlib
+
+try:
+    import brotli # type: ignore
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE") or 1024)
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL") or 6)
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY") or 4)
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+def negotiate_encoding(accept_encodings: Accept) -> Optional[str]:
+    for encoding in ENCODINGS:
+        if accept_encodings.quality(encoding) > 0:
+            return encoding
+    return None
+
+def compressor(encoding: str, level: Optional[int] = None) -> tuple[Callable[[bytes], bytes], Callable[[], bytes]]:
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY if level is None else level)
+        return compressor.process, compressor.finish
+    # wbits 31 selects the gzip container
+    compressor = zlib.compressobj(COMPRESSION_LEVEL if level is None else level, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    process, finish = compressor(encoding, level)
+    return process(data) + finish()
+
+def compress_stream(chunks: Iterable[bytes | str], encoding: str) -> Iterator[bytes]:
+    process, finish = compressor(encoding)
+    for chunk in chunks:
+        compressed = process(chunk.encode() if isinstance(chunk, str) else chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+async def compress_async_stream(chunks: AsyncIterable[bytes | str], encoding: str) -> AsyncIterator[bytes]:
+    process, finish = compressor(encoding)
+    async for chunk in chunks:
+        compressed = process(chunk.encode() if isinstance(chunk, str) else chunk)
+        if compressed:
+            yield compressed
+    yield finish()
+
+def should_compress(response: BaseResponse) -> bool:
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return False
+    if "Content-Encoding" in response.headers or getattr(response, "direct_passthrough", False):
+        return False
+    return (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+
+# Streamed bodies have no size up front and are always compressed, buffered ones only above the threshold
+def compress_response(response: Response, accept_encodings: Accept) -> Response:
+    if not should_compress(response):
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(accept_encodings)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
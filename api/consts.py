@@ -13,17 +13,49 @@ FIELD_LOGIN_TOKEN = "login_token"
 FIELD_SESSION_DATA = "session_data"
 FIELD_SESSION_NAME = "session_name"
 FIELD_CREATION_TIME = "creation_time"
+FIELD_LAST_USED = "last_used"
+FIELD_INVITED_AT = "invited_at"
 FIELD_PASSWORD = "password"
 FIELD_USER_SLOT = "user_id"
 FIELD_CSRF_TOKEN = "csrftoken"
 FIELD_CSRF_TOKEN_HEADER = "X-CSRFTOKEN"
 FIELD_LOGIN_TYPE = "login_type"
 FIELD_HASHED_PASSWORD = "password_hash"
+FIELD_GENERATION = "generation"
+FIELD_USER_AGENT_CACHE = "user_agent_cache"
+FIELD_REVOKED_AT = "revoked_at"
+FIELD_EXPIRES_AT = "expires_at"
+FIELD_CHALLENGE = "challenge"
+FIELD_TOKENS = "tokens"
+FIELD_UPDATED_AT = "updated_at"
+FIELD_ALLOWED = "allowed"
+FIELD_RATE_LIMITS = "rate_limits"
+FIELD_SWEEPER = "sweeper"
+FIELD_AUDIT = "audit"
+FIELD_EVENT_ID = "event_id"
+FIELD_TIME = "time"
+FIELD_ACTOR = "actor"
+FIELD_LOOKUP_ACTOR = "_actor"
+FIELD_ACTION = "action"
+FIELD_TARGET = "target"
+FIELD_LOOKUP_TARGET = "_target"
+FIELD_SESSIONS = "sessions"
+FIELD_AUTHKEYS = "authkeys"
+FIELD_NEXT = "next"
+FIELD_AFTER = "after"
+FIELD_LIMIT = "limit"
+FIELD_USERS = "users"
+FIELD_RESULTS = "results"
 
 FIELD_PUBLIC_KEY = "public_key"
 FIELD_CRED_ID = "id"
 
 COOKIE_AGE = 86400 * 30
+USER_LIST_PAGE_SIZE = 200
+USER_LIST_MAX_PAGE_SIZE = 1000
+BULK_MAX_ITEMS = 500
+AUDIT_PAGE_SIZE = 100
+AUDIT_MAX_PAGE_SIZE = 1000
 
 SETTINGS_NAME_TRANSLATIONS = {
     "NONE": "Keine",
@@ -0,0 +1,43 @@
+from __future__ import annotations
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Callable, TypeVar, ParamSpec
+import asyncio
+import threading
+from .exceptions import ServerBusy
+
+P = ParamSpec("P")
+T = TypeVar("T")
+
+class CryptoPool:
+    def __init__(self, max_workers: int, max_pending: int, timeout: float):
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="crypto")
+        # One slot per running or queued job, so a burst is rejected instead of piling up
+        self.slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self.timeout = timeout
+
+    def submit(self, function: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> Future[T]:
+        if not self.slots.acquire(blocking=False):
+            raise ServerBusy()
+        try:
+            future = self.executor.submit(function, *args, **kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def run(self, function: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+        future = self.submit(function, *args, **kwargs)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise ServerBusy()
+
+    async def run_async(self, function: Callable[P, T], *args: P.args, **kwargs: P.kwargs) -> T:
+        future = self.submit(function, *args, **kwargs)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise ServerBusy()
@@ -1,18 +1,35 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Optional, Self
 from uuid import uuid4
 from datetime import datetime
-from collections.abc import Hashable
+from collections.abc import Hashable, Iterable, Iterator
+from contextlib import contextmanager
 from dataclasses import dataclass
+from base64 import urlsafe_b64encode, b64decode
+import copy
+import json
+import sqlite3
+import time
+import threading
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
-from pymongo import DESCENDING
-from .exceptions import NotFoundError, UserSlotTakenError
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.read_preferences import PrimaryPreferred, Secondary, SecondaryPreferred, Nearest, _ServerMode
+from .exceptions import NotFoundError, UserSlotTakenError, AlreadyExistsError, QueryPlanError, InvalidPageToken
 from . import authentication
+from .audit import AuditEvent
+from .tracing import traced_methods
 from .consts import *
 
 MAX_SESSIONS = 10
+READ_PREFERENCES = {
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest
+}
 
 @dataclass(frozen=True)
 class UserProfile:
@@ -22,10 +39,39 @@ class UserProfile:
     permission_group: int
     unfilled: bool
 
+@dataclass(frozen=True)
+class UserListEntry:
+    lookup_username: str
+    username: str
+    user_id: str
+    settings: int
+    permission_group: int
+
+def encode_page_token(lookup_username: str) -> str:
+    return urlsafe_b64encode(lookup_username.encode("utf-8")).decode("ascii")
+
+def decode_page_token(token: str) -> str:
+    try:
+        return b64decode(token.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+    except (ValueError, UnicodeError):
+        raise InvalidPageToken()
+
+@dataclass(frozen=True)
+class AuthRecord:
+    username: str
+    login_data: Optional[str]
+    login_token: Optional[str]
+    login_type: int
+
 class Database(ABC, Hashable):
     def __hash__(self) -> int:
         return hash(id(self))
 
+    # For pure reads that tolerate bounded staleness. Session lookups and reads that have to see a
+    # preceding write keep using the database itself.
+    def read_only(self) -> Database:
+        return self
+
     @abstractmethod
     def get_username_by_session_data(self, session_data: str) -> Optional[str]:
         pass
@@ -35,7 +81,12 @@ class Database(ABC, Hashable):
         pass
 
     @abstractmethod
-    def add_session(self, session_data: str, username: str, session_name: str) -> None:
+    def get_auth_record(self, username: str) -> Optional[AuthRecord]:
+        pass
+
+    @abstractmethod
+    # Returns the session data of the sessions the MAX_SESSIONS cap pushed out
+    def add_session(self, session_data: str, username: str, session_name: str) -> list[str]:
         pass
 
     @abstractmethod
@@ -54,8 +105,13 @@ class Database(ABC, Hashable):
     def list_sessions(self, username: str) -> list[authentication.Session]:
         pass
     
+    # Sessions created or last used at or before the cutoffs have expired and are not returned
+    @abstractmethod
+    def get_session(self, session_data: str, created_after: float = 0, used_after: float = 0) -> Optional[authentication.Session]:
+        pass
+
     @abstractmethod
-    def get_session(self, session_data: str) -> Optional[authentication.Session]:
+    def touch_session(self, session_data: str, now: float) -> None:
         pass
     
     @abstractmethod
@@ -66,6 +122,11 @@ class Database(ABC, Hashable):
     def list_users(self) -> list[UserProfile]:
         pass
     
+    # Yields at most limit entries ordered by lookup username, already masked for the viewer
+    @abstractmethod
+    def iter_user_list(self, viewer_permission_group: int, view_member_settings: bool, view_invited_members: bool, limit: int, after: Optional[str] = None) -> Iterator[UserListEntry]:
+        pass
+
     @abstractmethod
     def get_correctly_cased_username(self, username: str) -> Optional[str]:
         pass
@@ -89,6 +150,30 @@ class Database(ABC, Hashable):
     @abstractmethod
     def disable_user(self, username: str) -> Optional[str]:
         pass
+
+    # Batch variants for member administration, usernames match case-insensitively and the returned
+    # sets hold lookup usernames
+    @abstractmethod
+    def get_user_profiles(self, usernames: list[str]) -> dict[str, UserProfile]:
+        pass
+
+    # Holds None for every slot whose name is already taken
+    @abstractmethod
+    def create_user_slots(self, slots: list[tuple[int, int, str]]) -> list[Optional[str]]:
+        pass
+
+    @abstractmethod
+    def remove_unfilled_users(self, usernames: list[str]) -> set[str]:
+        pass
+
+    # Maps each username to the fields to set, FIELD_SETTINGS and/or FIELD_PERMISSION_GROUP
+    @abstractmethod
+    def update_users(self, changes: dict[str, dict[str, int]]) -> set[str]:
+        pass
+
+    @abstractmethod
+    def disable_users(self, usernames: list[str]) -> set[str]:
+        pass
     
     @abstractmethod
     def create_authkey(self, data: str, credential_id: bytes, username: str, session_name: str) -> None:
@@ -106,16 +191,513 @@ class Database(ABC, Hashable):
     def migrate_login_data(self, username: str, login_data: str, login_token: str, login_type: int) -> None:
         pass
 
-class MongoDB(Database):
+    @abstractmethod
+    def get_generation(self, name: str) -> int:
+        pass
+
+    @abstractmethod
+    def increment_generation(self, name: str) -> int:
+        pass
+
+    # Each revocation is (key, revoked_at, expires_at)
+    @abstractmethod
+    def add_revocations(self, revocations: list[tuple[str, float, float]]) -> None:
+        pass
+
+    @abstractmethod
+    def list_revocations(self, now: float) -> dict[str, float]:
+        pass
+
+    @abstractmethod
+    def put_challenge(self, key: str, challenge: bytes, expires_at: float) -> None:
+        pass
+
+    @abstractmethod
+    def consume_challenge(self, key: str, now: float) -> Optional[bytes]:
+        pass
+
+    # The sweeper's deletions. Sessions and authkeys of users that no longer exist or are disabled are
+    # orphaned, stale user slots are the ones never filled since they were handed out before the cutoff.
+    @abstractmethod
+    def delete_expired_sessions(self, created_before: float, used_before: float) -> None:
+        pass
+
+    @abstractmethod
+    def delete_stale_user_slots(self, invited_before: float) -> set[str]:
+        pass
+
+    @abstractmethod
+    def delete_orphaned_credentials(self) -> None:
+        pass
+
+    # Takes a token from the shared token bucket of key and returns whether there was one
+    @abstractmethod
+    def take_token(self, key: str, burst: float, rate: float, now: float) -> bool:
+        pass
+
+    @abstractmethod
+    def insert_audit_events(self, events: list[AuditEvent]) -> None:
+        pass
+
+    # Newest first, before is the event id the previous page ended with
+    @abstractmethod
+    def list_audit_events(self, limit: int, before: Optional[str] = None, actor: Optional[str] = None, target: Optional[str] = None) -> list[AuditEvent]:
+        pass
+
+def find_plan_stages(plan: object) -> Iterator[str]:
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            # A $lookup pushed down into the plan names its join strategy
+            yield f"{plan['stage']} {plan['strategy']}" if "strategy" in plan else plan["stage"]
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                yield from find_plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from find_plan_stages(value)
+
+# The winning plans wherever the explain output nests them: at the top for a find, under the $cursor
+# stage of an aggregation and once per shard on a sharded cluster
+def find_winning_plans(explanation: object) -> Iterator[dict]:
+    if isinstance(explanation, dict):
+        for key, value in explanation.items():
+            if key == "winningPlan":
+                yield value
+            elif key != "rejectedPlans":
+                yield from find_winning_plans(value)
+    elif isinstance(explanation, list):
+        for value in explanation:
+            yield from find_winning_plans(value)
+
+def plan_stages(explanation: dict) -> list[str]:
+    return [stage for plan in find_winning_plans(explanation) for stage in find_plan_stages(plan)]
+
+def scans_collection(stages: list[str]) -> bool:
+    # A $lookup joined any other way than through an index reads the whole foreign collection
+    return any(stage == "COLLSCAN" or (stage.startswith("EQ_LOOKUP") and stage != "EQ_LOOKUP IndexedLoopJoin") for stage in stages)
+
+def read_preference_from_name(name: Optional[str], max_staleness: int = -1) -> Optional[_ServerMode]:
+    if not name or name == "primary":
+        return None
+    if name not in READ_PREFERENCES:
+        raise ValueError(f"Unknown read preference {name!r}")
+    # The server rejects a max staleness below 90 seconds, -1 leaves it unbounded
+    return READ_PREFERENCES[name](max_staleness=max_staleness)
+
+class MongoSchema:
+    INDEXES = {
+        "users": [
+            IndexModel([(FIELD_LOOKUP_USERNAME, ASCENDING)], unique=True, name="users_by_username"),
+            IndexModel([(FIELD_USER_ID, ASCENDING)], unique=True, name="users_by_user_id"),
+            IndexModel([(FIELD_INVITED_AT, ASCENDING)], sparse=True, name="users_by_invited_at")
+        ],
+        # Sessions and authkeys are stored as one bucket document per user holding a capped array
+        "sessions": [
+            IndexModel([(FIELD_LOOKUP_USERNAME, ASCENDING)], unique=True, name="session_buckets_by_username"),
+            IndexModel([(f"{FIELD_SESSIONS}.{FIELD_SESSION_DATA}", ASCENDING)], unique=True, partialFilterExpression={f"{FIELD_SESSIONS}.{FIELD_SESSION_DATA}": {"$exists": True}}, name="session_buckets_by_session_data"),
+            IndexModel([(f"{FIELD_SESSIONS}.{FIELD_CREATION_TIME}", ASCENDING)], name="session_buckets_by_creation_time"),
+            IndexModel([(f"{FIELD_SESSIONS}.{FIELD_LAST_USED}", ASCENDING)], name="session_buckets_by_last_used")
+        ],
+        "authkeys": [
+            IndexModel([(FIELD_LOOKUP_USERNAME, ASCENDING)], unique=True, name="authkey_buckets_by_username"),
+            IndexModel([(f"{FIELD_AUTHKEYS}.{FIELD_CRED_ID}", ASCENDING)], unique=True, partialFilterExpression={f"{FIELD_AUTHKEYS}.{FIELD_CRED_ID}": {"$exists": True}}, name="authkey_buckets_by_id")
+        ],
+        "revocations": [
+            IndexModel([(FIELD_EXPIRES_AT, ASCENDING)], expireAfterSeconds=0, name="revocations_by_expiry")
+        ],
+        "challenges": [
+            IndexModel([(FIELD_EXPIRES_AT, ASCENDING)], expireAfterSeconds=0, name="challenges_by_expiry")
+        ],
+        "rate_limits": [
+            IndexModel([(FIELD_EXPIRES_AT, ASCENDING)], expireAfterSeconds=0, name="rate_limits_by_expiry")
+        ],
+        # The _id index serves the unfiltered log, event ids sort by time
+        "audit": [
+            IndexModel([(FIELD_LOOKUP_ACTOR, ASCENDING), ("_id", DESCENDING)], name="audit_by_actor"),
+            IndexModel([(FIELD_LOOKUP_TARGET, ASCENDING), ("_id", DESCENDING)], sparse=True, name="audit_by_target")
+        ]
+    }
+    # Indexes of the former one-document-per-session layout, dropped by migrate_legacy_documents. The
+    # bucket indexes cannot be built while such documents exist, so python -m api.migrate runs first.
+    LEGACY_INDEXES = {
+        "sessions": ["sessions_by_session_data", "sessions_by_username"],
+        "authkeys": ["authkeys_by_id", "authkeys_by_username"]
+    }
+    # Every filter/sort combination of the find, update and delete calls of the Mongo backends, checked
+    # by verify_query_plans together with the aggregations in pipeline_shapes
+    QUERY_SHAPES = (
+        ("users", {FIELD_LOOKUP_USERNAME: ""}, None),
+        ("users", {FIELD_LOOKUP_USERNAME: "", FIELD_USER_SLOT: {"$ne": None}}, None),
+        ("users", {FIELD_USER_SLOT: ""}, None),
+        ("users", {FIELD_USER_SLOT: "", FIELD_UNFILLED: True}, None),
+        ("users", {FIELD_LOOKUP_USERNAME: "", FIELD_UNFILLED: True}, None),
+        ("users", {FIELD_LOOKUP_USERNAME: "", FIELD_UNFILLED: False}, None),
+        ("users", {FIELD_LOOKUP_USERNAME: {"$in": [""]}}, None),
+        ("users", {FIELD_LOOKUP_USERNAME: {"$in": [""]}, FIELD_UNFILLED: True}, None),
+        ("users", {FIELD_USER_ID: {"$in": [""]}}, None),
+        ("users", {FIELD_UNFILLED: {"$ne": True}, FIELD_LOOKUP_USERNAME: {"$gt": ""}}, [(FIELD_LOOKUP_USERNAME, ASCENDING)]),
+        ("users", {FIELD_UNFILLED: True, FIELD_INVITED_AT: {"$lt": datetime.fromtimestamp(0)}}, None),
+        ("sessions", {FIELD_LOOKUP_USERNAME: ""}, None),
+        ("sessions", {FIELD_LOOKUP_USERNAME: {"$in": [""]}}, None),
+        ("sessions", {f"{FIELD_SESSIONS}.{FIELD_SESSION_DATA}": ""}, None),
+        ("sessions", {"$or": [{f"{FIELD_SESSIONS}.{FIELD_CREATION_TIME}": {"$lt": datetime.fromtimestamp(0)}}, {f"{FIELD_SESSIONS}.{FIELD_LAST_USED}": {"$lt": datetime.fromtimestamp(0)}}]}, None),
+        ("authkeys", {FIELD_LOOKUP_USERNAME: ""}, None),
+        ("authkeys", {f"{FIELD_AUTHKEYS}.{FIELD_CRED_ID}": b""}, None),
+        ("revocations", {FIELD_EXPIRES_AT: {"$gt": datetime.fromtimestamp(0)}}, None),
+        ("challenges", {"_id": "", FIELD_EXPIRES_AT: {"$gt": datetime.fromtimestamp(0)}}, None),
+        ("rate_limits", {"_id": ""}, None),
+        ("audit", {"_id": {"$lt": ""}}, [("_id", DESCENDING)]),
+        ("audit", {FIELD_LOOKUP_ACTOR: "", "_id": {"$lt": ""}}, [("_id", DESCENDING)]),
+        ("audit", {FIELD_LOOKUP_TARGET: "", "_id": {"$lt": ""}}, [("_id", DESCENDING)])
+    )
+    AUTH_RECORD_PROJECTION = {"_id": 0, FIELD_USERNAME: 1, FIELD_LOGIN_DATA: 1, FIELD_LOGIN_TOKEN: 1, FIELD_LOGIN_TYPE: 1}
+    LOOKUP_PROJECTION = {"_id": 0, FIELD_LOOKUP_USERNAME: 1}
+    USERNAME_PROJECTION = {"_id": 0, FIELD_USERNAME: 1}
+    CREDENTIAL_PROJECTION = {"_id": 0, f"{FIELD_AUTHKEYS}.$": 1}
+    SESSION_DATA_PROJECTION = {"_id": 0, f"{FIELD_SESSIONS}.{FIELD_SESSION_DATA}": 1}
+    ALLOWED_PROJECTION = {FIELD_ALLOWED: 1}
+    GENERATION_INCREMENT = {"$inc": {FIELD_GENERATION: 1}}
+
+    def use_database(self, db) -> None:
+        self.db = db
+        self.users = db.users
+        self.sessions = db.sessions
+        self.authkeys = db.authkeys
+        self.generations = db.generations
+        self.revocations = db.revocations
+        self.challenges = db.challenges
+        self.rate_limits = db.rate_limits
+        self.audit = db.audit
+
+    def with_read_preference(self, read_preference: _ServerMode) -> Self:
+        # Shares the client, only the collection handles carry the read preference
+        view = copy.copy(self)
+        view.use_database(self.db.with_options(read_preference=read_preference))
+        view.reader = view
+        return view
+
+    # The filters, updates and pipelines below are all the Mongo queries there are, MongoDB and
+    # AsyncMongoDB only differ in awaiting them
+    @staticmethod
+    def by_username(username: str, unfilled: Optional[bool] = None) -> dict:
+        query: dict = {FIELD_LOOKUP_USERNAME: username.lower()}
+        if unfilled is not None:
+            query[FIELD_UNFILLED] = unfilled
+        return query
+
+    @staticmethod
+    def by_usernames(usernames: Iterable[str], unfilled: Optional[bool] = None) -> dict:
+        query: dict = {FIELD_LOOKUP_USERNAME: {"$in": list({username.lower() for username in usernames})}}
+        if unfilled is not None:
+            query[FIELD_UNFILLED] = unfilled
+        return query
+
+    @staticmethod
+    def by_user_ids(user_ids: Iterable[str]) -> dict:
+        return {FIELD_USER_ID: {"$in": list(user_ids)}}
+
+    @staticmethod
+    def by_user_id(user_id: str) -> dict:
+        return {FIELD_USER_ID: user_id}
+
+    @staticmethod
+    def by_id(key: str) -> dict:
+        return {"_id": key}
+
+    @staticmethod
+    def by_ids(ids: list) -> dict:
+        return {"_id": {"$in": ids}}
+
+    @staticmethod
+    def by_session_data(session_data: str) -> dict:
+        return {f"{FIELD_SESSIONS}.{FIELD_SESSION_DATA}": session_data}
+
+    @staticmethod
+    def by_credential_id(credential_id: bytes) -> dict:
+        return {f"{FIELD_AUTHKEYS}.{FIELD_CRED_ID}": credential_id}
+
+    @staticmethod
+    def other_than_slot(username: str, except_user_id: Optional[str]) -> dict:
+        return {FIELD_LOOKUP_USERNAME: username.lower(), FIELD_USER_SLOT: {"$ne": except_user_id}}
+
+    @staticmethod
+    def unexpired(now: float, key: Optional[str] = None) -> dict:
+        query: dict = {FIELD_EXPIRES_AT: {"$gt": datetime.fromtimestamp(now)}}
+        if key is not None:
+            query["_id"] = key
+        return query
+
+    @staticmethod
+    def set_fields(fields: dict) -> dict:
+        return {"$set": fields}
+
+    @staticmethod
+    def login_data_update(login_data: str, login_token: str, login_type: int) -> dict:
+        return {"$set": {FIELD_LOGIN_DATA: login_data, FIELD_LOGIN_TOKEN: login_token, FIELD_LOGIN_TYPE: login_type}}
+
+    @staticmethod
+    def fill_user_slot(user_slot: str, username: str, login_data: str, login_token: str, login_type: int) -> tuple[dict, dict]:
+        return {FIELD_USER_SLOT: user_slot, FIELD_UNFILLED: True}, {
+            "$set": {
+                FIELD_UNFILLED: False,
+                FIELD_USERNAME: username,
+                FIELD_LOGIN_DATA: login_data,
+                FIELD_LOGIN_TOKEN: login_token,
+                FIELD_LOGIN_TYPE: login_type,
+                FIELD_LOOKUP_USERNAME: username.lower()
+            },
+            "$unset": {FIELD_INVITED_AT: ""}
+        }
+
+    @staticmethod
+    def user_updates(changes: dict[str, dict[str, int]]) -> list[UpdateOne]:
+        return [UpdateOne({FIELD_LOOKUP_USERNAME: username}, {"$set": fields}) for username, fields in changes.items()]
+
+    @staticmethod
+    def touch_update(now: float) -> dict:
+        return {"$max": {f"{FIELD_SESSIONS}.$.{FIELD_LAST_USED}": datetime.fromtimestamp(now)}}
+
+    @staticmethod
+    def session_removal(session_data: str) -> dict:
+        return {"$pull": {FIELD_SESSIONS: {FIELD_SESSION_DATA: session_data}}}
+
+    @staticmethod
+    def challenge_document(challenge: bytes, expires_at: float) -> dict:
+        return {FIELD_CHALLENGE: challenge, FIELD_EXPIRES_AT: datetime.fromtimestamp(expires_at)}
+
+    @staticmethod
+    def credential_data(bucket: Optional[dict]) -> Optional[str]:
+        if not bucket:
+            return None
+        return bucket[FIELD_AUTHKEYS][0].get(FIELD_DATA)
+
+    @staticmethod
+    def generation_from_document(document: Optional[dict]) -> int:
+        if document is None:
+            return 0
+        return document.get(FIELD_GENERATION, 0)
+
+    @staticmethod
+    def credential_owner_pipeline(credential_id: bytes) -> list[dict]:
+        # Resolves the credential's bucket to its account in the same round trip
+        return [
+            {"$match": {f"{FIELD_AUTHKEYS}.{FIELD_CRED_ID}": credential_id}},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": "users",
+                "localField": FIELD_LOOKUP_USERNAME,
+                "foreignField": FIELD_LOOKUP_USERNAME,
+                "as": "account"
+            }},
+            {"$unwind": "$account"},
+            {"$replaceRoot": {"newRoot": "$account"}}
+        ]
+
+    @staticmethod
+    def user_slot_document(slot_settings: int, permission_group: int, temp_name: str) -> dict:
+        return {FIELD_USER_ID: str(uuid4()), FIELD_USERNAME: temp_name, FIELD_LOOKUP_USERNAME: temp_name.lower(), FIELD_UNFILLED: True, FIELD_SETTINGS: slot_settings, FIELD_PERMISSION_GROUP: permission_group, FIELD_INVITED_AT: datetime.now()}
+
+    @staticmethod
+    def disable_update(username: str, user_id: str) -> tuple[dict, dict]:
+        return {FIELD_LOOKUP_USERNAME: username.lower(), FIELD_UNFILLED: False}, {"$set": {FIELD_UNFILLED: True, FIELD_USER_SLOT: user_id}, "$unset": {FIELD_LOGIN_DATA: ""}}
+
+    @staticmethod
+    def duplicate_indexes(exc: BulkWriteError) -> set[int]:
+        errors = exc.details.get("writeErrors", [])
+        if any(error["code"] != 11000 for error in errors) or exc.details.get("writeConcernErrors"):
+            raise exc
+        return {error["index"] for error in errors}
+
+    @staticmethod
+    def capped_push(username: str, array: str, entry: dict) -> dict:
+        # Appends the entry and trims the array to the newest MAX_SESSIONS in the same atomic update
+        return {
+            "$set": {FIELD_USERNAME: username},
+            "$push": {array: {"$each": [entry], "$slice": -MAX_SESSIONS}}
+        }
+
+    # The sessions a capped_push of one entry trims off, read from the bucket as it was before the push
+    @staticmethod
+    def pushed_out_sessions(bucket: Optional[dict]) -> list[str]:
+        entries = (bucket or {}).get(FIELD_SESSIONS, [])
+        return [entry[FIELD_SESSION_DATA] for entry in entries[:max(len(entries) + 1 - MAX_SESSIONS, 0)] if FIELD_SESSION_DATA in entry]
+
+    @staticmethod
+    def session_entry(session_data: str, session_name: str) -> dict:
+        now = datetime.now()
+        return {FIELD_SESSION_DATA: session_data, FIELD_SESSION_NAME: session_name, FIELD_CREATION_TIME: now, FIELD_LAST_USED: now}
+
+    @staticmethod
+    def last_used_backfill() -> list[dict]:
+        # Sessions from before idle expiry count as last used when they were created
+        return [{"$set": {FIELD_SESSIONS: {"$map": {
+            "input": "$" + FIELD_SESSIONS,
+            "in": {"$mergeObjects": [{FIELD_LAST_USED: "$$this." + FIELD_CREATION_TIME}, "$$this"]}
+        }}}}]
+
+    @staticmethod
+    def expired_sessions_update(created_before: float, used_before: float) -> tuple[dict, dict]:
+        created = {"$lt": datetime.fromtimestamp(created_before)}
+        used = {"$lt": datetime.fromtimestamp(used_before)}
+        query = {"$or": [{f"{FIELD_SESSIONS}.{FIELD_CREATION_TIME}": created}, {f"{FIELD_SESSIONS}.{FIELD_LAST_USED}": used}]}
+        return query, {"$pull": {FIELD_SESSIONS: {"$or": [{FIELD_CREATION_TIME: created}, {FIELD_LAST_USED: used}]}}}
+
+    @staticmethod
+    def stale_user_slots_query(invited_before: float) -> dict:
+        # Filling a slot removes its invitation time, disabled users have none and are never stale
+        return {FIELD_UNFILLED: True, FIELD_INVITED_AT: {"$lt": datetime.fromtimestamp(invited_before)}}
+
+    @staticmethod
+    def orphaned_buckets_pipeline() -> list[dict]:
+        return [
+            {"$lookup": {
+                "from": "users",
+                "localField": FIELD_LOOKUP_USERNAME,
+                "foreignField": FIELD_LOOKUP_USERNAME,
+                "pipeline": [{"$match": {FIELD_UNFILLED: {"$ne": True}}}, {"$project": {"_id": 1}}],
+                "as": "account"
+            }},
+            {"$match": {"account": {"$size": 0}}},
+            {"$project": {"_id": 1}}
+        ]
+
+    @staticmethod
+    def authkey_entry(data: str, credential_id: bytes, session_name: str) -> dict:
+        return {FIELD_CRED_ID: credential_id, FIELD_DATA: data, FIELD_CREATION_TIME: datetime.now(), FIELD_SESSION_NAME: session_name}
+
+    @staticmethod
+    def token_bucket_update(burst: float, rate: float, now: float) -> list[dict]:
+        # An update pipeline, so refilling and taking happen in one atomic write. A new bucket starts full.
+        tokens = {"$min": [burst, {"$add": [
+            {"$ifNull": [f"${FIELD_TOKENS}", burst]},
+            {"$multiply": [{"$max": [0, {"$subtract": [now, {"$ifNull": [f"${FIELD_UPDATED_AT}", now]}]}]}, rate]}
+        ]}]}
+        return [
+            {"$set": {FIELD_TOKENS: tokens, FIELD_UPDATED_AT: now, FIELD_EXPIRES_AT: datetime.fromtimestamp(now + burst / rate)}},
+            {"$set": {
+                FIELD_ALLOWED: {"$gte": [f"${FIELD_TOKENS}", 1]},
+                FIELD_TOKENS: {"$cond": [{"$gte": [f"${FIELD_TOKENS}", 1]}, {"$subtract": [f"${FIELD_TOKENS}", 1]}, f"${FIELD_TOKENS}"]}
+            }}
+        ]
+
+    @staticmethod
+    def audit_document(event: AuditEvent) -> dict:
+        document = {"_id": event.event_id, FIELD_TIME: datetime.fromtimestamp(event.time), FIELD_ACTOR: event.actor, FIELD_LOOKUP_ACTOR: event.actor.lower(), FIELD_ACTION: event.action, FIELD_DATA: event.data}
+        if event.target is not None:
+            document |= {FIELD_TARGET: event.target, FIELD_LOOKUP_TARGET: event.target.lower()}
+        return document
+
+    @staticmethod
+    def audit_event_from_document(document: dict) -> AuditEvent:
+        return AuditEvent(document["_id"], document[FIELD_TIME].timestamp(), document[FIELD_ACTOR], document[FIELD_ACTION], document.get(FIELD_TARGET), document.get(FIELD_DATA, {}))
+
+    @staticmethod
+    def audit_query(before: Optional[str], actor: Optional[str], target: Optional[str]) -> dict:
+        query: dict = {}
+        if actor is not None:
+            query[FIELD_LOOKUP_ACTOR] = actor.lower()
+        if target is not None:
+            query[FIELD_LOOKUP_TARGET] = target.lower()
+        if before is not None:
+            query["_id"] = {"$lt": before}
+        return query
+
+    @staticmethod
+    def revocation_updates(revocations: list[tuple[str, float, float]]) -> list[UpdateOne]:
+        # The TTL index removes entries once no cached session or claim from before them can still be used
+        return [UpdateOne({"_id": key}, {"$max": {FIELD_REVOKED_AT: revoked_at, FIELD_EXPIRES_AT: datetime.fromtimestamp(expires_at)}}, upsert=True) for key, revoked_at, expires_at in revocations]
+
+    @staticmethod
+    def user_profile_from_document(document: dict) -> UserProfile:
+        return UserProfile(document.get(FIELD_USERNAME, "???"), document.get(FIELD_USER_ID, "???"), authentication.Settings(document.get(FIELD_SETTINGS, 0)), document.get(FIELD_PERMISSION_GROUP), document.get(FIELD_UNFILLED))
+
+    @staticmethod
+    def auth_record_from_document(document: dict) -> AuthRecord:
+        return AuthRecord(document.get(FIELD_USERNAME), document.get(FIELD_LOGIN_DATA), document.get(FIELD_LOGIN_TOKEN), document.get(FIELD_LOGIN_TYPE, 0))
+
+    @staticmethod
+    def session_from_document(document: dict) -> authentication.Session:
+        session = document[FIELD_SESSIONS]
+        return authentication.Session(session.get(FIELD_SESSION_DATA), session.get(FIELD_CREATION_TIME), document.get(FIELD_USERNAME), session.get(FIELD_SESSION_NAME), authentication.Settings(document["account"].get(FIELD_SETTINGS, 0)), document["account"].get(FIELD_PERMISSION_GROUP), session.get(FIELD_LAST_USED) or session.get(FIELD_CREATION_TIME))
+
+    @staticmethod
+    def session_pipeline(match: dict, session_data: Optional[str] = None, created_after: float = 0, used_after: float = 0) -> list[dict]:
+        # Sessions are joined with their account server-side so resolving one costs a single round trip
+        pipeline: list[dict] = [{"$match": match}, {"$unwind": "$" + FIELD_SESSIONS}]
+        if session_data is not None:
+            pipeline.append({"$match": {
+                f"{FIELD_SESSIONS}.{FIELD_SESSION_DATA}": session_data,
+                f"{FIELD_SESSIONS}.{FIELD_CREATION_TIME}": {"$gt": datetime.fromtimestamp(created_after)},
+                "$expr": {"$gt": [{"$ifNull": [f"${FIELD_SESSIONS}.{FIELD_LAST_USED}", f"${FIELD_SESSIONS}.{FIELD_CREATION_TIME}"]}, datetime.fromtimestamp(used_after)]}
+            }})
+        pipeline += [
+            {"$lookup": {
+                "from": "users",
+                "localField": FIELD_LOOKUP_USERNAME,
+                "foreignField": FIELD_LOOKUP_USERNAME,
+                "pipeline": [{"$project": {"_id": 0, FIELD_SETTINGS: 1, FIELD_PERMISSION_GROUP: 1}}],
+                "as": "account"
+            }},
+            {"$unwind": "$account"}
+        ]
+        return pipeline
+
+    @staticmethod
+    def user_list_pipeline(viewer_permission_group: int, view_member_settings: bool, view_invited_members: bool, limit: int, after: Optional[str]) -> list[dict]:
+        match: dict = {}
+        if not view_invited_members:
+            match[FIELD_UNFILLED] = {"$ne": True}
+        if after is not None:
+            match[FIELD_LOOKUP_USERNAME] = {"$gt": after}
+        visible = {"$lte": ["$" + FIELD_PERMISSION_GROUP, viewer_permission_group]} if view_member_settings else False
+        return [
+            {"$match": match},
+            {"$sort": {FIELD_LOOKUP_USERNAME: ASCENDING}},
+            {"$limit": limit},
+            {"$project": {
+                "_id": 0,
+                FIELD_LOOKUP_USERNAME: 1,
+                FIELD_USERNAME: {"$ifNull": ["$" + FIELD_USERNAME, "???"]},
+                FIELD_USER_ID: {"$cond": [{"$eq": ["$" + FIELD_UNFILLED, True]}, "???", {"$ifNull": ["$" + FIELD_USER_ID, "???"]}]},
+                FIELD_SETTINGS: {"$cond": [visible, {"$ifNull": ["$" + FIELD_SETTINGS, 0]}, -1]},
+                FIELD_PERMISSION_GROUP: {"$cond": [visible, "$" + FIELD_PERMISSION_GROUP, -1]}
+            }}
+        ]
+
+    # The aggregations of the request paths. A $lookup the server does not push down into the plan
+    # does not show in it, its users side is the users_by_username equality of QUERY_SHAPES. The
+    # sweeper's orphaned_buckets_pipeline is left out, it reads every bucket by design.
+    @classmethod
+    def pipeline_shapes(cls) -> tuple[tuple[str, str, list[dict]], ...]:
+        return (
+            ("sessions", "get_session", cls.session_pipeline(cls.by_session_data(""), "")),
+            ("sessions", "list_sessions", cls.session_pipeline(cls.by_username(""))),
+            ("authkeys", "get_user_profile_by_credential_id", cls.credential_owner_pipeline(b"")),
+            ("users", "iter_user_list with invited members", cls.user_list_pipeline(0, True, True, USER_LIST_PAGE_SIZE + 1, None)),
+            ("users", "iter_user_list with invited members after", cls.user_list_pipeline(0, True, True, USER_LIST_PAGE_SIZE + 1, "")),
+            ("users", "iter_user_list", cls.user_list_pipeline(0, True, False, USER_LIST_PAGE_SIZE + 1, None)),
+            ("users", "iter_user_list after", cls.user_list_pipeline(0, True, False, USER_LIST_PAGE_SIZE + 1, ""))
+        )
+
+    @staticmethod
+    def user_list_entry_from_document(document: dict) -> UserListEntry:
+        return UserListEntry(document[FIELD_LOOKUP_USERNAME], document[FIELD_USERNAME], document[FIELD_USER_ID], document[FIELD_SETTINGS], document[FIELD_PERMISSION_GROUP])
+
+@traced_methods("db")
+class MongoDB(MongoSchema, Database):
     client: MongoClient
-    def __init__(self, uri: str, username: Optional[str] = None, password: Optional[str] = None, db: str = "main_db"):
+
+    def __init__(self, uri: str, username: Optional[str] = None, password: Optional[str] = None, db: str = "main_db", ensure_indexes: bool = True, read_preference: Optional[_ServerMode] = None):
         if username and password:
             uri = uri.format(username, password)
         self.client = self.connect(uri)
-        self.db = self.client[db]
-        self.users = self.db.users
-        self.sessions = self.db.sessions
-        self.authkeys = self.db.authkeys
+        self.use_database(self.client[db])
+        self.reader = self if read_preference is None else self.with_read_preference(read_preference)
+        if ensure_indexes:
+            self.ensure_indexes()
+
+    def read_only(self):
+        return self.reader
 
     @staticmethod
     def connect(uri: str) -> MongoClient:
@@ -123,156 +705,681 @@ class MongoDB(Database):
         client.admin.command('ping')
         return client
 
+    def ensure_indexes(self) -> None:
+        for collection, indexes in self.INDEXES.items():
+            self.db[collection].create_indexes(indexes)
+
+    # Returns the number of documents moved into buckets, a second run finds nothing to do
+    def migrate_legacy_documents(self) -> int:
+        moved = 0
+        for collection, names in self.LEGACY_INDEXES.items():
+            existing = self.db[collection].index_information()
+            for name in names:
+                if name in existing:
+                    self.db[collection].drop_index(name)
+        for collection, array, key in ((self.sessions, FIELD_SESSIONS, FIELD_SESSION_DATA), (self.authkeys, FIELD_AUTHKEYS, FIELD_CRED_ID)):
+            for document in collection.find({key: {"$exists": True}}).sort(FIELD_CREATION_TIME, ASCENDING):
+                username = document.get(FIELD_USERNAME, "")
+                entry = {field: value for field, value in document.items() if field not in ("_id", FIELD_USERNAME, FIELD_LOOKUP_USERNAME)}
+                collection.update_one({FIELD_LOOKUP_USERNAME: username.lower(), array: {"$exists": True}}, self.capped_push(username, array, entry), upsert=True)
+                collection.delete_one({"_id": document["_id"]})
+                moved += 1
+        self.sessions.update_many({FIELD_SESSIONS: {"$elemMatch": {FIELD_LAST_USED: {"$exists": False}}}}, self.last_used_backfill())
+        return moved
+
+    def verify_query_plans(self) -> dict[str, list[str]]:
+        plans: dict[str, list[str]] = {}
+        unindexed: list[str] = []
+        for collection, query, sort in self.QUERY_SHAPES:
+            cursor = self.db[collection].find(query).limit(MAX_SESSIONS + 1)
+            if sort:
+                cursor = cursor.sort(sort)
+            stages = plan_stages(cursor.explain())
+            shape = f"{collection}: {query!r} sort={sort!r}"
+            plans[shape] = stages
+            if scans_collection(stages):
+                unindexed.append(shape)
+        for collection, name, pipeline in self.pipeline_shapes():
+            stages = plan_stages(self.db.command("explain", {"aggregate": collection, "pipeline": pipeline, "cursor": {}}, verbosity="queryPlanner"))
+            shape = f"{collection}: {name}"
+            plans[shape] = stages
+            if scans_collection(stages):
+                unindexed.append(shape)
+        if unindexed:
+            raise QueryPlanError("Queries without a usable index: " + "; ".join(unindexed))
+        return plans
+
+    def lookup_usernames(self, query: dict) -> set[str]:
+        return {document[FIELD_LOOKUP_USERNAME] for document in self.users.find(query, self.LOOKUP_PROJECTION)}
+
     def create_user_slot(self, slot_settings, permission_group, temp_name):
-        user_id = str(uuid4())
-        self.users.insert_one({FIELD_USER_ID: user_id, FIELD_USERNAME: temp_name, FIELD_LOOKUP_USERNAME: temp_name.lower(), FIELD_UNFILLED: True, FIELD_SETTINGS: slot_settings, FIELD_PERMISSION_GROUP: permission_group})
-        return user_id
+        document = self.user_slot_document(slot_settings, permission_group, temp_name)
+        try:
+            self.users.insert_one(document)
+        except DuplicateKeyError:
+            # The unique index caught a concurrent slot or user with the same name
+            raise AlreadyExistsError()
+        return document[FIELD_USER_ID]
     
     def create_user(self, username, login_data, login_token, login_type, user_slot):
-        user_slot_data = self.users.find_one({FIELD_USER_SLOT: user_slot})
-        if not user_slot_data:
-            raise NotFoundError()
-        if not user_slot_data.get(FIELD_UNFILLED):
+        try:
+            result = self.users.update_one(*self.fill_user_slot(user_slot, username, login_data, login_token, login_type))
+        except DuplicateKeyError:
+            raise AlreadyExistsError()
+        if result.matched_count == 0:
+            if self.users.find_one(self.by_user_id(user_slot), {"_id": 1}) is None:
+                raise NotFoundError()
             raise UserSlotTakenError()
-        self.users.update_one({FIELD_USER_SLOT: user_slot}, {"$set":
-            {
-                FIELD_UNFILLED: False,
-                FIELD_USERNAME: username,
-                FIELD_LOGIN_DATA: login_data,
-                FIELD_LOGIN_TOKEN: login_token,
-                FIELD_LOGIN_TYPE: login_type,
-                FIELD_LOOKUP_USERNAME: username.lower()
-            }
-        })
 
     def get_login_data_by_username(self, username):
-        user_data = self.users.find_one({FIELD_LOOKUP_USERNAME: username.lower()})
-        if not user_data:
-            return None
-        if FIELD_LOGIN_DATA not in user_data:
+        record = self.get_auth_record(username)
+        if record is None or record.login_data is None or record.login_token is None:
             return None
-        if FIELD_LOGIN_TOKEN not in user_data:
+        return (record.login_data, record.login_token, record.login_type)
+
+    def get_auth_record(self, username):
+        document = self.users.find_one(self.by_username(username), self.AUTH_RECORD_PROJECTION)
+        if document is None:
             return None
-        login_data = user_data[FIELD_LOGIN_DATA]
-        login_token = user_data[FIELD_LOGIN_TOKEN]
-        login_type = user_data.get(FIELD_LOGIN_TYPE, 0)
-        assert isinstance(login_data, str)
-        assert isinstance(login_token, str)
-        return (login_data, login_token, login_type)
+        return self.auth_record_from_document(document)
 
     def has_username(self, username, *, except_user_id = None):
-        user = self.users.find_one({FIELD_LOOKUP_USERNAME: username.lower(), FIELD_USER_SLOT: {"$ne": except_user_id}})
-        return bool(user)
+        return self.users.find_one(self.other_than_slot(username, except_user_id), {"_id": 1}) is not None
     
     def get_username_by_session_data(self, session_data):
-        session = self.sessions.find_one({FIELD_SESSION_DATA: session_data})
-        if not session:
+        bucket = self.sessions.find_one(self.by_session_data(session_data), self.USERNAME_PROJECTION)
+        if not bucket:
             return None
-        if FIELD_USERNAME not in session:
-            return None
-        username = session[FIELD_USERNAME]
-        assert isinstance(username, str)
-        return username
+        return bucket.get(FIELD_USERNAME)
 
     def add_session(self, session_data, username, session_name):
-        if not self.has_username(username):
-            raise NotFoundError()
-        self.sessions.insert_one({
-            FIELD_SESSION_DATA: session_data,
-            FIELD_SESSION_NAME: session_name,
-            FIELD_LOOKUP_USERNAME: username.lower(),
-            FIELD_USERNAME: username,
-            FIELD_CREATION_TIME: datetime.now()
-        })
-        sessions = list(self.sessions.find({FIELD_LOOKUP_USERNAME: username.lower()}).sort(FIELD_CREATION_TIME, DESCENDING).limit(MAX_SESSIONS + 1))
-        if len(sessions) == MAX_SESSIONS + 1:
-            self.sessions.delete_many({"_id": {"$not": {"$in": [sess["_id"] for sess in sessions[:MAX_SESSIONS]]}}, FIELD_LOOKUP_USERNAME: username.lower()})
-    
+        bucket = self.sessions.find_one_and_update(self.by_username(username), self.capped_push(username, FIELD_SESSIONS, self.session_entry(session_data, session_name)), self.SESSION_DATA_PROJECTION, upsert=True, return_document=ReturnDocument.BEFORE)
+        return self.pushed_out_sessions(bucket)
+
     def list_sessions(self, username):
-        account = self.users.find_one({FIELD_LOOKUP_USERNAME: username.lower()})
-        return [authentication.Session(document.get(FIELD_SESSION_DATA), document.get(FIELD_CREATION_TIME), username, document.get(FIELD_SESSION_NAME), authentication.Settings(account.get(FIELD_SETTINGS)), account.get(FIELD_PERMISSION_GROUP)) for document in self.sessions.find({FIELD_LOOKUP_USERNAME: username.lower()})]
+        return [self.session_from_document(document) for document in self.sessions.aggregate(self.session_pipeline(self.by_username(username)))]
+
+    def get_session(self, session_data, created_after = 0, used_after = 0):
+        for document in self.sessions.aggregate(self.session_pipeline(self.by_session_data(session_data), session_data, created_after, used_after)):
+            return self.session_from_document(document)
+        return None
+
+    def touch_session(self, session_data, now):
+        self.sessions.update_one(self.by_session_data(session_data), self.touch_update(now))
 
-    def get_session(self, session_data):
-        session = self.sessions.find_one({FIELD_SESSION_DATA: session_data})
-        if not session:
-            return None
-        account = self.users.find_one({FIELD_LOOKUP_USERNAME: session.get(FIELD_LOOKUP_USERNAME)})
-        return authentication.Session(session.get(FIELD_SESSION_DATA), session.get(FIELD_CREATION_TIME), session.get(FIELD_USERNAME), session.get(FIELD_SESSION_NAME), authentication.Settings(account.get(FIELD_SETTINGS)), account.get(FIELD_PERMISSION_GROUP))
-    
     def delete_session(self, session_data):
-        self.sessions.delete_one({FIELD_SESSION_DATA: session_data})
-    
+        self.sessions.update_one(self.by_session_data(session_data), self.session_removal(session_data))
+
     def list_users(self):
-        return [
-            UserProfile(document.get(FIELD_USERNAME, "???"), document.get(FIELD_USER_ID, "???"), authentication.Settings(document.get(FIELD_SETTINGS, 0)), document.get(FIELD_PERMISSION_GROUP), document.get(FIELD_UNFILLED))
-            for document in self.users.find()
-        ]
+        return [self.user_profile_from_document(document) for document in self.users.find()]
     
+    def iter_user_list(self, viewer_permission_group, view_member_settings, view_invited_members, limit, after = None):
+        pipeline = self.user_list_pipeline(viewer_permission_group, view_member_settings, view_invited_members, limit, after)
+        for document in self.users.aggregate(pipeline):
+            yield self.user_list_entry_from_document(document)
+
     def get_correctly_cased_username(self, username):
-        document = self.users.find_one({FIELD_LOOKUP_USERNAME: username.lower()})
+        document = self.users.find_one(self.by_username(username), self.USERNAME_PROJECTION)
         if document is None:
             return None
         return document.get(FIELD_USERNAME)
     
     def remove_unfilled_user(self, username):
-        document = self.users.find_one_and_delete({FIELD_UNFILLED: True, FIELD_LOOKUP_USERNAME: username.lower()})
-        return document is not None
+        return self.users.find_one_and_delete(self.by_username(username, unfilled=True)) is not None
     
     def get_user_profile(self, username):
-        document = self.users.find_one({FIELD_LOOKUP_USERNAME: username.lower()})
+        document = self.users.find_one(self.by_username(username))
         if document is None:
             return None
-        return UserProfile(document.get(FIELD_USERNAME, "???"), document.get(FIELD_USER_ID, "???"), authentication.Settings(document.get(FIELD_SETTINGS, 0)), document.get(FIELD_PERMISSION_GROUP), document.get(FIELD_UNFILLED))
+        return self.user_profile_from_document(document)
     
     def set_permission_group(self, username, permission_group):
-        document = self.users.find_one_and_update({FIELD_LOOKUP_USERNAME: username.lower()}, {"$set": {FIELD_PERMISSION_GROUP: permission_group}})
-        return document is not None
+        return self.users.find_one_and_update(self.by_username(username), self.set_fields({FIELD_PERMISSION_GROUP: permission_group})) is not None
     
     def set_settings(self, username, settings):
-        document = self.users.find_one_and_update({FIELD_LOOKUP_USERNAME: username.lower()}, {"$set": {FIELD_SETTINGS: settings}})
-        return document is not None
+        return self.users.find_one_and_update(self.by_username(username), self.set_fields({FIELD_SETTINGS: settings})) is not None
     
     def disable_user(self, username):
         user_id = str(uuid4())
-        document = self.users.find_one_and_update({FIELD_LOOKUP_USERNAME: username.lower(), FIELD_UNFILLED: False}, {"$set": {FIELD_UNFILLED: True, FIELD_USER_SLOT: user_id}, "$unset": {FIELD_LOGIN_DATA: ""}})
-        if document is not None:
-            self.sessions.delete_many({FIELD_LOOKUP_USERNAME: username.lower()})
-            self.authkeys.delete_many({FIELD_LOOKUP_USERNAME: username.lower()})
-        return user_id if document is not None else None
-    
+        if self.users.find_one_and_update(*self.disable_update(username, user_id)) is None:
+            return None
+        self.sessions.delete_one(self.by_username(username))
+        self.authkeys.delete_one(self.by_username(username))
+        return user_id
+
+    def get_user_profiles(self, usernames):
+        return {document[FIELD_LOOKUP_USERNAME]: self.user_profile_from_document(document) for document in self.users.find(self.by_usernames(usernames))}
+
+    def create_user_slots(self, slots):
+        documents = [self.user_slot_document(slot_settings, permission_group, temp_name) for slot_settings, permission_group, temp_name in slots]
+        if not documents:
+            return []
+        taken = set()
+        try:
+            self.users.insert_many(documents, ordered=False)
+        except BulkWriteError as exc:
+            taken = self.duplicate_indexes(exc)
+        return [None if index in taken else document[FIELD_USER_ID] for index, document in enumerate(documents)]
+
+    def remove_unfilled_users(self, usernames):
+        found = self.lookup_usernames(self.by_usernames(usernames, unfilled=True))
+        if not found:
+            return set()
+        result = self.users.delete_many(self.by_usernames(found, unfilled=True))
+        if result.deleted_count == len(found):
+            return found
+        # Some slots were filled in the meantime, whatever is still there was not removed
+        return found - self.lookup_usernames(self.by_usernames(found))
+
+    def update_users(self, changes):
+        changes = {username.lower(): fields for username, fields in changes.items()}
+        if not changes:
+            return set()
+        result = self.users.bulk_write(self.user_updates(changes), ordered=False)
+        if result.matched_count == len(changes):
+            return set(changes)
+        return self.lookup_usernames(self.by_usernames(changes))
+
+    def disable_users(self, usernames):
+        slots = {username.lower(): str(uuid4()) for username in usernames}
+        if not slots:
+            return set()
+        self.users.bulk_write([UpdateOne(*self.disable_update(username, user_id)) for username, user_id in slots.items()], ordered=False)
+        # Only the users this call disabled carry one of the fresh slot ids
+        disabled = self.lookup_usernames(self.by_user_ids(slots.values()))
+        if disabled:
+            self.sessions.delete_many(self.by_usernames(disabled))
+            self.authkeys.delete_many(self.by_usernames(disabled))
+        return disabled
+
     def create_authkey(self, data, credential_id, username, session_name):
-        self.authkeys.insert_one({
-            FIELD_CRED_ID: credential_id,
-            FIELD_DATA: data,
-            FIELD_LOOKUP_USERNAME: username.lower(),
-            FIELD_USERNAME: username,
-            FIELD_CREATION_TIME: datetime.now(),
-            FIELD_SESSION_NAME: session_name
-        })
-        authkeys = list(self.authkeys.find({FIELD_LOOKUP_USERNAME: username.lower()}).sort(FIELD_CREATION_TIME, DESCENDING).limit(MAX_SESSIONS + 1))
-        if len(authkeys) == MAX_SESSIONS + 1:
-            self.authkeys.delete_many({"_id": {"$not": {"$in": [sess["_id"] for sess in authkeys[:MAX_SESSIONS]]}}, FIELD_LOOKUP_USERNAME: username.lower()})
-    
+        self.authkeys.update_one(self.by_username(username), self.capped_push(username, FIELD_AUTHKEYS, self.authkey_entry(data, credential_id, session_name)), upsert=True)
+
     def find_credential_by_id(self, credential_id):
-        document = self.authkeys.find_one({FIELD_CRED_ID: credential_id})
-        if not document:
-            return None
-        return document.get(FIELD_DATA)
-    
+        return self.credential_data(self.authkeys.find_one(self.by_credential_id(credential_id), self.CREDENTIAL_PROJECTION))
+
     def get_user_profile_by_credential_id(self, credential_id):
-        document = self.authkeys.find_one({FIELD_CRED_ID: credential_id})
-        if not document:
+        for document in self.authkeys.aggregate(self.credential_owner_pipeline(credential_id)):
+            return self.user_profile_from_document(document)
+        return None
+
+    def migrate_login_data(self, username, login_data, login_token, login_type):
+        self.users.update_one(self.by_username(username), self.login_data_update(login_data, login_token, login_type))
+
+    def get_generation(self, name):
+        return self.generation_from_document(self.generations.find_one(self.by_id(name)))
+
+    def increment_generation(self, name):
+        return self.generation_from_document(self.generations.find_one_and_update(self.by_id(name), self.GENERATION_INCREMENT, upsert=True, return_document=ReturnDocument.AFTER))
+
+    def add_revocations(self, revocations):
+        if revocations:
+            self.revocations.bulk_write(self.revocation_updates(revocations), ordered=False)
+
+    def list_revocations(self, now):
+        return {document["_id"]: document[FIELD_REVOKED_AT] for document in self.revocations.find(self.unexpired(now))}
+
+    def put_challenge(self, key, challenge, expires_at):
+        self.challenges.replace_one(self.by_id(key), self.challenge_document(challenge, expires_at), upsert=True)
+
+    def consume_challenge(self, key, now):
+        # The TTL monitor only runs about once a minute, so expiry is checked here as well
+        document = self.challenges.find_one_and_delete(self.unexpired(now, key))
+        if document is None:
             return None
-        username = document.get(FIELD_USERNAME)
-        if not username:
+        return document[FIELD_CHALLENGE]
+
+    # Array entries cannot expire through a TTL index, so the sweeper pulls them out of the buckets
+    def delete_expired_sessions(self, created_before, used_before):
+        self.sessions.update_many(*self.expired_sessions_update(created_before, used_before))
+
+    def delete_stale_user_slots(self, invited_before):
+        query = self.stale_user_slots_query(invited_before)
+        stale = self.lookup_usernames(query)
+        if stale:
+            self.users.delete_many({**query, **self.by_usernames(stale)})
+        return stale
+
+    def delete_orphaned_credentials(self):
+        for collection in (self.sessions, self.authkeys):
+            orphaned = [document["_id"] for document in collection.aggregate(self.orphaned_buckets_pipeline())]
+            if orphaned:
+                collection.delete_many(self.by_ids(orphaned))
+
+    def take_token(self, key, burst, rate, now):
+        try:
+            document = self.rate_limits.find_one_and_update(self.by_id(key), self.token_bucket_update(burst, rate, now), self.ALLOWED_PROJECTION, upsert=True, return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # Lost the race to create the bucket, it exists now
+            document = self.rate_limits.find_one_and_update(self.by_id(key), self.token_bucket_update(burst, rate, now), self.ALLOWED_PROJECTION, return_document=ReturnDocument.AFTER)
+        return document[FIELD_ALLOWED]
+
+    def insert_audit_events(self, events):
+        self.audit.insert_many([self.audit_document(event) for event in events], ordered=False)
+
+    def list_audit_events(self, limit, before = None, actor = None, target = None):
+        cursor = self.audit.find(self.audit_query(before, actor, target)).sort("_id", DESCENDING).limit(limit)
+        return [self.audit_event_from_document(document) for document in cursor]
+
+@traced_methods("db")
+class SQLiteDatabase(Database):
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT NOT NULL UNIQUE,
+            username TEXT NOT NULL,
+            _username TEXT NOT NULL UNIQUE,
+            unfilled INTEGER NOT NULL,
+            settings INTEGER NOT NULL DEFAULT 0,
+            permission_group INTEGER,
+            login_data TEXT,
+            login_token TEXT,
+            login_type INTEGER NOT NULL DEFAULT 0,
+            invited_at REAL
+        )""",
+        """CREATE TABLE IF NOT EXISTS sessions (
+            session_data TEXT PRIMARY KEY,
+            session_name TEXT,
+            _username TEXT NOT NULL,
+            username TEXT NOT NULL,
+            creation_time REAL NOT NULL,
+            last_used REAL
+        )""",
+        "CREATE INDEX IF NOT EXISTS sessions_by_user ON sessions (_username, creation_time)",
+        """CREATE TABLE IF NOT EXISTS authkeys (
+            id BLOB PRIMARY KEY,
+            data TEXT NOT NULL,
+            _username TEXT NOT NULL,
+            username TEXT NOT NULL,
+            creation_time REAL NOT NULL,
+            session_name TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS authkeys_by_user ON authkeys (_username, creation_time)",
+        "CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, generation INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS revocations (key TEXT PRIMARY KEY, revoked_at REAL NOT NULL, expires_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS challenges (key TEXT PRIMARY KEY, challenge BLOB NOT NULL, expires_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL, allowed INTEGER NOT NULL, expires_at REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS rate_limits_by_expiry ON rate_limits (expires_at)",
+        """CREATE TABLE IF NOT EXISTS audit_events (
+            event_id TEXT PRIMARY KEY,
+            time REAL NOT NULL,
+            actor TEXT NOT NULL,
+            _actor TEXT NOT NULL,
+            action TEXT NOT NULL,
+            target TEXT,
+            _target TEXT,
+            data TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS audit_events_by_actor ON audit_events (_actor, event_id)",
+        "CREATE INDEX IF NOT EXISTS audit_events_by_target ON audit_events (_target, event_id) WHERE _target IS NOT NULL"
+    )
+    # Columns added after the tables first shipped, with the statement filling them in for existing rows
+    ADDED_COLUMNS = (
+        ("sessions", "last_used REAL", "UPDATE sessions SET last_used = creation_time"),
+        ("users", "invited_at REAL", None)
+    )
+    SWEEP_INDEXES = (
+        "CREATE INDEX IF NOT EXISTS sessions_by_creation_time ON sessions (creation_time)",
+        "CREATE INDEX IF NOT EXISTS sessions_by_last_used ON sessions (last_used)",
+        "CREATE INDEX IF NOT EXISTS users_by_invited_at ON users (invited_at) WHERE invited_at IS NOT NULL"
+    )
+    USER_PROFILE_COLUMNS = "users.username, users.user_id, users.settings, users.permission_group, users.unfilled"
+
+    def __init__(self, path: str = "inconspicuous.db"):
+        if path == ":memory:":
+            # A named shared-cache database so every thread sees the same in-memory data
+            self.path = f"file:inconspicuous-{uuid4()}?mode=memory&cache=shared"
+            self.uri = True
+        else:
+            self.path = path
+            self.uri = False
+        self.local = threading.local()
+        # Kept open for the lifetime of the object so an in-memory database is not dropped
+        self.anchor = self.connect(self.path, self.uri)
+        self.anchor.execute("PRAGMA journal_mode = WAL")
+        with self.transaction(self.anchor) as connection:
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+            for table, column, backfill in self.ADDED_COLUMNS:
+                columns = {row[1] for row in connection.execute(f"PRAGMA table_info({table})")}
+                if column.split()[0] not in columns:
+                    connection.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+                    if backfill is not None:
+                        connection.execute(backfill)
+            for statement in self.SWEEP_INDEXES:
+                connection.execute(statement)
+
+    @staticmethod
+    def connect(path: str, uri: bool = False) -> sqlite3.Connection:
+        connection = sqlite3.connect(path, uri=uri, timeout=30, isolation_level=None, check_same_thread=False, cached_statements=256)
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA busy_timeout = 30000")
+        return connection
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.connect(self.path, self.uri)
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self, connection: Optional[sqlite3.Connection] = None) -> Iterator[sqlite3.Connection]:
+        connection = connection or self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def user_profile_from_row(row: tuple) -> UserProfile:
+        username, user_id, settings, permission_group, unfilled = row
+        return UserProfile(username, user_id, authentication.Settings(settings), permission_group, bool(unfilled))
+
+    def create_user_slot(self, slot_settings, permission_group, temp_name):
+        user_id = str(uuid4())
+        try:
+            self.connection.execute(
+                "INSERT INTO users (user_id, username, _username, unfilled, settings, permission_group, invited_at) VALUES (?, ?, ?, 1, ?, ?, ?)",
+                (user_id, temp_name, temp_name.lower(), slot_settings, permission_group, time.time())
+            )
+        except sqlite3.IntegrityError:
+            raise AlreadyExistsError()
+        return user_id
+
+    def create_user(self, username, login_data, login_token, login_type, user_slot):
+        try:
+            cursor = self.connection.execute(
+                "UPDATE users SET unfilled = 0, username = ?, login_data = ?, login_token = ?, login_type = ?, _username = ?, invited_at = NULL WHERE user_id = ? AND unfilled = 1",
+                (username, login_data, login_token, login_type, username.lower(), user_slot)
+            )
+        except sqlite3.IntegrityError:
+            raise AlreadyExistsError()
+        if cursor.rowcount == 0:
+            if self.connection.execute("SELECT 1 FROM users WHERE user_id = ?", (user_slot,)).fetchone() is None:
+                raise NotFoundError()
+            raise UserSlotTakenError()
+
+    def get_login_data_by_username(self, username):
+        row = self.connection.execute("SELECT login_data, login_token, login_type FROM users WHERE _username = ?", (username.lower(),)).fetchone()
+        if row is None:
             return None
-        return self.get_user_profile(username)
-    
+        login_data, login_token, login_type = row
+        if login_data is None or login_token is None:
+            return None
+        return (login_data, login_token, login_type)
+
+    def get_auth_record(self, username):
+        row = self.connection.execute("SELECT username, login_data, login_token, login_type FROM users WHERE _username = ?", (username.lower(),)).fetchone()
+        if row is None:
+            return None
+        return AuthRecord(*row)
+
+    def has_username(self, username, *, except_user_id = None):
+        row = self.connection.execute("SELECT 1 FROM users WHERE _username = ? AND user_id IS NOT ?", (username.lower(), except_user_id)).fetchone()
+        return row is not None
+
+    def get_username_by_session_data(self, session_data):
+        row = self.connection.execute("SELECT username FROM sessions WHERE session_data = ?", (session_data,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def add_session(self, session_data, username, session_name):
+        with self.transaction() as connection:
+            now = datetime.now().timestamp()
+            connection.execute(
+                "INSERT INTO sessions (session_data, session_name, _username, username, creation_time, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                (session_data, session_name, username.lower(), username, now, now)
+            )
+            rows = connection.execute(
+                "DELETE FROM sessions WHERE _username = ? AND session_data NOT IN (SELECT session_data FROM sessions WHERE _username = ? ORDER BY creation_time DESC LIMIT ?) RETURNING session_data",
+                (username.lower(), username.lower(), MAX_SESSIONS)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def list_sessions(self, username):
+        rows = self.connection.execute(
+            "SELECT sessions.session_data, sessions.creation_time, sessions.session_name, users.settings, users.permission_group, sessions.last_used FROM sessions JOIN users ON users._username = sessions._username WHERE sessions._username = ?",
+            (username.lower(),)
+        ).fetchall()
+        return [
+            authentication.Session(session_data, datetime.fromtimestamp(creation_time), username, session_name, authentication.Settings(settings), permission_group, datetime.fromtimestamp(last_used))
+            for session_data, creation_time, session_name, settings, permission_group, last_used in rows
+        ]
+
+    def get_session(self, session_data, created_after = 0, used_after = 0):
+        row = self.connection.execute(
+            "SELECT sessions.session_data, sessions.creation_time, sessions.username, sessions.session_name, users.settings, users.permission_group, sessions.last_used FROM sessions JOIN users ON users._username = sessions._username WHERE sessions.session_data = ? AND sessions.creation_time > ? AND sessions.last_used > ?",
+            (session_data, created_after, used_after)
+        ).fetchone()
+        if row is None:
+            return None
+        session_data, creation_time, username, session_name, settings, permission_group, last_used = row
+        return authentication.Session(session_data, datetime.fromtimestamp(creation_time), username, session_name, authentication.Settings(settings), permission_group, datetime.fromtimestamp(last_used))
+
+    def touch_session(self, session_data, now):
+        self.connection.execute("UPDATE sessions SET last_used = MAX(last_used, ?) WHERE session_data = ?", (now, session_data))
+
+    def delete_session(self, session_data):
+        self.connection.execute("DELETE FROM sessions WHERE session_data = ?", (session_data,))
+
+    def list_users(self):
+        rows = self.connection.execute(f"SELECT {self.USER_PROFILE_COLUMNS} FROM users").fetchall()
+        return [self.user_profile_from_row(row) for row in rows]
+
+    def iter_user_list(self, viewer_permission_group, view_member_settings, view_invited_members, limit, after = None):
+        cursor = self.connection.execute(
+            """SELECT _username, username,
+                CASE WHEN unfilled THEN '???' ELSE user_id END,
+                CASE WHEN :visible AND permission_group <= :viewer_permission_group THEN settings ELSE -1 END,
+                CASE WHEN :visible AND permission_group <= :viewer_permission_group THEN permission_group ELSE -1 END
+            FROM users WHERE (:invited OR unfilled = 0) AND _username > :after ORDER BY _username LIMIT :limit""",
+            {"visible": view_member_settings, "viewer_permission_group": viewer_permission_group, "invited": view_invited_members, "after": after or "", "limit": limit}
+        )
+        for row in cursor:
+            yield UserListEntry(*row)
+
+    def get_correctly_cased_username(self, username):
+        row = self.connection.execute("SELECT username FROM users WHERE _username = ?", (username.lower(),)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def remove_unfilled_user(self, username):
+        cursor = self.connection.execute("DELETE FROM users WHERE unfilled = 1 AND _username = ?", (username.lower(),))
+        return cursor.rowcount > 0
+
+    def get_user_profile(self, username):
+        row = self.connection.execute(f"SELECT {self.USER_PROFILE_COLUMNS} FROM users WHERE _username = ?", (username.lower(),)).fetchone()
+        if row is None:
+            return None
+        return self.user_profile_from_row(row)
+
+    def set_permission_group(self, username, permission_group):
+        cursor = self.connection.execute("UPDATE users SET permission_group = ? WHERE _username = ?", (permission_group, username.lower()))
+        return cursor.rowcount > 0
+
+    def set_settings(self, username, settings):
+        cursor = self.connection.execute("UPDATE users SET settings = ? WHERE _username = ?", (settings, username.lower()))
+        return cursor.rowcount > 0
+
+    def disable_user(self, username):
+        user_id = str(uuid4())
+        with self.transaction() as connection:
+            cursor = connection.execute("UPDATE users SET unfilled = 1, user_id = ?, login_data = NULL WHERE _username = ? AND unfilled = 0", (user_id, username.lower()))
+            if cursor.rowcount == 0:
+                return None
+            connection.execute("DELETE FROM sessions WHERE _username = ?", (username.lower(),))
+            connection.execute("DELETE FROM authkeys WHERE _username = ?", (username.lower(),))
+        return user_id
+
+    @staticmethod
+    def placeholders(values: list) -> str:
+        return ", ".join("?" * len(values))
+
+    def get_user_profiles(self, usernames):
+        lookups = list({username.lower() for username in usernames})
+        rows = self.connection.execute(f"SELECT users._username, {self.USER_PROFILE_COLUMNS} FROM users WHERE _username IN ({self.placeholders(lookups)})", lookups).fetchall()
+        return {row[0]: self.user_profile_from_row(row[1:]) for row in rows}
+
+    def create_user_slots(self, slots):
+        user_ids = []
+        with self.transaction() as connection:
+            for slot_settings, permission_group, temp_name in slots:
+                user_id = str(uuid4())
+                cursor = connection.execute(
+                    "INSERT INTO users (user_id, username, _username, unfilled, settings, permission_group, invited_at) VALUES (?, ?, ?, 1, ?, ?, ?) ON CONFLICT DO NOTHING",
+                    (user_id, temp_name, temp_name.lower(), slot_settings, permission_group, time.time())
+                )
+                user_ids.append(user_id if cursor.rowcount > 0 else None)
+        return user_ids
+
+    def remove_unfilled_users(self, usernames):
+        lookups = list({username.lower() for username in usernames})
+        rows = self.connection.execute(f"DELETE FROM users WHERE unfilled = 1 AND _username IN ({self.placeholders(lookups)}) RETURNING _username", lookups).fetchall()
+        return {row[0] for row in rows}
+
+    def update_users(self, changes):
+        updated = set()
+        with self.transaction() as connection:
+            for username, fields in changes.items():
+                cursor = connection.execute(
+                    "UPDATE users SET settings = COALESCE(?, settings), permission_group = COALESCE(?, permission_group) WHERE _username = ?",
+                    (fields.get(FIELD_SETTINGS), fields.get(FIELD_PERMISSION_GROUP), username.lower())
+                )
+                if cursor.rowcount > 0:
+                    updated.add(username.lower())
+        return updated
+
+    def disable_users(self, usernames):
+        disabled = []
+        with self.transaction() as connection:
+            for lookup in {username.lower() for username in usernames}:
+                cursor = connection.execute("UPDATE users SET unfilled = 1, user_id = ?, login_data = NULL WHERE _username = ? AND unfilled = 0", (str(uuid4()), lookup))
+                if cursor.rowcount > 0:
+                    disabled.append(lookup)
+            connection.execute(f"DELETE FROM sessions WHERE _username IN ({self.placeholders(disabled)})", disabled)
+            connection.execute(f"DELETE FROM authkeys WHERE _username IN ({self.placeholders(disabled)})", disabled)
+        return set(disabled)
+
+    def create_authkey(self, data, credential_id, username, session_name):
+        with self.transaction() as connection:
+            connection.execute(
+                "INSERT INTO authkeys (id, data, _username, username, creation_time, session_name) VALUES (?, ?, ?, ?, ?, ?)",
+                (credential_id, data, username.lower(), username, datetime.now().timestamp(), session_name)
+            )
+            connection.execute(
+                "DELETE FROM authkeys WHERE _username = ? AND id NOT IN (SELECT id FROM authkeys WHERE _username = ? ORDER BY creation_time DESC LIMIT ?)",
+                (username.lower(), username.lower(), MAX_SESSIONS)
+            )
+
+    def find_credential_by_id(self, credential_id):
+        row = self.connection.execute("SELECT data FROM authkeys WHERE id = ?", (credential_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_user_profile_by_credential_id(self, credential_id):
+        row = self.connection.execute(
+            f"SELECT {self.USER_PROFILE_COLUMNS} FROM authkeys JOIN users ON users._username = authkeys._username WHERE authkeys.id = ?",
+            (credential_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return self.user_profile_from_row(row)
+
     def migrate_login_data(self, username, login_data, login_token, login_type):
-        self.users.update_one({FIELD_LOOKUP_USERNAME: username.lower()}, {"$set":
-            {
-                FIELD_LOGIN_DATA: login_data,
-                FIELD_LOGIN_TOKEN: login_token,
-                FIELD_LOGIN_TYPE: login_type
-            }
-        })
\ No newline at end of file
+        self.connection.execute(
+            "UPDATE users SET login_data = ?, login_token = ?, login_type = ? WHERE _username = ?",
+            (login_data, login_token, login_type, username.lower())
+        )
+
+    def get_generation(self, name):
+        row = self.connection.execute("SELECT generation FROM generations WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def increment_generation(self, name):
+        row = self.connection.execute(
+            "INSERT INTO generations (name, generation) VALUES (?, 1) ON CONFLICT (name) DO UPDATE SET generation = generation + 1 RETURNING generation",
+            (name,)
+        ).fetchone()
+        return row[0]
+
+    def add_revocations(self, revocations):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM revocations WHERE expires_at <= ?", (time.time(),))
+            connection.executemany(
+                "INSERT INTO revocations (key, revoked_at, expires_at) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET revoked_at = max(revoked_at, excluded.revoked_at), expires_at = max(expires_at, excluded.expires_at)",
+                revocations
+            )
+
+    def list_revocations(self, now):
+        return dict(self.connection.execute("SELECT key, revoked_at FROM revocations WHERE expires_at > ?", (now,)).fetchall())
+
+    def put_challenge(self, key, challenge, expires_at):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM challenges WHERE expires_at <= ?", (time.time(),))
+            connection.execute(
+                "INSERT INTO challenges (key, challenge, expires_at) VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET challenge = excluded.challenge, expires_at = excluded.expires_at",
+                (key, challenge, expires_at)
+            )
+
+    def consume_challenge(self, key, now):
+        row = self.connection.execute("DELETE FROM challenges WHERE key = ? AND expires_at > ? RETURNING challenge", (key, now)).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def take_token(self, key, burst, rate, now):
+        # SET reads the old row in every expression, so allowed and tokens see the same refill
+        refilled = "MIN(:burst, tokens + MAX(:now - updated_at, 0) * :rate)"
+        with self.transaction() as connection:
+            # Buckets that would be full again carry no state
+            connection.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+            row = connection.execute(
+                f"""INSERT INTO rate_limits (key, tokens, updated_at, allowed, expires_at) VALUES (:key, :burst - 1, :now, 1, :expires_at)
+                ON CONFLICT (key) DO UPDATE SET allowed = {refilled} >= 1, tokens = {refilled} - ({refilled} >= 1), updated_at = :now, expires_at = :expires_at
+                RETURNING allowed""",
+                {"key": key, "burst": burst, "rate": rate, "now": now, "expires_at": now + burst / rate}
+            ).fetchone()
+        return bool(row[0])
+
+    def delete_expired_sessions(self, created_before, used_before):
+        self.connection.execute("DELETE FROM sessions WHERE creation_time < ? OR last_used < ?", (created_before, used_before))
+
+    def delete_stale_user_slots(self, invited_before):
+        rows = self.connection.execute("DELETE FROM users WHERE unfilled = 1 AND invited_at < ? RETURNING _username", (invited_before,)).fetchall()
+        return {row[0] for row in rows}
+
+    def delete_orphaned_credentials(self):
+        with self.transaction() as connection:
+            connection.execute("DELETE FROM sessions WHERE _username NOT IN (SELECT _username FROM users WHERE unfilled = 0)")
+            connection.execute("DELETE FROM authkeys WHERE _username NOT IN (SELECT _username FROM users WHERE unfilled = 0)")
+
+    def insert_audit_events(self, events):
+        with self.transaction() as connection:
+            connection.executemany(
+                "INSERT INTO audit_events (event_id, time, actor, _actor, action, target, _target, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+                [(event.event_id, event.time, event.actor, event.actor.lower(), event.action, event.target, event.target.lower() if event.target is not None else None, json.dumps(event.data)) for event in events]
+            )
+
+    def list_audit_events(self, limit, before = None, actor = None, target = None):
+        conditions = []
+        if actor is not None:
+            conditions.append("_actor = :actor")
+        if target is not None:
+            conditions.append("_target = :target")
+        if before is not None:
+            conditions.append("event_id < :before")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = self.connection.execute(
+            f"SELECT event_id, time, actor, action, target, data FROM audit_events {where} ORDER BY event_id DESC LIMIT :limit",
+            {"actor": actor.lower() if actor is not None else None, "target": target.lower() if target is not None else None, "before": before, "limit": limit}
+        ).fetchall()
+        return [AuditEvent(*row[:5], json.loads(row[5])) for row in rows]
@@ -48,3 +48,18 @@ class NeedsNotOldLogin(MyError):
 
 class NeedsOldLogin(MyError):
     identifier = "NEEDS_OLD_LOGIN"
+
+class QueryPlanError(MyError):
+    identifier = "QUERY_PLAN_COLLSCAN"
+
+class ServerBusy(MyError):
+    identifier = "SERVER_BUSY"
+
+class InvalidPageToken(MyError):
+    identifier = "INVALID_PAGE_TOKEN"
+
+class TooManyItems(MyError):
+    identifier = "TOO_MANY_ITEMS"
+
+class RateLimited(MyError):
+    identifier = "RATE_LIMITED"
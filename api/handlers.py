@@ -0,0 +1,216 @@
+from __future__ import annotations
+from json import dumps
+from time import perf_counter
+from typing import Optional, Self
+from dataclasses import dataclass
+from collections.abc import Callable
+from werkzeug.datastructures import MultiDict
+from . import exceptions, consts
+from .audit import AuditEvent
+from .database import UserProfile, UserListEntry, encode_page_token, decode_page_token
+from .authentication import (
+    Session,
+    SessionData,
+    Settings,
+    LoginType,
+    BulkResult,
+    UserSlotRequest,
+    UserChange,
+    SESSION_DATA_COOKIE_NAME,
+    add_csrf_token,
+    user_agent_cache,
+    login_limiter,
+    sweeper,
+    audit_log
+)
+from .exceptions import Unauthorized, NotFoundError
+from .consts import (
+    FIELD_SETTINGS,
+    FIELD_USER_SLOT,
+    FIELD_USERNAME,
+    FIELD_PERMISSION_GROUP,
+    FIELD_PASSWORD,
+    FIELD_SUCCESS,
+    FIELD_REASON,
+    FIELD_DATA,
+    FIELD_USER_ID,
+    FIELD_CSRF_TOKEN,
+    FIELD_HASHED_PASSWORD,
+    FIELD_NEXT,
+    FIELD_AFTER,
+    FIELD_LIMIT,
+    FIELD_USER_AGENT_CACHE,
+    FIELD_RATE_LIMITS,
+    FIELD_SWEEPER,
+    FIELD_AUDIT,
+    FIELD_ACTOR,
+    FIELD_TARGET,
+    FIELD_RESULTS,
+    COOKIE_AGE,
+    USER_LIST_PAGE_SIZE,
+    USER_LIST_MAX_PAGE_SIZE,
+    AUDIT_PAGE_SIZE,
+    AUDIT_MAX_PAGE_SIZE
+)
+
+# Everything about the endpoints that does not depend on the web framework: parsing the requests,
+# the permission checks and the response bodies. The Flask app in index.py and the Quart app in
+# asgi.py only add the I/O around these, so they answer every request the same way.
+
+def success(data: object = None) -> dict:
+    if data is None:
+        return {FIELD_SUCCESS: True}
+    return {FIELD_SUCCESS: True, FIELD_DATA: data}
+
+def failure(reason: str) -> dict:
+    return {FIELD_SUCCESS: False, FIELD_REASON: reason}
+
+def require(allowed: bool) -> None:
+    if not allowed:
+        raise Unauthorized()
+
+@dataclass(frozen=True)
+class LoginForm:
+    username: str
+    password: Optional[str] = None
+    hashed_password: Optional[str] = None
+    user_slot: Optional[str] = None
+    @classmethod
+    def from_dict(cls, form: dict) -> Self:
+        return cls(form[FIELD_USERNAME], form.get(FIELD_PASSWORD), form.get(FIELD_HASHED_PASSWORD), form.get(FIELD_USER_SLOT))
+
+def session_cookie(response, session_data: SessionData):
+    response.set_cookie(SESSION_DATA_COOKIE_NAME, session_data.data, max_age=COOKIE_AGE)
+    return add_csrf_token(response)
+
+def ensure_csrf_token(cookies: dict, response):
+    if FIELD_CSRF_TOKEN not in cookies:
+        return add_csrf_token(response)
+    return response
+
+def page_context(session: Optional[Session] = None) -> dict:
+    context = {"exceptions": exceptions, "Settings": Settings, "consts": consts, "LoginType": LoginType}
+    if session is not None:
+        context["session"] = session
+    return context
+
+# The single-user admin endpoints run the bulk operation with one item, so both share every check.
+# Each parser returns the items and what the audit log records for each of them.
+def slot_requests(items: list[dict]) -> tuple[list[UserSlotRequest], list[dict]]:
+    slots = [UserSlotRequest.from_dict(item) for item in items]
+    return slots, [{FIELD_SETTINGS: slot.settings.value, FIELD_PERMISSION_GROUP: slot.permission_group} for slot in slots]
+
+def target_requests(usernames: list[str]) -> tuple[list[str], list[dict]]:
+    return list(usernames), [{} for _ in usernames]
+
+def change_requests(changes: list[UserChange]) -> tuple[list[UserChange], list[dict]]:
+    return changes, [change.fields() for change in changes]
+
+def settings_change(form: dict) -> UserChange:
+    return UserChange(form[FIELD_USERNAME], settings=Settings(form[FIELD_SETTINGS]))
+
+def permission_group_change(form: dict) -> UserChange:
+    return UserChange(form[FIELD_USERNAME], permission_group=form[FIELD_PERMISSION_GROUP])
+
+# One event per item that went through, with what was requested for it
+def audit_events(actor: str, action: str, results: list[BulkResult], data: list[dict]) -> list[AuditEvent]:
+    return [AuditEvent.create(actor, action, result.username, item_data) for result, item_data in zip(results, data) if result.reason is None]
+
+def bulk_body(results: list[BulkResult]) -> dict:
+    return {FIELD_SUCCESS: True, FIELD_RESULTS: [result.to_dict() for result in results]}
+
+def single_body(results: list[BulkResult]) -> dict:
+    result = results[0]
+    if result.reason is not None:
+        return failure(result.reason)
+    return success(result.data)
+
+def page_args(args: MultiDict, default: int, maximum: int) -> tuple[int, Optional[str]]:
+    limit = min(max(args.get(FIELD_LIMIT, default, type=int), 1), maximum)
+    after = args.get(FIELD_AFTER)
+    return limit, decode_page_token(after) if after else None
+
+# The arguments for iter_user_list, which is asked for one entry more to learn whether a next page exists
+def user_list_query(session: Session, args: MultiDict) -> tuple[int, tuple]:
+    require(session.permissions.view_members)
+    limit, after = page_args(args, USER_LIST_PAGE_SIZE, USER_LIST_MAX_PAGE_SIZE)
+    return limit, (session.permission_group, session.permissions.view_member_settings, session.permissions.view_invited_members, limit + 1, after)
+
+# Writes the user list as it is read, the sync and async streams feed it one entry at a time
+class UserListWriter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.count = 0
+        self.next_token: Optional[str] = None
+        self.last_entry: Optional[UserListEntry] = None
+
+    def head(self) -> str:
+        return f'{{"{FIELD_SUCCESS}": true, "{FIELD_DATA}": ['
+
+    # None once the page is full, the entry only proves that there is a next page
+    def row(self, entry: UserListEntry) -> Optional[str]:
+        if self.count == self.limit:
+            assert self.last_entry is not None
+            self.next_token = encode_page_token(self.last_entry.lookup_username)
+            return None
+        row = dumps({
+            FIELD_USERNAME: entry.username,
+            FIELD_SETTINGS: entry.settings,
+            FIELD_PERMISSION_GROUP: entry.permission_group,
+            FIELD_USER_ID: entry.user_id
+        })
+        self.last_entry = entry
+        self.count += 1
+        return row if self.count == 1 else ", " + row
+
+    def tail(self) -> str:
+        return f'], "{FIELD_NEXT}": {dumps(self.next_token)}}}'
+
+def user_id_body(session: Session, user_profile: UserProfile) -> dict:
+    if user_profile.unfilled and not session.permissions.retrieve_invitation:
+        raise Unauthorized()
+    if user_profile.unfilled and (not session.permissions.outranks(user_profile.permission_group) or not session.permissions.grants(user_profile.settings.value)):
+        raise Unauthorized()
+    return success(user_profile.user_id)
+
+def user_body(session: Session, user_profile: UserProfile) -> dict:
+    if user_profile.unfilled and not session.permissions.view_invited_members:
+        raise NotFoundError()
+    (settings_value,), (permission_group,) = session.permissions.visible_fields([user_profile.permission_group], [user_profile.settings.value])
+    return success({
+        FIELD_USERNAME: user_profile.username,
+        FIELD_SETTINGS: settings_value,
+        FIELD_PERMISSION_GROUP: permission_group,
+        FIELD_USER_ID: user_profile.user_id if not user_profile.unfilled else "???"
+    })
+
+def audit_log_query(session: Session, args: MultiDict) -> tuple[int, tuple]:
+    require(session.permissions.sys_admin)
+    limit, before = page_args(args, AUDIT_PAGE_SIZE, AUDIT_MAX_PAGE_SIZE)
+    return limit, (limit + 1, before, args.get(FIELD_ACTOR), args.get(FIELD_TARGET))
+
+def audit_log_body(events: list[AuditEvent], limit: int) -> dict:
+    next_token = encode_page_token(events[limit - 1].event_id) if len(events) > limit else None
+    return {FIELD_SUCCESS: True, FIELD_DATA: [event.to_dict() for event in events[:limit]], FIELD_NEXT: next_token}
+
+def stats_body(session: Session) -> dict:
+    require(session.permissions.sys_admin)
+    return success({
+        FIELD_USER_AGENT_CACHE: user_agent_cache.stats(),
+        FIELD_RATE_LIMITS: login_limiter.stats(),
+        FIELD_SWEEPER: sweeper.stats(),
+        FIELD_AUDIT: audit_log.stats()
+    })
+
+def webauthn_options_body(options) -> str:
+    from webauthn import options_to_json
+    # options_to_json already produces the JSON text, so it is spliced in instead of parsed and re-encoded
+    return f'{{"{FIELD_SUCCESS}": true, "{FIELD_DATA}": {options_to_json(options)}}}'
+
+def timed(steps: tuple[tuple[str, Callable[[], object]], ...]) -> dict[str, float]:
+    timings = {}
+    for name, step in steps:
+        start = perf_counter()
+        step()
+        timings[name] = round((perf_counter() - start) * 1000, 3)
+    return timings
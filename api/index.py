@@ -1,39 +1,37 @@
-from os import environ, getenv
-from json import loads
-from traceback import format_exc
-from secrets import token_urlsafe
+from os import getenv
+from threading import Thread
+from typing import cast, TYPE_CHECKING
+from collections.abc import Iterator, Callable
 from flask import (
     Flask,
     request,
     redirect,
     render_template,
     make_response,
-    Request,
     jsonify,
     url_for,
-    send_from_directory,
+    stream_with_context,
+    after_this_request,
+    abort,
     Response
 )
-from user_agents import parse # type: ignore
-from webauthn import options_to_json
-from webauthn.helpers import parse_registration_credential_json, parse_authentication_credential_json
-from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
-from .database import MongoDB
+from .compression import compress_response
+from .lazy import Lazy, import_modules
+from .tracing import TRACING, TracedTemplate, start_trace, finish_trace
+from .assets import AssetRegistry, SCRIPT_TEMPLATES, JAVASCRIPT, add_static_assets
+from .database import Database, UserListEntry
+from .backends import create_database
+from .audit import AuditEvent
 from .authentication import login as auth_login
 from .authentication import old_login as old_auth_login
 from .authentication import sign_up as auth_sign_up
 from .authentication import logout as auth_logout
-from .authentication import create_user_slot as auth_create_user_slot
-from .authentication import disable_user as auth_disable_user
+from .authentication import bulk_edit_users as auth_bulk_edit_users
 from .authentication import (
     extract_session,
-    extract_session_or_empty,
-    SESSION_DATA_COOKIE_NAME,
-    Settings,
-    username_constraints,
-    remove_unfilled_user,
-    set_permission_group,
-    set_settings,
+    extract_claimed_session,
+    set_session_claims,
+    Session,
     add_csrf_token,
     verify_csrf_token,
     get_user_profile,
@@ -44,284 +42,294 @@ from .authentication import (
     access_login_type,
     rsa_key_from_data,
     decrypt_rsa,
-    LoginType
+    session_name,
+    audit_log,
+    check_login_rate,
+    BulkResult,
+    UserChange,
+    bulk_create_user_slots,
+    bulk_remove_unfilled_users,
+    bulk_disable_users,
+    DEFERRED_MODULES
 )
-from .exceptions import (
-    MyError,
-    Unauthorized,
-    NotFoundError
-)
-from . import exceptions, consts
-from .consts import (
-    FIELD_SETTINGS,
-    FIELD_USER_SLOT,
-    FIELD_USERNAME,
-    FIELD_PERMISSION_GROUP,
-    FIELD_PASSWORD,
-    FIELD_SUCCESS,
-    FIELD_REASON,
-    FIELD_DATA,
-    FIELD_USER_ID,
-    FIELD_CSRF_TOKEN,
-    FIELD_HASHED_PASSWORD,
-    COOKIE_AGE
+from .handlers import (
+    success,
+    failure,
+    require,
+    LoginForm,
+    session_cookie,
+    ensure_csrf_token,
+    page_context,
+    slot_requests,
+    target_requests,
+    change_requests,
+    settings_change,
+    permission_group_change,
+    audit_events,
+    bulk_body,
+    single_body,
+    user_list_query,
+    UserListWriter,
+    user_id_body,
+    user_body,
+    audit_log_query,
+    audit_log_body,
+    stats_body,
+    webauthn_options_body,
+    timed
 )
+from .exceptions import MyError, NoSession
+from .permissions import Permissions
+from .consts import FIELD_USERNAME, FIELD_USERS
 
 
-MONGO_DB_CONNECTION_URI = environ["MONGO_DB_CONNECTION_URI"]
-MONGO_DB_PASSWORD = environ["MONGO_DB_PASSWORD"]
-MONGO_DB_USERNAME = environ["MONGO_DB_USERNAME"]
 RSA_KEY = str(getenv("RSA_KEY")).encode()
 
-rsa_key = rsa_key_from_data(RSA_KEY)
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
 
-db = MongoDB(MONGO_DB_CONNECTION_URI, MONGO_DB_USERNAME, MONGO_DB_PASSWORD)
+# Neither is built at import time, a cold start only pays for them once a request needs them
+rsa_key: "Lazy[RSAPrivateKey]" = Lazy(lambda: rsa_key_from_data(RSA_KEY))
+lazy_db = Lazy(create_database)
+db = cast(Database, lazy_db)
 
 app = Flask(__name__, template_folder="templates")
 
-def session_name(__request: Request) -> str:
-    parsed_user_agent = parse(__request.user_agent.string)
-    browser = parsed_user_agent.browser.family
-    os = parsed_user_agent.os.family
-    return f"{browser} on {os}"
+def build_assets() -> AssetRegistry:
+    registry = AssetRegistry()
+    add_static_assets(registry)
+    # The scripts only need url_for, so they render the same outside of the request that asked for them
+    with app.test_request_context():
+        for name in SCRIPT_TEMPLATES:
+            registry.add(name, render_template(name, **page_context()), JAVASCRIPT)
+    return registry
+
+# Read and rendered by the first page or asset request
+assets = cast(AssetRegistry, Lazy(build_assets))
+
+def extract_read_session() -> Session:
+    session, claims = extract_claimed_session(db, request)
+    if claims is not None:
+        after_this_request(lambda response: set_session_claims(response, claims))
+    return session
+
+def extract_read_session_or_empty() -> Session:
+    try:
+        return extract_read_session()
+    except NoSession:
+        return Session.create_empty_session()
+
+@app.after_request
+def compress(response: Response) -> Response:
+    return compress_response(response, request.accept_encodings)
+
+if TRACING:
+    app.jinja_env.template_class = TracedTemplate
+
+    @app.before_request
+    def begin_trace():
+        start_trace()
+
+    @app.after_request
+    def end_trace(response: Response) -> Response:
+        return finish_trace(response, request.method, request.path)
+
+def webauthn_options_response(options) -> Response:
+    return Response(webauthn_options_body(options), mimetype="application/json")
 
 @app.get("/")
 def home():
-    session = extract_session_or_empty(db, request)
-    response = make_response(render_template("home.html", exceptions=exceptions, session=session, Settings=Settings, consts=consts, LoginType=LoginType))
-    if FIELD_CSRF_TOKEN not in request.cookies:
-        return add_csrf_token(response)
-    return response
+    session = extract_read_session_or_empty()
+    response = make_response(render_template("home.html", **page_context(session), assets=assets))
+    return ensure_csrf_token(request.cookies, response)
 
 @app.get("/control_panel/")
 def control_panel():
-    session = extract_session_or_empty(db, request)
+    session = extract_read_session_or_empty()
     if not session:
         return redirect(url_for("home"))
-    response = make_response(render_template("controlPanel.html", exceptions=exceptions, session=session, Settings=Settings, consts=consts))
-    if FIELD_CSRF_TOKEN not in request.cookies:
-        return add_csrf_token(response)
-    return response
+    response = make_response(render_template("controlPanel.html", **page_context(session), assets=assets))
+    return ensure_csrf_token(request.cookies, response)
 
 @app.post("/login/")
 def login():
-    login_data = request.json
-    username = login_data[FIELD_USERNAME]
-    password = decrypt_rsa(login_data[FIELD_PASSWORD], rsa_key)
+    form = LoginForm.from_dict(request.json)
     try:
-        session_data = auth_login(db, username, password, session_name(request))
+        check_login_rate(db, request, form.username)
+        password = decrypt_rsa(form.password, rsa_key.get())
+        session_data = auth_login(db, form.username, password, session_name(request))
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    response = jsonify({FIELD_SUCCESS: True})
-    response.set_cookie(SESSION_DATA_COOKIE_NAME, session_data.data, max_age=COOKIE_AGE)
-    return add_csrf_token(response)
+        return jsonify(failure(exc.identifier))
+    return session_cookie(jsonify(success()), session_data)
 
 @app.post("/old_login/")
 def old_login():
-    login_data = request.json
-    username = login_data[FIELD_USERNAME]
-    password = login_data[FIELD_PASSWORD]
-    extra_password = decrypt_rsa(login_data[FIELD_HASHED_PASSWORD], rsa_key)
+    form = LoginForm.from_dict(request.json)
     try:
-        session_data = old_auth_login(db, username, password, session_name(request), extra_password)
+        check_login_rate(db, request, form.username)
+        extra_password = decrypt_rsa(form.hashed_password, rsa_key.get())
+        session_data = old_auth_login(db, form.username, form.password, session_name(request), extra_password)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    response = jsonify({FIELD_SUCCESS: True})
-    response.set_cookie(SESSION_DATA_COOKIE_NAME, session_data.data, max_age=COOKIE_AGE)
-    return add_csrf_token(response)
+        return jsonify(failure(exc.identifier))
+    return session_cookie(jsonify(success()), session_data)
 
 @app.post("/login/login_type/")
 def get_login_type():
-    login_data = request.json
-    username = login_data[FIELD_USERNAME]
+    form = LoginForm.from_dict(request.json)
     try:
-        login_type = access_login_type(db, username)
+        check_login_rate(db, request, form.username)
+        login_type = access_login_type(db.read_only(), form.username)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    response = jsonify({FIELD_SUCCESS: True, FIELD_DATA: login_type.value})
-    return add_csrf_token(response)
+        return jsonify(failure(exc.identifier))
+    return add_csrf_token(jsonify(success(login_type.value)))
 
 @app.get("/register/")
 def registration():
-    return render_template("register.html", exceptions=exceptions, consts=consts)
+    return render_template("register.html", **page_context(), assets=assets)
 
 @app.post("/register/")
 def register():
-    login_data = request.json
-    username = login_data[FIELD_USERNAME]
-    password = login_data[FIELD_PASSWORD]
-    user_slot = login_data[FIELD_USER_SLOT]
+    form = LoginForm.from_dict(request.json)
     try:
-        session_data = auth_sign_up(db, username, password, session_name(request), user_slot)
+        session_data = auth_sign_up(db, form.username, form.password, session_name(request), form.user_slot)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    response = jsonify({FIELD_SUCCESS: True})
-    response.set_cookie(SESSION_DATA_COOKIE_NAME, session_data.data, max_age=COOKIE_AGE)
-    return add_csrf_token(response)
+        return jsonify(failure(exc.identifier))
+    return session_cookie(jsonify(success()), session_data)
 
 @app.post("/logout/")
 def logout():
     try:
         verify_csrf_token(request)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return auth_logout(db, jsonify({FIELD_SUCCESS: True}), request)
+        return jsonify(failure(exc.identifier))
+    return auth_logout(db, jsonify(success()), request)
 
-@app.post("/add_user/")
-def add_user():
-    form_data = request.json
-    username = form_data[FIELD_USERNAME]
-    permission_group = form_data[FIELD_PERMISSION_GROUP]
-    settings = Settings(form_data[FIELD_SETTINGS])
+def admin_action(action: str, run: Callable[[Database, Permissions, list], list[BulkResult]], items: list, data: list[dict], respond: Callable[[list[BulkResult]], dict]) -> Response:
     try:
         verify_csrf_token(request)
         session = extract_session(db, request)
-        if Settings._CREATE_MEMBERS not in session.settings:
-            raise Unauthorized()
-        if settings not in session.settings:
-            raise Unauthorized()
-        if permission_group >= session.permission_group:
-            raise Unauthorized()
-        if username.startswith("TEST_USERNAME_USING_THIS_NAME_WILL_NOT_CREATE_A_USER"):
-            user_slot = "NO_USER_SLOT_GENERATED"
-        else:
-            username_constraints(username)
-            user_slot = auth_create_user_slot(db, settings, permission_group, username)
+        results = run(db, session.permissions, items)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True, FIELD_DATA: user_slot})
+        return jsonify(failure(exc.identifier))
+    for event in audit_events(session.username, action, results, data):
+        audit_log.record(db, event)
+    return jsonify(respond(results))
+
+@app.post("/add_user/")
+def add_user():
+    return admin_action("add_user", bulk_create_user_slots, *slot_requests([request.json]), single_body)
+
+def stream_user_list(entries: Iterator[UserListEntry], limit: int) -> Iterator[str]:
+    writer = UserListWriter(limit)
+    yield writer.head()
+    for entry in entries:
+        row = writer.row(entry)
+        if row is None:
+            break
+        yield row
+    yield writer.tail()
 
 @app.get("/user_list/")
 def get_user_list():
     try:
-        session = extract_session(db, request)
-        if Settings.VIEW_MEMBERS not in session.settings:
-            raise Unauthorized()
-        view_member_settings = Settings._VIEW_MEMBER_SETTINGS in session.settings
-        view_invited_members = Settings._VIEW_INVITED_MEMBERS in session.settings
+        session = extract_read_session()
+        limit, query = user_list_query(session, request.args)
+        entries = db.read_only().iter_user_list(*query)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    users = [
-        {
-            FIELD_USERNAME: user.username,
-            FIELD_SETTINGS: user.settings.value if view_member_settings and user.permission_group <= session.permission_group else -1,
-            FIELD_PERMISSION_GROUP: user.permission_group if view_member_settings and user.permission_group <= session.permission_group else -1,
-            FIELD_USER_ID: user.user_id if not user.unfilled else "???"
-        }
-        for user in db.list_users()
-        if not user.unfilled or view_invited_members
-    ]
-    return jsonify({FIELD_SUCCESS: True, FIELD_DATA: users})
+        return jsonify(failure(exc.identifier))
+    return Response(stream_with_context(stream_user_list(entries, limit)), mimetype="application/json")
 
 @app.post("/remove_user/")
 def remove_user():
-    form_data = request.json
-    username = form_data[FIELD_USERNAME]
-    try:
-        verify_csrf_token(request)
-        session = extract_session(db, request)
-        if Settings._UNINVITE_MEMBERS not in session.settings:
-            raise Unauthorized()
-        remove_unfilled_user(db, username)
-    except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True})
+    return admin_action("remove_user", bulk_remove_unfilled_users, *target_requests([request.json[FIELD_USERNAME]]), single_body)
 
 @app.post("/deactivate_user/")
 def deactivate_user():
-    form_data = request.json
-    username = form_data[FIELD_USERNAME]
-    try:
-        verify_csrf_token(request)
-        session = extract_session(db, request)
-        if Settings._DISABLE_MEMBERS not in session.settings:
-            raise Unauthorized()
-        user_profile = get_user_profile(db,username)
-        if user_profile.permission_group >= session.permission_group:
-            raise Unauthorized()
-        user_slot = auth_disable_user(db, username)
-    except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True})
+    return admin_action("deactivate_user", bulk_disable_users, *target_requests([request.json[FIELD_USERNAME]]), single_body)
 
 @app.get("/get_user_id/<username>/")
 def get_user_id(username):
     try:
-        session = extract_session(db, request)
-        if Settings.VIEW_MEMBERS not in session.settings:
-            raise Unauthorized()
-        user_profile = get_user_profile(db,username)
-        if user_profile.unfilled and Settings._RETRIEVE_INVITATION not in session.settings:
-            raise Unauthorized()
-        if user_profile.unfilled and (user_profile.permission_group >= session.permission_group or user_profile.settings not in session.settings):
-            raise Unauthorized()
-        user_id = user_profile.user_id
+        session = extract_read_session()
+        require(session.permissions.view_members)
+        body = user_id_body(session, get_user_profile(db.read_only(), username))
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True, FIELD_DATA: user_id})
+        return jsonify(failure(exc.identifier))
+    return jsonify(body)
 
 @app.post("/edit_user_permission_group/")
 def edit_user_permission_group():
-    form_data = request.json
-    username = form_data[FIELD_USERNAME]
-    new_permission_group = form_data[FIELD_PERMISSION_GROUP]
-    try:
-        verify_csrf_token(request)
-        session = extract_session(db, request)
-        if Settings._EDIT_MEMBER_SETTINGS not in session.settings:
-            raise Unauthorized()
-        user_profile = get_user_profile(db,username)
-        if user_profile.permission_group >= session.permission_group:
-            raise Unauthorized()
-        if new_permission_group >= session.permission_group:
-            raise Unauthorized()
-        set_permission_group(db, username, new_permission_group)
-    except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True})
+    return admin_action("edit_user_permission_group", auth_bulk_edit_users, *change_requests([permission_group_change(request.json)]), single_body)
 
 @app.post("/edit_user_settings/")
 def edit_user_settings():
-    form_data = request.json
-    username = form_data[FIELD_USERNAME]
-    new_settings = form_data[FIELD_SETTINGS]
-    try:
-        verify_csrf_token(request)
-        session = extract_session(db, request)
-        if Settings._EDIT_MEMBER_SETTINGS not in session.settings:
-            raise Unauthorized()
-        user_profile = get_user_profile(db,username)
-        if user_profile.permission_group >= session.permission_group:
-            raise Unauthorized()
-        set_settings(db, username, Settings(new_settings))
-    except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True})
+    return admin_action("edit_user_settings", auth_bulk_edit_users, *change_requests([settings_change(request.json)]), single_body)
 
 @app.get("/get_user/<username>/")
 def get_user(username):
     try:
-        session = extract_session(db, request)
-        if Settings.VIEW_MEMBERS not in session.settings:
-            raise Unauthorized()
-        user_profile = get_user_profile(db,username)
-        if user_profile.unfilled and Settings._VIEW_INVITED_MEMBERS not in session.settings:
-            raise NotFoundError()
-        if Settings._VIEW_MEMBER_SETTINGS not in session.settings or user_profile.permission_group > session.permission_group:
-            permission_group = -1
-            settings_value = -1
-        else:
-            permission_group = user_profile.permission_group
-            settings_value = user_profile.settings.value
-        user_id = user_profile.user_id if not user_profile.unfilled else "???"
+        session = extract_read_session()
+        require(session.permissions.view_members)
+        body = user_body(session, get_user_profile(db.read_only(), username))
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True, FIELD_DATA: {
-        FIELD_USERNAME: user_profile.username,
-        FIELD_SETTINGS: settings_value,
-        FIELD_PERMISSION_GROUP: permission_group,
-        FIELD_USER_ID: user_id
-    }})
+        return jsonify(failure(exc.identifier))
+    return jsonify(body)
+
+@app.post("/bulk/add_users/")
+def bulk_add_users():
+    return admin_action("add_user", bulk_create_user_slots, *slot_requests(request.json[FIELD_USERS]), bulk_body)
+
+@app.post("/bulk/remove_users/")
+def bulk_remove_users():
+    return admin_action("remove_user", bulk_remove_unfilled_users, *target_requests(request.json[FIELD_USERS]), bulk_body)
+
+@app.post("/bulk/deactivate_users/")
+def bulk_deactivate_users():
+    return admin_action("deactivate_user", bulk_disable_users, *target_requests(request.json[FIELD_USERS]), bulk_body)
+
+# Covers both /edit_user_settings/ and /edit_user_permission_group/, an item may carry either or both
+@app.post("/bulk/edit_users/")
+def bulk_edit_users():
+    return admin_action("edit_user", auth_bulk_edit_users, *change_requests([UserChange.from_dict(item) for item in request.json[FIELD_USERS]]), bulk_body)
+
+@app.get("/audit_log/")
+def get_audit_log():
+    try:
+        session = extract_read_session()
+        limit, query = audit_log_query(session, request.args)
+        events = db.read_only().list_audit_events(*query)
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return jsonify(audit_log_body(events, limit))
+
+@app.get("/stats/")
+def get_stats():
+    try:
+        body = stats_body(extract_session(db, request))
+    except MyError as exc:
+        return jsonify(failure(exc.identifier))
+    return jsonify(body)
+
+def warm() -> dict[str, float]:
+    return timed((
+        ("modules", lambda: import_modules(DEFERRED_MODULES)),
+        ("rsa_key", rsa_key.get),
+        ("database", lazy_db.get),
+        ("assets", lambda: assets.precompress())
+    ))
+
+# Meant for a deploy hook or scheduled ping, warming an already warm instance is a no-op
+@app.get("/warm/")
+def warm_instance():
+    return jsonify(success(warm()))
+
+@app.get("/assets/<path:path>")
+def get_asset(path):
+    asset = assets.find(path)
+    if asset is None:
+        abort(404)
+    body, headers = asset.select(request.accept_encodings)
+    return Response(body, content_type=asset.content_type, headers=headers)
 
 @app.get("/manifest/")
 def get_manifest():
@@ -336,13 +344,14 @@ def access_webauth_creator():
     try:
         session = extract_session(db, request)
         user_profile = session.get_user_profile(db)
-        credentials = access_creation_credentials(user_profile, request)
+        credentials = access_creation_credentials(db, user_profile, request)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True, FIELD_DATA: loads(options_to_json(credentials))})
+        return jsonify(failure(exc.identifier))
+    return webauthn_options_response(credentials)
 
 @app.post("/webauth/create_credentials/")
 def create_webauth():
+    from webauthn.helpers import parse_registration_credential_json
     form_data = request.json
     try:
         session = extract_session(db, request)
@@ -350,27 +359,32 @@ def create_webauth():
         credential = parse_registration_credential_json(form_data)
         verify_and_save_credential(db, user_profile, session, request, credential)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True})
+        return jsonify(failure(exc.identifier))
+    audit_log.record(db, AuditEvent.create(session.username, "create_credentials", session.username))
+    return jsonify(success())
 
 @app.get("/webauth/login_credentials/")
 def access_webauth_login():
     try:
         session = extract_session(db, request)
         user_profile = session.get_user_profile(db)
-        credentials = access_login_credentials(request)
+        credentials = access_login_credentials(db, request)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    return jsonify({FIELD_SUCCESS: True, FIELD_DATA: loads(options_to_json(credentials))})
+        return jsonify(failure(exc.identifier))
+    return webauthn_options_response(credentials)
 
 @app.post("/webauth/login/")
 def login_via_passkey():
+    from webauthn.helpers import parse_registration_credential_json
     form_data = request.json
     try:
+        check_login_rate(db, request)
         credential = parse_registration_credential_json(form_data)
         session_data = login_by_credential(db, credential, session_name(request), request)
     except MyError as exc:
-        return jsonify({FIELD_SUCCESS: False, FIELD_REASON: exc.identifier})
-    response = jsonify({FIELD_SUCCESS: True})
-    response.set_cookie(SESSION_DATA_COOKIE_NAME, session_data.data, max_age=COOKIE_AGE)
-    return add_csrf_token(response)
\ No newline at end of file
+        return jsonify(failure(exc.identifier))
+    return session_cookie(jsonify(success()), session_data)
+
+# For long-running servers, a serverless instance may be frozen before the thread gets to run
+if getenv("WARM_ON_START"):
+    Thread(target=warm, daemon=True).start()
@@ -0,0 +1,36 @@
+from __future__ import annotations
+from typing import Callable, Generic, TypeVar
+import importlib
+import threading
+
+T = TypeVar("T")
+
+# Built on first use and exactly once, even when several threads ask for it at the same time. A
+# factory that raises is retried by the next caller. Attribute access is forwarded to the value, so
+# a Lazy can stand in for the object itself.
+class Lazy(Generic[T]):
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value: T
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        if self._ready:
+            return self._value
+        with self._lock:
+            if not self._ready:
+                self._value = self._factory()
+                self._ready = True
+        return self._value
+
+    @property
+    def is_ready(self) -> bool:
+        return self._ready
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+def import_modules(names: tuple[str, ...]) -> None:
+    for name in names:
+        importlib.import_module(name)
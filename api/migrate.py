@@ -0,0 +1,24 @@
+# Moves documents of the former one-document-per-session layout into the per-user buckets and builds
+# the indexes, once after upgrading and before the new version serves requests:
+#   python -m api.migrate
+# The apps only create the indexes when they start, which fails while legacy documents remain.
+import json
+import time
+from .database import MongoDB
+from .user_cache import CachingDatabase
+from .backends import create_database
+
+def main() -> None:
+    started = time.perf_counter()
+    database = create_database(ensure_indexes=False)
+    if isinstance(database, CachingDatabase):
+        database = database.database
+    moved = 0
+    # SQLite databases were always created with the current layout
+    if isinstance(database, MongoDB):
+        moved = database.migrate_legacy_documents()
+        database.ensure_indexes()
+    print(json.dumps({"documents_migrated": moved, "duration_ms": round((time.perf_counter() - started) * 1000, 1)}))
+
+if __name__ == "__main__":
+    main()
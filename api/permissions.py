@@ -0,0 +1,66 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from functools import lru_cache
+from collections.abc import Sequence
+from . import authentication
+
+PERMISSIONS_CACHE_SIZE = 1024
+
+# A session's Settings and permission group compiled into plain ints and booleans. Containment on an
+# enum.Flag goes through the enum machinery every time, these are attribute loads and int operations.
+@dataclass(frozen=True)
+class Permissions:
+    settings: int
+    permission_group: int
+    view_members: bool
+    view_member_settings: bool
+    edit_member_settings: bool
+    create_members: bool
+    disable_members: bool
+    view_invited_members: bool
+    uninvite_members: bool
+    retrieve_invitation: bool
+    sys_admin: bool
+
+    def has(self, mask: int) -> bool:
+        return self.settings & mask == mask
+
+    # Whether settings may be handed out, i.e. are a subset of our own
+    def grants(self, settings: int) -> bool:
+        return settings & ~self.settings == 0
+
+    def outranks(self, permission_group: int) -> bool:
+        return permission_group < self.permission_group
+
+    def can_see_settings_of(self, permission_group: int) -> bool:
+        return self.view_member_settings and permission_group <= self.permission_group
+
+    # Same masking as the user list queries: settings and permission group of users above us or
+    # without VIEW_MEMBER_SETTINGS become -1
+    def visible_fields(self, permission_groups: Sequence[int], settings: Sequence[int]) -> tuple[list[int], list[int]]:
+        if not self.view_member_settings:
+            return [-1] * len(permission_groups), [-1] * len(permission_groups)
+        limit = self.permission_group
+        return (
+            [value if group <= limit else -1 for group, value in zip(permission_groups, settings)],
+            [group if group <= limit else -1 for group in permission_groups]
+        )
+
+@lru_cache(maxsize=PERMISSIONS_CACHE_SIZE)
+def compile_permissions(settings: int, permission_group: int) -> Permissions:
+    Settings = authentication.Settings
+    def has(flag: authentication.Settings) -> bool:
+        return settings & flag.value == flag.value
+    return Permissions(
+        settings,
+        permission_group,
+        view_members=has(Settings.VIEW_MEMBERS),
+        view_member_settings=has(Settings._VIEW_MEMBER_SETTINGS),
+        edit_member_settings=has(Settings._EDIT_MEMBER_SETTINGS),
+        create_members=has(Settings._CREATE_MEMBERS),
+        disable_members=has(Settings._DISABLE_MEMBERS),
+        view_invited_members=has(Settings._VIEW_INVITED_MEMBERS),
+        uninvite_members=has(Settings._UNINVITE_MEMBERS),
+        retrieve_invitation=has(Settings._RETRIEVE_INVITATION),
+        sys_admin=has(Settings.SYS_ADMIN)
+    )
@@ -0,0 +1,120 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional, Self, TYPE_CHECKING
+from collections.abc import Hashable
+from cachetools import TTLCache
+from werkzeug.sansio.request import Request
+import threading
+import time
+from .exceptions import RateLimited
+
+if TYPE_CHECKING:
+    from .database import Database
+    from .async_database import AsyncDatabase
+
+# A token bucket: up to burst requests at once, refilled at rate tokens per second
+@dataclass(frozen=True)
+class RateLimit:
+    burst: float
+    rate: float
+    # "30/60" allows a burst of 30 and refills all 30 over 60 seconds
+    @classmethod
+    def parse(cls, spec: str) -> Self:
+        count, seconds = spec.split("/")
+        return cls(float(count), float(count) / float(seconds))
+
+    @property
+    def refill_time(self) -> float:
+        return self.burst / self.rate
+
+class RateLimitStore(ABC):
+    # Takes a token from the bucket of key, False when it is empty
+    @abstractmethod
+    def take(self, database: Database, key: str, limit: RateLimit) -> bool:
+        pass
+
+    @abstractmethod
+    async def take_async(self, database: AsyncDatabase, key: str, limit: RateLimit) -> bool:
+        pass
+
+    def size(self) -> Optional[int]:
+        return None
+
+# Every worker keeps its own buckets, so the effective limit is multiplied by the number of workers
+class MemoryRateLimitStore(RateLimitStore):
+    def __init__(self, maxsize: int, ttl: float):
+        # A bucket untouched for longer than it takes to refill is full and can be forgotten
+        self.buckets: TTLCache[tuple[Hashable, str], tuple[float, float]] = TTLCache(maxsize, ttl)
+        self.lock = threading.Lock()
+
+    def take(self, database, key, limit):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get((database, key), (limit.burst, now))
+            tokens = min(limit.burst, tokens + (now - updated_at) * limit.rate)
+            allowed = tokens >= 1
+            self.buckets[(database, key)] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+    async def take_async(self, database, key, limit):
+        return self.take(database, key, limit)
+
+    def size(self):
+        with self.lock:
+            return len(self.buckets)
+
+class DatabaseRateLimitStore(RateLimitStore):
+    def take(self, database, key, limit):
+        return database.take_token(key, limit.burst, limit.rate, time.time())
+
+    async def take_async(self, database, key, limit):
+        return await database.take_token(key, limit.burst, limit.rate, time.time())
+
+def client_address(request: Request, trusted_proxies: int) -> str:
+    # Each trusted proxy appends the address it received the request from to X-Forwarded-For
+    route = request.access_route if trusted_proxies else []
+    if len(route) >= trusted_proxies > 0:
+        return route[-trusted_proxies]
+    return request.remote_addr or ""
+
+# Checked before the handlers do any decryption, key derivation or database work. The address is
+# checked first so a flood from one address does not use up the tokens of the usernames it tries.
+# Without a store nothing is limited.
+class RateLimiter:
+    def __init__(self, store: Optional[RateLimitStore], ip_limit: RateLimit, username_limit: RateLimit):
+        self.store = store
+        self.ip_limit = ip_limit
+        self.username_limit = username_limit
+        self.counters = {"ip_allowed": 0, "ip_limited": 0, "username_allowed": 0, "username_limited": 0}
+        self.lock = threading.Lock()
+
+    def count(self, scope: str, allowed: bool) -> None:
+        with self.lock:
+            self.counters[f"{scope}_allowed" if allowed else f"{scope}_limited"] += 1
+
+    def check(self, database: Database, address: str, username: Optional[str] = None) -> None:
+        if self.store is None:
+            return
+        allowed = self.store.take(database, f"ip:{address}", self.ip_limit)
+        self.count("ip", allowed)
+        if allowed and username is not None:
+            allowed = self.store.take(database, f"user:{username.lower()}", self.username_limit)
+            self.count("username", allowed)
+        if not allowed:
+            raise RateLimited()
+
+    async def check_async(self, database: AsyncDatabase, address: str, username: Optional[str] = None) -> None:
+        if self.store is None:
+            return
+        allowed = await self.store.take_async(database, f"ip:{address}", self.ip_limit)
+        self.count("ip", allowed)
+        if allowed and username is not None:
+            allowed = await self.store.take_async(database, f"user:{username.lower()}", self.username_limit)
+            self.count("username", allowed)
+        if not allowed:
+            raise RateLimited()
+
+    def stats(self) -> dict[str, Optional[int]]:
+        with self.lock:
+            return {**self.counters, "size": self.store.size() if self.store is not None else None}
@@ -0,0 +1,94 @@
+from __future__ import annotations
+from typing import Optional
+from collections.abc import Hashable, Iterable
+from dataclasses import dataclass
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha256
+import hmac
+import json
+import threading
+import time
+
+@dataclass(frozen=True)
+class SessionClaims:
+    username: str
+    session_name: str
+    settings: int
+    permission_group: int
+    creation_time: float
+    session_id: str
+    issued_at: int
+    expires_at: int
+
+def session_id(session_data: str) -> str:
+    # The claim names its server-side session without carrying the secret cookie value
+    return urlsafe_b64encode(sha256(session_data.encode()).digest()[:18]).decode()
+
+def session_revocation_key(session_id: str) -> str:
+    return "s:" + session_id
+
+def user_revocation_key(username: str) -> str:
+    return "u:" + username.lower()
+
+# Short-lived HMAC-signed snapshot of a session, verified without touching the database.
+class ClaimSigner:
+    def __init__(self, secret: bytes, ttl: int):
+        self.secret = secret
+        self.ttl = ttl
+
+    def sign(self, payload: bytes) -> bytes:
+        return urlsafe_b64encode(hmac.digest(self.secret, payload, "sha256")).rstrip(b"=")
+
+    def issue(self, session_data: str, username: str, session_name: str, settings: int, permission_group: int, creation_time: float) -> str:
+        issued_at = int(time.time())
+        claims = [username, session_name, settings, permission_group, creation_time, session_id(session_data), issued_at, issued_at + self.ttl]
+        payload = urlsafe_b64encode(json.dumps(claims, separators=(",", ":")).encode()).rstrip(b"=")
+        return (payload + b"." + self.sign(payload)).decode()
+
+    def verify(self, token: str, session_data: str) -> Optional[SessionClaims]:
+        payload, _, signature = token.encode().partition(b".")
+        if not hmac.compare_digest(signature, self.sign(payload)):
+            return None
+        try:
+            claims = SessionClaims(*json.loads(urlsafe_b64decode(payload + b"=" * (-len(payload) % 4))))
+        except (ValueError, TypeError):
+            return None
+        if claims.expires_at <= time.time() or claims.session_id != session_id(session_data):
+            return None
+        return claims
+
+# Revocations only have to outlive the claims and cached sessions from before them, so the list stays
+# small. It is reloaded whenever the shared session generation moves, which every revocation increments.
+class RevocationList:
+    def __init__(self, grace: float):
+        self.grace = grace
+        self.entries: dict[Hashable, dict[str, float]] = {}
+        self.loaded_generations: dict[Hashable, int] = {}
+        self.lock = threading.Lock()
+
+    def is_loaded(self, database: Hashable, generation: int) -> bool:
+        with self.lock:
+            return self.loaded_generations.get(database) == generation
+
+    def load(self, database: Hashable, generation: int, entries: dict[str, float]) -> None:
+        with self.lock:
+            self.entries[database] = entries
+            self.loaded_generations[database] = generation
+
+    def add(self, database: Hashable, key: str, revoked_at: float) -> None:
+        with self.lock:
+            entries = self.entries.setdefault(database, {})
+            entries[key] = max(entries.get(key, 0), revoked_at)
+
+    def is_revoked(self, database: Hashable, claims: SessionClaims) -> bool:
+        return self.revoked_since(database, (session_revocation_key(claims.session_id), user_revocation_key(claims.username)), claims.issued_at)
+
+    # Whether anything read at or before the given time may predate a revocation of one of the keys
+    def revoked_since(self, database: Hashable, keys: Iterable[str], read_at: float) -> bool:
+        with self.lock:
+            entries = self.entries.get(database, {})
+            for key in keys:
+                revoked_at = entries.get(key)
+                if revoked_at is not None and read_at <= revoked_at + self.grace:
+                    return True
+            return False
@@ -0,0 +1,105 @@
+from __future__ import annotations
+from typing import Optional, TYPE_CHECKING
+from collections.abc import Hashable
+import asyncio
+import json
+import threading
+import time
+
+if TYPE_CHECKING:
+    from .database import Database
+    from .async_database import AsyncDatabase
+
+# Deletes what no lookup returns anymore: expired sessions, user slots nobody filled in time and the
+# sessions and authkeys of users that are gone. Logins start a run in the background at most every
+# interval per database, deployments without long-lived workers run it on a schedule instead:
+#   python -m api.sweeper
+class Sweeper:
+    def __init__(self, interval: float, session_max_age: float, session_idle_timeout: float, user_slot_max_age: float):
+        self.interval = interval
+        self.session_max_age = session_max_age
+        self.session_idle_timeout = session_idle_timeout
+        # 0 keeps user slots until they are filled or removed
+        self.user_slot_max_age = user_slot_max_age
+        self.last_runs: dict[Hashable, float] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.counters = {"runs": 0, "failures": 0, "user_slots_removed": 0}
+        self.last_duration_ms: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def due(self, database: Hashable) -> bool:
+        if self.interval <= 0:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            last_run = self.last_runs.get(database)
+            if last_run is not None and now - last_run < self.interval:
+                return False
+            self.last_runs[database] = now
+            return True
+
+    def record(self, started: float, removed: Optional[set[str]]) -> None:
+        with self.lock:
+            if removed is None:
+                self.counters["failures"] += 1
+            else:
+                self.counters["runs"] += 1
+                self.counters["user_slots_removed"] += len(removed)
+            self.last_duration_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    def sweep(self, database: Database) -> set[str]:
+        now = time.time()
+        database.delete_expired_sessions(now - self.session_max_age, now - self.session_idle_timeout)
+        removed = database.delete_stale_user_slots(now - self.user_slot_max_age) if self.user_slot_max_age > 0 else set()
+        database.delete_orphaned_credentials()
+        return removed
+
+    async def sweep_async(self, database: AsyncDatabase) -> set[str]:
+        now = time.time()
+        await database.delete_expired_sessions(now - self.session_max_age, now - self.session_idle_timeout)
+        removed = await database.delete_stale_user_slots(now - self.user_slot_max_age) if self.user_slot_max_age > 0 else set()
+        await database.delete_orphaned_credentials()
+        return removed
+
+    def run(self, database: Database) -> None:
+        started = time.perf_counter()
+        try:
+            removed = self.sweep(database)
+        except Exception:
+            self.record(started, None)
+            raise
+        self.record(started, removed)
+
+    async def run_async(self, database: AsyncDatabase) -> None:
+        started = time.perf_counter()
+        try:
+            removed = await self.sweep_async(database)
+        except Exception:
+            self.record(started, None)
+            raise
+        self.record(started, removed)
+
+    def start(self, database: Database) -> None:
+        if self.due(database):
+            threading.Thread(target=self.run, args=(database,), daemon=True).start()
+
+    def start_async(self, database: AsyncDatabase) -> None:
+        if self.due(database):
+            task = asyncio.get_running_loop().create_task(self.run_async(database))
+            # The loop only keeps weak references to its tasks
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def stats(self) -> dict[str, Optional[float]]:
+        with self.lock:
+            return {**self.counters, "last_duration_ms": self.last_duration_ms}
+
+def main() -> None:
+    from .backends import create_database
+    from .authentication import sweeper
+    started = time.perf_counter()
+    removed = sweeper.sweep(create_database())
+    print(json.dumps({"user_slots_removed": sorted(removed), "duration_ms": round((time.perf_counter() - started) * 1000, 1)}))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 window.lastUsername = null;
-{% if Settings._CREATE_MEMBERS in session.settings %}
 const addUserButton = document.querySelector("#addUserForm");
 const addUserUsernameInput = document.querySelector("#addUserForm #username");
 const addUserPgroupInput = document.querySelector("#addUserForm #pgroup");
@@ -8,6 +7,19 @@ const addUserMessageBox = document.querySelector("#addUserForm .message");
 const addUserMessageBoxText = document.querySelector("#addUserForm .message p");
 const addUserMessageBoxLinkElm = document.querySelector("#addUserForm .message .copy-link");
 window.addUserMessageBoxLink = "";
+for (const name in settingsValues) {
+    if (name.startsWith("setting__") || name === "setting_NONE" || !settingsInclude(ownSettings, name)) continue;
+    const settingLabel = document.createElement("label");
+    const settingInput = document.createElement("input");
+    settingInput.name = name;
+    settingInput.id = name;
+    settingInput.type = "checkbox";
+    settingInput.style.marginBottom = "2px";
+    const settingName = document.createElement("span");
+    settingName.textContent = settingsNames[name];
+    settingLabel.append(settingInput, settingName);
+    addUserSettingsDiv.appendChild(settingLabel);
+}
 function copyAddUserMessageLink(event) {
     navigator.clipboard.writeText(addUserMessageBoxLink);
 }
@@ -64,4 +76,3 @@ addUserButton.addEventListener("submit", (event) => {
         })
     }).then((response) => response.json()).then(addUserSuccess);
 })
-{% endif %}
\ No newline at end of file
@@ -67,6 +67,9 @@ function loginSuccess(data) {
             case "{{ exceptions.InvalidCredentials.identifier }}":
                 messageBox.textContent = "Falsche Einlogdaten.";
                 break;
+            case "{{ exceptions.ServerBusy.identifier }}":
+                messageBox.textContent = "Der Server ist ausgelastet. Bitte versuche es gleich noch einmal.";
+                break;
             default:
                 messageBox.textContent = "Konnte nicht eingeloggt werden.";
         }
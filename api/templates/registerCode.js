@@ -40,6 +40,9 @@ function signupSuccess(data) {
             case "{{ exceptions.NotFoundError.identifier }}":
                 messageBox.textContent = "Du hast keinen angegeben oder dieser User Slot existiert nicht."
                 break;
+            case "{{ exceptions.ServerBusy.identifier }}":
+                messageBox.textContent = "Der Server ist ausgelastet. Bitte versuche es gleich noch einmal.";
+                break;
             default:
                 messageBox.textContent = "Dein Konto konnte nicht erstellt werden.";
         }
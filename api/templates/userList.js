@@ -14,7 +14,7 @@ function userListSuccess(data){
     const success = data.{{ consts.FIELD_SUCCESS }};
     if (!success) return;
     const userListTable = userListDiv.querySelector("tbody");
-    userListDiv.firstChild.remove();
+    if (userListDiv.firstChild.nodeType === Node.TEXT_NODE) userListDiv.firstChild.remove();
     for (const user of data.{{ consts.FIELD_DATA }}) {
         const username = user.{{ consts.FIELD_USERNAME }};
         const pgroup = user.{{ consts.FIELD_PERMISSION_GROUP }};
@@ -23,7 +23,7 @@ function userListSuccess(data){
         const currentLine = createUserListLine();
         currentLine.classList.add("username-"+username);
         currentLine.querySelector(".username-column").textContent = username;
-        currentLine.querySelector(".pgroup-column").textContent = pgroup !== -1 ? pgroup : "≥{{ session.permission_group }}";
+        currentLine.querySelector(".pgroup-column").textContent = pgroup !== -1 ? pgroup : "≥" + ownPgroup;
         currentLine.querySelector(".status-column").textContent = unfilled ? "Eingeladen" : "Mitglied";
         const settingsList = currentLine.querySelector(".settings-column .settings-list");
         if (settings === -1){
@@ -40,72 +40,74 @@ function userListSuccess(data){
             }
         }
         if (pgroup !== -1 && pgroup < ownPgroup) {
-            {% if Settings._DISABLE_MEMBERS in session.settings %}
-            const disableButton = createUserListButton();
-            disableButton.textContent = "Entregristrieren";
-            disableButton.classList.add("disable-button");
-            disableButton.targetUsername = username;
-            disableButton.onclick = (event) => {
-                if (event.target.textContent === "...") return;
-                event.target.textContent = "...";
-                fetch("{{ url_for('deactivate_user') }}", {
-                    headers: {
-                        'Accept': 'application/json',
-                        'Content-Type': 'application/json',
-                        '{{ consts.FIELD_CSRF_TOKEN_HEADER }}': getCookie("{{ consts.FIELD_CSRF_TOKEN }}")
-                    },
-                    method: "POST",
-                    body: JSON.stringify({ {{ consts.FIELD_USERNAME }}: event.target.targetUsername })
-                }).then((response) => response.json()).then((data) => {
-                    event.target.textContent = "Entregristrieren";
-                    if (data.success) {
-                        event.target.style.display = "none";
-                        const deleteButton = document.querySelector("#userList .username-"+event.target.targetUsername+" .delete-button")
-                        if (deleteButton) deleteButton.style.display = "";
-                    }
-                });
-            }
-            if (unfilled) {
-                disableButton.style.display = "none";
-            }
-            currentLine.querySelector(".options-column").appendChild(disableButton);
-            {% endif %}
-            {% if Settings._UNINVITE_MEMBERS in session.settings %}
-            const deleteButton = createUserListButton();
-            deleteButton.textContent = "Löschen";
-            deleteButton.classList.add("delete-button");
-            deleteButton.targetUsername = username;
-            deleteButton.onclick = (event) => {
-                if (event.target.textContent === "...") return;
-                event.target.textContent = "...";
-                fetch("{{ url_for('remove_user') }}", {
-                    headers: {
-                        'Accept': 'application/json',
-                        'Content-Type': 'application/json',
-                        '{{ consts.FIELD_CSRF_TOKEN_HEADER }}': getCookie("{{ consts.FIELD_CSRF_TOKEN }}")
-                    },
-                    method: "POST",
-                    body: JSON.stringify({ {{ consts.FIELD_USERNAME }}: event.target.targetUsername })
-                }).then((response) => response.json()).then((data) => {
-                    event.target.textContent = "Löschen";
-                    if (data.success) {
-                        event.target.parentNode.parentNode.remove()
-                    }
-                });
+            if (settingsInclude(ownSettings, "setting__DISABLE_MEMBERS")) {
+                const disableButton = createUserListButton();
+                disableButton.textContent = "Entregristrieren";
+                disableButton.classList.add("disable-button");
+                disableButton.targetUsername = username;
+                disableButton.onclick = (event) => {
+                    if (event.target.textContent === "...") return;
+                    event.target.textContent = "...";
+                    fetch("{{ url_for('deactivate_user') }}", {
+                        headers: {
+                            'Accept': 'application/json',
+                            'Content-Type': 'application/json',
+                            '{{ consts.FIELD_CSRF_TOKEN_HEADER }}': getCookie("{{ consts.FIELD_CSRF_TOKEN }}")
+                        },
+                        method: "POST",
+                        body: JSON.stringify({ {{ consts.FIELD_USERNAME }}: event.target.targetUsername })
+                    }).then((response) => response.json()).then((data) => {
+                        event.target.textContent = "Entregristrieren";
+                        if (data.success) {
+                            event.target.style.display = "none";
+                            const deleteButton = document.querySelector("#userList .username-"+event.target.targetUsername+" .delete-button")
+                            if (deleteButton) deleteButton.style.display = "";
+                        }
+                    });
+                }
+                if (unfilled) {
+                    disableButton.style.display = "none";
+                }
+                currentLine.querySelector(".options-column").appendChild(disableButton);
             }
-            if (!unfilled) {
-                deleteButton.style.display = "none";
+            if (settingsInclude(ownSettings, "setting__UNINVITE_MEMBERS")) {
+                const deleteButton = createUserListButton();
+                deleteButton.textContent = "Löschen";
+                deleteButton.classList.add("delete-button");
+                deleteButton.targetUsername = username;
+                deleteButton.onclick = (event) => {
+                    if (event.target.textContent === "...") return;
+                    event.target.textContent = "...";
+                    fetch("{{ url_for('remove_user') }}", {
+                        headers: {
+                            'Accept': 'application/json',
+                            'Content-Type': 'application/json',
+                            '{{ consts.FIELD_CSRF_TOKEN_HEADER }}': getCookie("{{ consts.FIELD_CSRF_TOKEN }}")
+                        },
+                        method: "POST",
+                        body: JSON.stringify({ {{ consts.FIELD_USERNAME }}: event.target.targetUsername })
+                    }).then((response) => response.json()).then((data) => {
+                        event.target.textContent = "Löschen";
+                        if (data.success) {
+                            event.target.parentNode.parentNode.remove()
+                        }
+                    });
+                }
+                if (!unfilled) {
+                    deleteButton.style.display = "none";
+                }
+                currentLine.querySelector(".options-column").appendChild(deleteButton);
             }
-            currentLine.querySelector(".options-column").appendChild(deleteButton);
-            {% endif %}
         }
         userListTable.appendChild(currentLine);
     }
     userListTable.parentNode.style.display = "";
+    if (data.{{ consts.FIELD_NEXT }}) userListLoad(data.{{ consts.FIELD_NEXT }});
 }
 
-function userListLoad() {
-    fetch("{{ url_for('get_user_list') }}")
+function userListLoad(after) {
+    const query = after ? "?{{ consts.FIELD_AFTER }}=" + encodeURIComponent(after) : "";
+    fetch("{{ url_for('get_user_list') }}" + query)
         .then((response) => response.json()).then(userListSuccess);
 }
 
@@ -0,0 +1,169 @@
+from __future__ import annotations
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter_ns
+from typing import Callable, Optional, TypeVar
+from werkzeug.sansio.response import Response as BaseResponse
+from jinja2 import Template
+import inspect
+import json
+import logging
+import os
+import random
+
+F = TypeVar("F", bound=Callable)
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE") or 0)
+TRACE_LOG = bool(os.getenv("TRACE_LOG"))
+# Nothing is wrapped when tracing is off, so the untraced paths stay exactly as they were
+TRACING = TRACE_SAMPLE_RATE > 0
+
+logger = logging.getLogger(__name__)
+
+class Trace:
+    def __init__(self):
+        self.start = perf_counter_ns()
+        # Appended from worker threads too, list.append is atomic
+        self.spans: list[tuple[str, int]] = []
+
+    def record(self, name: str, elapsed: int) -> None:
+        self.spans.append((name, elapsed))
+
+    def summary(self) -> dict[str, tuple[int, int]]:
+        totals: dict[str, tuple[int, int]] = {}
+        for name, elapsed in self.spans:
+            count, total = totals.get(name, (0, 0))
+            totals[name] = (count + 1, total + elapsed)
+        return totals
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+def start_trace() -> None:
+    # Always set, a reused worker thread must not keep the trace of its previous request
+    current_trace.set(Trace() if random.random() < TRACE_SAMPLE_RATE else None)
+
+def finish_trace(response: BaseResponse, method: str, path: str) -> BaseResponse:
+    trace = current_trace.get()
+    if trace is None:
+        return response
+    current_trace.set(None)
+    # Spans of a streamed body end after the headers are sent and are not part of the header
+    total = perf_counter_ns() - trace.start
+    summary = trace.summary()
+    response.headers["Server-Timing"] = ", ".join(
+        [f'{name};dur={elapsed / 1e6:.3f};desc="{count}x"' for name, (count, elapsed) in summary.items()]
+        + [f"total;dur={total / 1e6:.3f}"]
+    )
+    if TRACE_LOG:
+        logger.info(json.dumps({
+            "method": method,
+            "path": path,
+            "status": response.status_code,
+            "total_ms": round(total / 1e6, 3),
+            "spans": {name: {"count": count, "ms": round(elapsed / 1e6, 3)} for name, (count, elapsed) in summary.items()}
+        }))
+    return response
+
+def traced(name: str) -> Callable[[F], F]:
+    def decorate(function):
+        if not TRACING:
+            return function
+        # Generators are timed while they produce items, not when they are created
+        if inspect.isasyncgenfunction(function):
+            @wraps(function)
+            async def traced_async_generator(*args, **kwargs):
+                trace = current_trace.get()
+                iterator = function(*args, **kwargs)
+                elapsed = 0
+                try:
+                    while True:
+                        start = perf_counter_ns()
+                        try:
+                            item = await anext(iterator)
+                        except StopAsyncIteration:
+                            break
+                        finally:
+                            elapsed += perf_counter_ns() - start
+                        yield item
+                finally:
+                    if trace is not None:
+                        trace.record(name, elapsed)
+            return traced_async_generator
+        if inspect.isgeneratorfunction(function):
+            @wraps(function)
+            def traced_generator(*args, **kwargs):
+                trace = current_trace.get()
+                iterator = function(*args, **kwargs)
+                elapsed = 0
+                try:
+                    while True:
+                        start = perf_counter_ns()
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            break
+                        finally:
+                            elapsed += perf_counter_ns() - start
+                        yield item
+                finally:
+                    if trace is not None:
+                        trace.record(name, elapsed)
+            return traced_generator
+        if inspect.iscoroutinefunction(function):
+            @wraps(function)
+            async def traced_coroutine(*args, **kwargs):
+                trace = current_trace.get()
+                if trace is None:
+                    return await function(*args, **kwargs)
+                start = perf_counter_ns()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    trace.record(name, perf_counter_ns() - start)
+            return traced_coroutine
+        @wraps(function)
+        def traced_function(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return function(*args, **kwargs)
+            start = perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                trace.record(name, perf_counter_ns() - start)
+        return traced_function
+    return decorate
+
+def traced_methods(prefix: str):
+    # Wraps the implementations of every abstract method the class inherits, i.e. its public interface
+    def decorate(cls):
+        if not TRACING:
+            return cls
+        names = set().union(*(getattr(base, "__abstractmethods__", ()) for base in cls.__mro__[1:]))
+        for name in names:
+            method = cls.__dict__.get(name)
+            if inspect.isfunction(method):
+                setattr(cls, name, traced(f"{prefix}.{name}")(method))
+        return cls
+    return decorate
+
+class TracedTemplate(Template):
+    def render(self, *args, **kwargs):
+        trace = current_trace.get()
+        if trace is None:
+            return super().render(*args, **kwargs)
+        start = perf_counter_ns()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            trace.record("template", perf_counter_ns() - start)
+
+    async def render_async(self, *args, **kwargs):
+        trace = current_trace.get()
+        if trace is None:
+            return await super().render_async(*args, **kwargs)
+        start = perf_counter_ns()
+        try:
+            return await super().render_async(*args, **kwargs)
+        finally:
+            trace.record("template", perf_counter_ns() - start)
@@ -0,0 +1,46 @@
+from __future__ import annotations
+from typing import Callable
+from cachetools import LRUCache
+import threading
+from .tracing import traced
+
+@traced("user_agent")
+def classify_user_agent(user_agent: str) -> str:
+    # Imported on first use, loading the parser's regexes takes over 100ms
+    from user_agents import parse as parse_user_agent # type: ignore
+    parsed_user_agent = parse_user_agent(user_agent)
+    browser = parsed_user_agent.browser.family
+    os = parsed_user_agent.os.family
+    return f"{browser} on {os}"
+
+# Every lookup goes through the locked LRU, so user agents that stop being common are evicted like any other
+class UserAgentCache:
+    def __init__(self, maxsize: int, max_length: int, classify: Callable[[str], str] = classify_user_agent):
+        self.entries: LRUCache[str, str] = LRUCache(maxsize)
+        self.max_length = max_length
+        self.classify = classify
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_agent: str) -> str:
+        with self.lock:
+            name = self.entries.get(user_agent)
+            if name is not None:
+                self.hits += 1
+                return name
+            self.misses += 1
+        name = self.classify(user_agent)
+        # Oversized headers are classified but never stored
+        if len(user_agent) <= self.max_length:
+            with self.lock:
+                self.entries[user_agent] = name
+        return name
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.entries)
+            }
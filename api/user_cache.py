@@ -0,0 +1,332 @@
+from __future__ import annotations
+from bisect import bisect_right
+from dataclasses import replace
+from typing import Optional
+from collections.abc import Callable, Iterable, Iterator
+import threading
+import time
+from .database import Database, UserProfile, UserListEntry, AuthRecord
+from .consts import FIELD_SETTINGS, FIELD_PERMISSION_GROUP
+from . import authentication
+
+USERS_GENERATION = "users"
+
+# Every user profile at one point in time, loaded with a single list_users. Profiles are never changed
+# in place, a write installs a changed copy, so a reader still streaming the previous directory sees it
+# whole. Auth records are only needed by logins and are added one by one as they are looked up.
+class UserDirectory:
+    def __init__(self, profiles: Iterable[UserProfile], auth_records: Optional[dict[str, Optional[AuthRecord]]] = None, sorted_names: Optional[list[str]] = None):
+        self.profiles = {profile.username.lower(): profile for profile in profiles}
+        self.auth_records: dict[str, Optional[AuthRecord]] = auth_records if auth_records is not None else {}
+        self._sorted_names = sorted_names
+
+    @property
+    def sorted_names(self) -> list[str]:
+        if self._sorted_names is None:
+            self._sorted_names = sorted(self.profiles)
+        return self._sorted_names
+
+    def replaced(self, profiles: Iterable[UserProfile] = (), removed: Iterable[str] = ()) -> UserDirectory:
+        changed = dict(self.profiles)
+        auth_records = dict(self.auth_records)
+        for name in removed:
+            changed.pop(name, None)
+            auth_records.pop(name, None)
+        for profile in profiles:
+            changed[profile.username.lower()] = profile
+        sorted_names = self._sorted_names if changed.keys() == self.profiles.keys() else None
+        return UserDirectory(changed.values(), auth_records, sorted_names)
+
+    def updated(self, changes: dict[str, dict[str, int]]) -> UserDirectory:
+        profiles = []
+        for username, fields in changes.items():
+            profile = self.profiles.get(username.lower())
+            if profile is None:
+                continue
+            if FIELD_SETTINGS in fields:
+                profile = replace(profile, settings=authentication.Settings(fields[FIELD_SETTINGS]))
+            if FIELD_PERMISSION_GROUP in fields:
+                profile = replace(profile, permission_group=fields[FIELD_PERMISSION_GROUP])
+            profiles.append(profile)
+        return self.replaced(profiles)
+
+    def with_slots(self, slots: list[tuple[int, int, str]], user_ids: list[Optional[str]]) -> UserDirectory:
+        return self.replaced(UserProfile(temp_name, user_id, authentication.Settings(slot_settings), permission_group, True) for (slot_settings, permission_group, temp_name), user_id in zip(slots, user_ids) if user_id is not None)
+
+    def without_auth_record(self, username: str) -> UserDirectory:
+        # Auth records are a lookup memo, dropping one does not disturb readers
+        self.auth_records.pop(username.lower(), None)
+        return self
+
+    def get_user_profiles(self, usernames: list[str]) -> dict[str, UserProfile]:
+        return {username.lower(): self.profiles[username.lower()] for username in usernames if username.lower() in self.profiles}
+
+    def has_username(self, username: str, except_user_id: Optional[str]) -> bool:
+        profile = self.profiles.get(username.lower())
+        return profile is not None and profile.user_id != except_user_id
+
+    def iter_user_list(self, viewer_permission_group: int, view_member_settings: bool, view_invited_members: bool, limit: int, after: Optional[str] = None) -> Iterator[UserListEntry]:
+        names = self.sorted_names
+        count = 0
+        for name in names[bisect_right(names, after or ""):]:
+            if count == limit:
+                return
+            profile = self.profiles[name]
+            if profile.unfilled and not view_invited_members:
+                continue
+            # The same masking the queries of the backends do
+            visible = view_member_settings and profile.permission_group is not None and profile.permission_group <= viewer_permission_group
+            yield UserListEntry(
+                name,
+                profile.username,
+                "???" if profile.unfilled else profile.user_id,
+                profile.settings.value if visible else -1,
+                profile.permission_group if visible else -1
+            )
+            count += 1
+
+# When to reload the directory and how to apply a write to it, without any I/O, so the sync and the
+# async wrapper share it. Writes increment the shared users generation, which the other workers
+# check at most every check_interval seconds. Every process that writes users therefore has to go
+# through one of the wrappers as well, or the others keep serving their directory until it is dropped
+# for another reason.
+class DirectoryState:
+    def __init__(self, check_interval: float):
+        self.check_interval = check_interval
+        self.directory: Optional[UserDirectory] = None
+        self.known_generation: Optional[int] = None
+        self.checked_at = 0.0
+        self.epoch = 0
+        self.lock = threading.Lock()
+
+    def check_due(self) -> bool:
+        return time.monotonic() - self.checked_at >= self.check_interval
+
+    def observe_generation(self, generation: int, checked_at: float) -> None:
+        with self.lock:
+            if generation != self.known_generation:
+                self.directory = None
+                self.epoch += 1
+            self.known_generation = generation
+            self.checked_at = checked_at
+
+    def loaded(self, epoch: int, directory: UserDirectory) -> UserDirectory:
+        with self.lock:
+            # A write happened while loading, the directory may not contain it
+            if epoch == self.epoch:
+                self.directory = directory
+        return directory
+
+    def store_auth_record(self, epoch: int, directory: UserDirectory, username: str, record: Optional[AuthRecord]) -> None:
+        with self.lock:
+            if epoch == self.epoch:
+                directory.auth_records[username.lower()] = record
+
+    # Returns the generation the write is expected to increment
+    def begin_change(self, apply: Optional[Callable[[UserDirectory], UserDirectory]]) -> Optional[int]:
+        with self.lock:
+            self.epoch += 1
+            if apply is None or self.directory is None:
+                self.directory = None
+            else:
+                self.directory = apply(self.directory)
+            return self.known_generation
+
+    def end_change(self, known: Optional[int], generation: int) -> None:
+        with self.lock:
+            # Anything but our own increment means another process changed users as well
+            if known is None or generation != known + 1:
+                self.directory = None
+            self.known_generation = generation
+            self.checked_at = time.monotonic()
+
+# Serves the user reads from an in-memory directory and passes everything else through
+class CachingDatabase(DirectoryState, Database):
+    def __init__(self, database: Database, check_interval: float = 1):
+        super().__init__(check_interval)
+        self.database = database
+
+    def __getattr__(self, name: str):
+        return getattr(self.database, name)
+
+    def read_only(self):
+        # Misses load from the primary, a directory read from a secondary could miss our own writes
+        return self
+
+    def current_directory(self) -> UserDirectory:
+        if self.check_due():
+            checked_at = time.monotonic()
+            self.observe_generation(self.database.get_generation(USERS_GENERATION), checked_at)
+        directory = self.directory
+        if directory is not None:
+            return directory
+        epoch = self.epoch
+        return self.loaded(epoch, UserDirectory(self.database.list_users()))
+
+    def changed(self, apply: Optional[Callable[[UserDirectory], UserDirectory]] = None) -> None:
+        known = self.begin_change(apply)
+        self.end_change(known, self.database.increment_generation(USERS_GENERATION))
+
+    def get_user_profile(self, username):
+        return self.current_directory().profiles.get(username.lower())
+
+    def get_user_profiles(self, usernames):
+        return self.current_directory().get_user_profiles(usernames)
+
+    def has_username(self, username, *, except_user_id = None):
+        return self.current_directory().has_username(username, except_user_id)
+
+    def get_correctly_cased_username(self, username):
+        profile = self.current_directory().profiles.get(username.lower())
+        return profile.username if profile is not None else None
+
+    def list_users(self):
+        return list(self.current_directory().profiles.values())
+
+    def iter_user_list(self, viewer_permission_group, view_member_settings, view_invited_members, limit, after = None):
+        return self.current_directory().iter_user_list(viewer_permission_group, view_member_settings, view_invited_members, limit, after)
+
+    def get_auth_record(self, username):
+        directory = self.current_directory()
+        if username.lower() in directory.auth_records:
+            return directory.auth_records[username.lower()]
+        epoch = self.epoch
+        record = self.database.get_auth_record(username)
+        self.store_auth_record(epoch, directory, username, record)
+        return record
+
+    def get_login_data_by_username(self, username):
+        record = self.get_auth_record(username)
+        if record is None or record.login_data is None or record.login_token is None:
+            return None
+        return (record.login_data, record.login_token, record.login_type)
+
+    def create_user(self, username, login_data, login_token, login_type, user_slot):
+        try:
+            self.database.create_user(username, login_data, login_token, login_type, user_slot)
+        finally:
+            self.changed()
+
+    def create_user_slot(self, slot_settings, permission_group, temp_name):
+        user_id = self.database.create_user_slot(slot_settings, permission_group, temp_name)
+        self.changed(lambda directory: directory.with_slots([(slot_settings, permission_group, temp_name)], [user_id]))
+        return user_id
+
+    def create_user_slots(self, slots):
+        user_ids = self.database.create_user_slots(slots)
+        self.changed(lambda directory: directory.with_slots(slots, user_ids))
+        return user_ids
+
+    def remove_unfilled_user(self, username):
+        removed = self.database.remove_unfilled_user(username)
+        if removed:
+            self.changed(lambda directory: directory.replaced(removed=[username.lower()]))
+        return removed
+
+    def remove_unfilled_users(self, usernames):
+        removed = self.database.remove_unfilled_users(usernames)
+        if removed:
+            self.changed(lambda directory: directory.replaced(removed=removed))
+        return removed
+
+    def set_permission_group(self, username, permission_group):
+        updated = self.database.set_permission_group(username, permission_group)
+        if updated:
+            self.changed(lambda directory: directory.updated({username: {FIELD_PERMISSION_GROUP: permission_group}}))
+        return updated
+
+    def set_settings(self, username, settings):
+        updated = self.database.set_settings(username, settings)
+        if updated:
+            self.changed(lambda directory: directory.updated({username: {FIELD_SETTINGS: settings}}))
+        return updated
+
+    def update_users(self, changes):
+        updated = self.database.update_users(changes)
+        if updated:
+            self.changed(lambda directory: directory.updated({username: fields for username, fields in changes.items() if username.lower() in updated}))
+        return updated
+
+    # Disabling hands out a new user id, the next read loads it
+    def disable_user(self, username):
+        user_id = self.database.disable_user(username)
+        if user_id is not None:
+            self.changed()
+        return user_id
+
+    def disable_users(self, usernames):
+        disabled = self.database.disable_users(usernames)
+        if disabled:
+            self.changed()
+        return disabled
+
+    def migrate_login_data(self, username, login_data, login_token, login_type):
+        self.database.migrate_login_data(username, login_data, login_token, login_type)
+        self.changed(lambda directory: directory.without_auth_record(username))
+
+    def get_username_by_session_data(self, session_data):
+        return self.database.get_username_by_session_data(session_data)
+
+    def add_session(self, session_data, username, session_name):
+        return self.database.add_session(session_data, username, session_name)
+
+    def list_sessions(self, username):
+        return self.database.list_sessions(username)
+
+    def get_session(self, session_data, created_after = 0, used_after = 0):
+        return self.database.get_session(session_data, created_after, used_after)
+
+    def touch_session(self, session_data, now):
+        self.database.touch_session(session_data, now)
+
+    def delete_session(self, session_data):
+        self.database.delete_session(session_data)
+
+    def create_authkey(self, data, credential_id, username, session_name):
+        self.database.create_authkey(data, credential_id, username, session_name)
+
+    def find_credential_by_id(self, credential_id):
+        return self.database.find_credential_by_id(credential_id)
+
+    def get_user_profile_by_credential_id(self, credential_id):
+        return self.database.get_user_profile_by_credential_id(credential_id)
+
+    def get_generation(self, name):
+        return self.database.get_generation(name)
+
+    def increment_generation(self, name):
+        return self.database.increment_generation(name)
+
+    def add_revocations(self, revocations):
+        self.database.add_revocations(revocations)
+
+    def list_revocations(self, now):
+        return self.database.list_revocations(now)
+
+    def put_challenge(self, key, challenge, expires_at):
+        self.database.put_challenge(key, challenge, expires_at)
+
+    def consume_challenge(self, key, now):
+        return self.database.consume_challenge(key, now)
+
+    def delete_expired_sessions(self, created_before, used_before):
+        self.database.delete_expired_sessions(created_before, used_before)
+
+    # Sweeps are rare, the directory is simply loaded again
+    def delete_stale_user_slots(self, invited_before):
+        removed = self.database.delete_stale_user_slots(invited_before)
+        if removed:
+            self.changed()
+        return removed
+
+    def delete_orphaned_credentials(self):
+        self.database.delete_orphaned_credentials()
+
+    def take_token(self, key, burst, rate, now):
+        return self.database.take_token(key, burst, rate, now)
+
+    def insert_audit_events(self, events):
+        self.database.insert_audit_events(events)
+
+    def list_audit_events(self, limit, before = None, actor = None, target = None):
+        return self.database.list_audit_events(limit, before, actor, target)
@@ -0,0 +1,50 @@
+# CPU cost against bytes saved for the response compression in api/compression.py, measured on user
+# lists of realistic sizes produced by the real /user_list/ serializer. Run from the repository root
+# with the app environment (RSA_KEY, ...) set:
+#   python -m benchmarks.compression
+from os import getenv
+from time import process_time
+from uuid import uuid4
+import json
+from api.compression import compress, ENCODINGS
+from api.database import UserListEntry
+from api.index import stream_user_list
+
+SIZES = (10, 200, 1000, 5000)
+LEVELS = {"gzip": (1, 6, 9), "br": (1, 4, 6, 11)}
+ROUNDS = int(getenv("BENCHMARK_ROUNDS", "20"))
+
+def user_list_payload(count: int) -> bytes:
+    entries = [
+        UserListEntry(f"member{i:05d}", f"Member{i:05d}", str(uuid4()) if i % 7 else "???", 1 << (i % 8), i % 50)
+        for i in range(count)
+    ]
+    return "".join(stream_user_list(iter(entries), count)).encode()
+
+def measure(payload: bytes, encoding: str, level: int) -> dict:
+    start = process_time()
+    for _ in range(ROUNDS):
+        compressed = compress(payload, encoding, level)
+    cpu_ms = (process_time() - start) * 1000 / ROUNDS
+    return {
+        "encoding": encoding,
+        "level": level,
+        "bytes": len(compressed),
+        "ratio": round(len(compressed) / len(payload), 4),
+        "cpu_ms": round(cpu_ms, 3),
+        "saved_bytes_per_cpu_ms": round((len(payload) - len(compressed)) / max(cpu_ms, 1e-6))
+    }
+
+def main():
+    results = []
+    for size in SIZES:
+        payload = user_list_payload(size)
+        results.append({
+            "users": size,
+            "raw_bytes": len(payload),
+            "encodings": [measure(payload, encoding, level) for encoding in ENCODINGS for level in LEVELS[encoding]]
+        })
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
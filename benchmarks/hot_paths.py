@@ -0,0 +1,157 @@
+# Latency percentiles and allocations of the authentication and session hot paths, measured against an
+# in-memory SQLiteDatabase so no network or server is needed. The output is JSON and meant to be
+# diffed between commits. Run from the repository root with the app environment (RSA_KEY, AUTH_SALT,
+# DATABASE_BACKEND=sqlite, SQLITE_DATABASE_PATH=:memory:) set:
+#   python -m benchmarks.hot_paths > before.json
+from os import getenv
+from time import perf_counter_ns
+from statistics import quantiles, fmean
+from typing import Callable, Optional
+import json
+import platform
+import subprocess
+import tracemalloc
+from flask import request
+from api import authentication
+from api.authentication import Settings, SessionData, Session
+from api.database import SQLiteDatabase
+from api.index import app, stream_user_list
+from api.consts import USER_LIST_PAGE_SIZE, USER_LIST_MAX_PAGE_SIZE, FIELD_CSRF_TOKEN
+
+ROUNDS = int(getenv("BENCHMARK_ROUNDS", "500"))
+# Every login derives a PBKDF2 key, so those cases get fewer rounds
+SLOW_ROUNDS = int(getenv("BENCHMARK_SLOW_ROUNDS", "20"))
+ALLOCATION_ROUNDS = int(getenv("BENCHMARK_ALLOCATION_ROUNDS", "50"))
+USER_COUNTS = tuple(int(count) for count in getenv("BENCHMARK_USER_COUNTS", "100,10000,100000").split(","))
+PASSWORD = "benchmark-password"
+SESSION_NAME = "Benchmark on Linux"
+# Stored login data is never checked by the user list, so bulk users skip the key derivation
+FILLER_LOGIN_DATA = authentication.weak_create_login_data("filler", PASSWORD)
+
+def percentiles(timings: list[int]) -> dict:
+    cuts = quantiles(timings, n=100)
+    return {
+        "p50_us": round(cuts[49] / 1000, 2),
+        "p90_us": round(cuts[89] / 1000, 2),
+        "p99_us": round(cuts[98] / 1000, 2),
+        "mean_us": round(fmean(timings) / 1000, 2)
+    }
+
+def allocations(case: Callable[[], object], setup: Optional[Callable[[], None]], rounds: int) -> dict:
+    # Traced separately, tracemalloc slows every allocation down and would skew the timings
+    peaks = []
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(rounds):
+            if setup is not None:
+                setup()
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            case()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - current)
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    peaks.sort()
+    return {
+        "peak_bytes_p50": peaks[len(peaks) // 2],
+        "peak_bytes_max": peaks[-1],
+        "retained_bytes_per_call": round((after - before) / rounds)
+    }
+
+def measure(name: str, case: Callable[[], object], rounds: int = ROUNDS, setup: Optional[Callable[[], None]] = None, **parameters) -> dict:
+    case()
+    timings = []
+    for _ in range(rounds):
+        if setup is not None:
+            setup()
+        start = perf_counter_ns()
+        case()
+        timings.append(perf_counter_ns() - start)
+    return {
+        "name": name,
+        **parameters,
+        "rounds": rounds,
+        **percentiles(timings),
+        **allocations(case, setup, min(rounds, ALLOCATION_ROUNDS))
+    }
+
+def add_user(database: SQLiteDatabase, username: str, login_data: authentication.LoginData, settings: Settings = Settings.NONE, permission_group: int = 0) -> None:
+    slot = database.create_user_slot(settings.value, permission_group, f"slot_{username}")
+    database.create_user(username, login_data.data, login_data.login_token, login_data.login_type.value, slot)
+
+def add_users(database: SQLiteDatabase, count: int) -> None:
+    with database.transaction():
+        for i in range(count):
+            add_user(database, f"Member{i:06d}", FILLER_LOGIN_DATA, Settings(1 << (i % 8)), i % 50)
+
+def login_cases() -> list[dict]:
+    database = SQLiteDatabase(":memory:")
+    add_user(database, "Benchmarker", authentication.create_login_data("Benchmarker", PASSWORD))
+    # Each weak user can only be migrated once
+    weak_count = 1 + SLOW_ROUNDS + min(SLOW_ROUNDS, ALLOCATION_ROUNDS)
+    weak_users = iter(range(weak_count))
+    for i in range(weak_count):
+        username = f"Weak{i:04d}"
+        add_user(database, username, authentication.weak_create_login_data(username, PASSWORD))
+    return [
+        measure("login", lambda: authentication.login(database, "benchmarker", PASSWORD, SESSION_NAME), SLOW_ROUNDS),
+        measure("old_login_migration", lambda: authentication.old_login(database, f"weak{next(weak_users):04d}", PASSWORD, SESSION_NAME), SLOW_ROUNDS),
+        measure("create_login_data", lambda: authentication.create_login_data("Benchmarker", PASSWORD), SLOW_ROUNDS)
+    ]
+
+def session_cases() -> list[dict]:
+    database = SQLiteDatabase(":memory:")
+    add_users(database, 1000)
+    session_data = SessionData(authentication.create_session_data().data)
+    database.add_session(session_data.data, "Member000500", SESSION_NAME)
+    def drop_cached_sessions():
+        with authentication.session_cache.lock:
+            authentication.session_cache.entries.clear()
+    return [
+        measure("session_lookup_cold", lambda: Session.from_session_data(database, session_data), setup=drop_cached_sessions),
+        measure("session_lookup_warm", lambda: Session.from_session_data(database, session_data)),
+        measure("add_session", lambda: database.add_session(authentication.create_session_data().data, "Member000500", SESSION_NAME))
+    ]
+
+def user_list_cases() -> list[dict]:
+    results = []
+    for count in USER_COUNTS:
+        database = SQLiteDatabase(":memory:")
+        add_users(database, count)
+        rounds = max(ROUNDS * 100 // max(count, 100), SLOW_ROUNDS)
+        for limit in (USER_LIST_PAGE_SIZE, USER_LIST_MAX_PAGE_SIZE):
+            # What /user_list/ does for a sys-admin: fetch one page plus one row and serialize it
+            render = lambda: "".join(stream_user_list(database.iter_user_list(1 << 30, True, True, limit + 1), limit))
+            results.append(measure("user_list", render, rounds, users=count, limit=limit))
+    return results
+
+def passkey_cases() -> list[dict]:
+    database = SQLiteDatabase(":memory:")
+    add_user(database, "Benchmarker", FILLER_LOGIN_DATA)
+    user = database.get_user_profile("Benchmarker")
+    with app.test_request_context("/", base_url="https://localhost", headers={"Cookie": f"{FIELD_CSRF_TOKEN}=benchmark"}):
+        return [
+            measure("passkey_creation_options", lambda: authentication.access_creation_credentials(database, user, request)),
+            measure("passkey_login_options", lambda: authentication.access_login_credentials(database, request))
+        ]
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    results = login_cases() + session_cases() + user_list_cases() + passkey_cases()
+    print(json.dumps({
+        "commit": commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
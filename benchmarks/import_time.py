@@ -0,0 +1,45 @@
+# Import-time budget for the serverless entry point. Imports api.index in fresh interpreters, reports
+# the median and exits non-zero when it is over IMPORT_TIME_BUDGET_MS or when a module that is meant
+# to be deferred was imported anyway. Run from the repository root with the app environment (RSA_KEY,
+# ...) set:
+#   python -m benchmarks.import_time
+from os import getenv
+from statistics import median
+import json
+import subprocess
+import sys
+
+BUDGET_MS = float(getenv("IMPORT_TIME_BUDGET_MS", "350"))
+RUNS = int(getenv("BENCHMARK_IMPORT_RUNS", "5"))
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import api.index
+elapsed = (time.perf_counter() - start) * 1000
+from api.authentication import DEFERRED_MODULES, sweeper, audit_log
+ready = {"database": api.index.lazy_db, "rsa_key": api.index.rsa_key, "assets": api.index.assets, "sweeper": sweeper, "audit_log": audit_log}
+print(json.dumps({"ms": elapsed, "loaded": [name for name in DEFERRED_MODULES if name in sys.modules], "initialized": [name for name, value in ready.items() if value.is_ready]}))
+"""
+
+def measure() -> dict:
+    result = subprocess.run([sys.executable, "-c", CHILD], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+def main():
+    runs = [measure() for _ in range(RUNS)]
+    import_ms = round(median(run["ms"] for run in runs), 1)
+    eager = sorted({name for run in runs for name in run["loaded"]})
+    initialized = sorted({name for run in runs for name in run["initialized"]})
+    results = {
+        "import_ms": import_ms,
+        "budget_ms": BUDGET_MS,
+        "runs": [round(run["ms"], 1) for run in runs],
+        "eagerly_imported": eager,
+        "eagerly_initialized": initialized
+    }
+    print(json.dumps(results, indent=2))
+    if import_ms > BUDGET_MS or eager or initialized:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# Checks that compiled Permissions agree with the Settings flag semantics they replace and times both.
+# Every capability, grants, outranks and visible_fields are compared against the Flag expressions the
+# handlers used before, visible_fields also against the masking done by SQLiteDatabase.iter_user_list.
+# Exits non-zero on the first disagreement, tests/test_permissions.py runs the same checks. Run from
+# the repository root with the app environment (RSA_KEY, ...) set:
+#   python -m benchmarks.permissions
+from os import getenv
+from time import perf_counter_ns
+import json
+import random
+import sys
+from api.authentication import Settings
+from api.permissions import compile_permissions
+from api.database import SQLiteDatabase
+
+CASES = int(getenv("BENCHMARK_PERMISSION_CASES", "20000"))
+ROUNDS = int(getenv("BENCHMARK_ROUNDS", "100000"))
+LIST_SIZE = 1000
+CAPABILITIES = {
+    "view_members": Settings.VIEW_MEMBERS,
+    "view_member_settings": Settings._VIEW_MEMBER_SETTINGS,
+    "edit_member_settings": Settings._EDIT_MEMBER_SETTINGS,
+    "create_members": Settings._CREATE_MEMBERS,
+    "disable_members": Settings._DISABLE_MEMBERS,
+    "view_invited_members": Settings._VIEW_INVITED_MEMBERS,
+    "uninvite_members": Settings._UNINVITE_MEMBERS,
+    "retrieve_invitation": Settings._RETRIEVE_INVITATION,
+    "sys_admin": Settings.SYS_ADMIN
+}
+PERMISSION_GROUPS = (1 - (1 << 31), -1, 0, 1, 5, 49, 100, (1 << 31) - 1)
+
+def is_settings(value: int) -> bool:
+    try:
+        Settings(value)
+    except ValueError:
+        return False
+    return True
+
+# Only values Settings accepts, anything else never got past Settings(...) in the handlers
+def settings_values(rng: random.Random) -> list[int]:
+    named = [member.value for member in Settings.__members__.values()]
+    values = named + [a | b for a in named for b in named]
+    values += [rng.getrandbits(31) for _ in range(CASES)]
+    values += [rng.getrandbits(9) for _ in range(CASES)]
+    return sorted(value for value in set(values) if is_settings(value))
+
+def reference_visible_fields(settings: Settings, permission_group: int, groups: list[int], values: list[int]) -> tuple[list[int], list[int]]:
+    visible_settings, visible_groups = [], []
+    for group, value in zip(groups, values):
+        if Settings._VIEW_MEMBER_SETTINGS not in settings or group > permission_group:
+            visible_settings.append(-1)
+            visible_groups.append(-1)
+        else:
+            visible_settings.append(value)
+            visible_groups.append(group)
+    return visible_settings, visible_groups
+
+def check_equivalence(rng: random.Random, values: list[int]) -> list[str]:
+    mismatches = []
+    targets = rng.sample(values, min(len(values), 64))
+    groups = [rng.choice((-5, 0, 3, 49, 50, 51, 100)) for _ in range(LIST_SIZE)]
+    user_settings = [rng.choice(values) for _ in range(LIST_SIZE)]
+    for value in values:
+        settings = Settings(value)
+        for permission_group in PERMISSION_GROUPS:
+            permissions = compile_permissions(value, permission_group)
+            for name, flag in CAPABILITIES.items():
+                if getattr(permissions, name) != (flag in settings):
+                    mismatches.append(f"{name} settings={value}")
+            for target in targets:
+                if permissions.grants(target) != (Settings(target) in settings):
+                    mismatches.append(f"grants {target} settings={value}")
+            for group in PERMISSION_GROUPS:
+                if permissions.outranks(group) != (group < permission_group):
+                    mismatches.append(f"outranks {group} permission_group={permission_group}")
+        permissions = compile_permissions(value, 50)
+        if permissions.visible_fields(groups, user_settings) != reference_visible_fields(settings, 50, groups, user_settings):
+            mismatches.append(f"visible_fields settings={value}")
+        if len(mismatches) > 20:
+            break
+    return mismatches
+
+def check_user_list(rng: random.Random, values: list[int]) -> list[str]:
+    database = SQLiteDatabase(":memory:")
+    with database.transaction():
+        for i in range(LIST_SIZE):
+            slot = database.create_user_slot(rng.choice(values), rng.randrange(-5, 100), f"member{i:04d}")
+            database.create_user(f"Member{i:04d}", "", "", 0, slot)
+    profiles = sorted(database.list_users(), key=lambda profile: profile.username.lower())
+    groups = [profile.permission_group for profile in profiles]
+    user_settings = [profile.settings.value for profile in profiles]
+    mismatches = []
+    for value in (Settings.VIEW_MEMBERS.value, Settings.VIEW_MEMBER_SETTINGS.value, Settings.ADMIN.value):
+        for permission_group in (0, 50, 100):
+            permissions = compile_permissions(value, permission_group)
+            entries = list(database.iter_user_list(permission_group, permissions.view_member_settings, permissions.view_invited_members, LIST_SIZE + 1))
+            expected = ([entry.settings for entry in entries], [entry.permission_group for entry in entries])
+            if permissions.visible_fields(groups, user_settings) != expected:
+                mismatches.append(f"user_list settings={value} permission_group={permission_group}")
+    return mismatches
+
+def timing(case) -> float:
+    start = perf_counter_ns()
+    for _ in range(ROUNDS):
+        case()
+    return round((perf_counter_ns() - start) / ROUNDS, 1)
+
+def main():
+    rng = random.Random(0)
+    values = settings_values(rng)
+    mismatches = check_equivalence(rng, values) + check_user_list(rng, values)
+    settings = Settings.EDIT_MEMBER_SETTINGS | Settings.CREATE_MEMBERS
+    requested = Settings.VIEW_MEMBERS.value
+    permissions = compile_permissions(settings.value, 50)
+    # What /add_user/ checked per request, on Flags and on the compiled masks
+    flag_check = lambda: Settings._CREATE_MEMBERS in settings and Settings(requested) in settings and 5 < 50
+    compiled_check = lambda: permissions.create_members and permissions.grants(requested) and permissions.outranks(5)
+    print(json.dumps({
+        "mismatches": mismatches,
+        "add_user_checks_ns": {"flag": timing(flag_check), "compiled": timing(compiled_check)},
+        "compile_cached_ns": timing(lambda: compile_permissions(settings.value, 50))
+    }, indent=2))
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
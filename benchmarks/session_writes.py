@@ -0,0 +1,86 @@
+# Compares the login write cost of the former insert/find/delete_many session capping with the single
+# capped $push used by MongoDB.add_session. Runs against MONGO_DB_CONNECTION_URI on a scratch database
+# which is dropped afterwards. Run from the repository root with the app environment (RSA_KEY, ...) set:
+#   python -m benchmarks.session_writes
+from os import getenv
+from uuid import uuid4
+from datetime import datetime
+from time import perf_counter
+from statistics import quantiles
+import json
+import sys
+from pymongo import ASCENDING, DESCENDING
+from pymongo import monitoring
+from api.database import MongoDB, MAX_SESSIONS
+from api.consts import *
+
+LOGINS = int(getenv("BENCHMARK_LOGINS", "2000"))
+USERS = int(getenv("BENCHMARK_USERS", "50"))
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+def legacy_add_session(sessions, session_data, username, session_name):
+    sessions.insert_one({
+        FIELD_SESSION_DATA: session_data,
+        FIELD_SESSION_NAME: session_name,
+        FIELD_LOOKUP_USERNAME: username.lower(),
+        FIELD_USERNAME: username,
+        FIELD_CREATION_TIME: datetime.now()
+    })
+    found = list(sessions.find({FIELD_LOOKUP_USERNAME: username.lower()}).sort(FIELD_CREATION_TIME, DESCENDING).limit(MAX_SESSIONS + 1))
+    if len(found) == MAX_SESSIONS + 1:
+        sessions.delete_many({"_id": {"$not": {"$in": [sess["_id"] for sess in found[:MAX_SESSIONS]]}}, FIELD_LOOKUP_USERNAME: username.lower()})
+
+def measure(counter, add_session) -> dict:
+    timings = []
+    commands = counter.count
+    for i in range(LOGINS):
+        start = perf_counter()
+        add_session(str(uuid4()), f"User{i % USERS}", "benchmark")
+        timings.append((perf_counter() - start) * 1000)
+    percentiles = quantiles(timings, n=100)
+    return {
+        "p50_ms": round(percentiles[49], 3),
+        "p95_ms": round(percentiles[94], 3),
+        "p99_ms": round(percentiles[98], 3),
+        "commands_per_login": round((counter.count - commands) / LOGINS, 2)
+    }
+
+def main():
+    uri = getenv("MONGO_DB_CONNECTION_URI")
+    if not uri:
+        sys.exit("MONGO_DB_CONNECTION_URI is not set")
+    uri = uri.format(getenv("MONGO_DB_USERNAME"), getenv("MONGO_DB_PASSWORD"))
+    scratch = f"benchmark_{uuid4().hex[:8]}"
+    counter = CommandCounter()
+    # Registered before the client is created so every command it issues is counted
+    monitoring.register(counter)
+    database = MongoDB(uri, db=scratch)
+    try:
+        legacy = database.db.legacy_sessions
+        legacy.create_index([(FIELD_SESSION_DATA, ASCENDING)], unique=True)
+        legacy.create_index([(FIELD_LOOKUP_USERNAME, ASCENDING), (FIELD_CREATION_TIME, DESCENDING)])
+        results = {
+            "logins": LOGINS,
+            "users": USERS,
+            "legacy": measure(counter, lambda session_data, username, session_name: legacy_add_session(legacy, session_data, username, session_name)),
+            "capped_push": measure(counter, database.add_session)
+        }
+        print(json.dumps(results, indent=2))
+    finally:
+        database.client.drop_database(scratch)
+        database.client.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+from statistics import median
+from benchmarks.import_time import BUDGET_MS, RUNS, measure
+
+# The same check as python -m benchmarks.import_time, so a change that slows down the cold start of
+# the serverless entry point fails the tests
+def test_import_time_within_budget():
+    runs = [measure() for _ in range(RUNS)]
+    assert median(run["ms"] for run in runs) <= BUDGET_MS
+
+def test_nothing_heavy_at_import():
+    run = measure()
+    assert run["loaded"] == []
+    assert run["initialized"] == []
@@ -0,0 +1,59 @@
+import random
+import pytest
+from api.authentication import Settings
+from api.permissions import compile_permissions
+from api.database import SQLiteDatabase
+from benchmarks.permissions import CAPABILITIES, PERMISSION_GROUPS, LIST_SIZE, settings_values, reference_visible_fields
+
+# Compiled Permissions against the Settings flag expressions the handlers used before them, on every
+# settings value Settings accepts
+
+@pytest.fixture(scope="module")
+def values() -> list[int]:
+    return settings_values(random.Random(0))
+
+@pytest.fixture(scope="module")
+def user_list_database(values: list[int]) -> SQLiteDatabase:
+    rng = random.Random(1)
+    database = SQLiteDatabase(":memory:")
+    with database.transaction():
+        for i in range(LIST_SIZE):
+            slot = database.create_user_slot(rng.choice(values), rng.randrange(-5, 100), f"member{i:04d}")
+            database.create_user(f"Member{i:04d}", "", "", 0, slot)
+    return database
+
+@pytest.mark.parametrize("name", CAPABILITIES)
+def test_capabilities_match_flags(values: list[int], name: str):
+    flag = CAPABILITIES[name]
+    for value in values:
+        assert getattr(compile_permissions(value, 0), name) == (flag in Settings(value)), value
+
+def test_grants_matches_flag_containment(values: list[int]):
+    targets = random.Random(2).sample(values, 64)
+    for value in values:
+        permissions = compile_permissions(value, 0)
+        for target in targets:
+            assert permissions.grants(target) == (Settings(target) in Settings(value)), (value, target)
+
+@pytest.mark.parametrize("permission_group", PERMISSION_GROUPS)
+def test_outranks_compares_permission_groups(permission_group: int):
+    permissions = compile_permissions(Settings.ADMIN.value, permission_group)
+    for group in PERMISSION_GROUPS:
+        assert permissions.outranks(group) == (group < permission_group), group
+
+def test_visible_fields_matches_flag_masking(values: list[int]):
+    rng = random.Random(3)
+    groups = [rng.choice((-5, 0, 3, 49, 50, 51, 100)) for _ in range(LIST_SIZE)]
+    user_settings = [rng.choice(values) for _ in range(LIST_SIZE)]
+    for value in values:
+        expected = reference_visible_fields(Settings(value), 50, groups, user_settings)
+        assert compile_permissions(value, 50).visible_fields(groups, user_settings) == expected, value
+
+@pytest.mark.parametrize("settings", (Settings.VIEW_MEMBERS, Settings.VIEW_MEMBER_SETTINGS, Settings.ADMIN))
+@pytest.mark.parametrize("permission_group", (0, 50, 100))
+def test_visible_fields_matches_user_list(user_list_database: SQLiteDatabase, settings: Settings, permission_group: int):
+    profiles = sorted(user_list_database.list_users(), key=lambda profile: profile.username.lower())
+    permissions = compile_permissions(settings.value, permission_group)
+    entries = list(user_list_database.iter_user_list(permission_group, permissions.view_member_settings, permissions.view_invited_members, LIST_SIZE + 1))
+    expected = ([entry.settings for entry in entries], [entry.permission_group for entry in entries])
+    assert permissions.visible_fields([profile.permission_group for profile in profiles], [profile.settings.value for profile in profiles]) == expected
@@ -0,0 +1,36 @@
+from api.database import plan_stages, scans_collection
+
+# Explain outputs as the server returns them, trimmed to the parts verify_query_plans reads
+
+def test_find_plan_with_index():
+    explanation = {"queryPlanner": {
+        "winningPlan": {"stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "users_by_username"}}},
+        "rejectedPlans": [{"stage": "COLLSCAN"}]
+    }}
+    assert plan_stages(explanation) == ["LIMIT", "FETCH", "IXSCAN"]
+    assert not scans_collection(plan_stages(explanation))
+
+def test_aggregation_scanning_in_cursor_stage():
+    explanation = {"stages": [
+        {"$cursor": {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN", "direction": "forward"}, "rejectedPlans": []}}},
+        {"$lookup": {"from": "users", "as": "account"}}
+    ]}
+    assert scans_collection(plan_stages(explanation))
+
+def test_pushed_down_lookup_join_strategy():
+    def explanation(strategy: str) -> dict:
+        return {"queryPlanner": {"winningPlan": {"queryPlan": {
+            "stage": "EQ_LOOKUP",
+            "strategy": strategy,
+            "inputStage": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}
+        }}}}
+    assert not scans_collection(plan_stages(explanation("IndexedLoopJoin")))
+    assert scans_collection(plan_stages(explanation("NestedLoopJoin")))
+    assert scans_collection(plan_stages(explanation("HashJoin")))
+
+def test_every_shard_is_checked():
+    explanation = {"queryPlanner": {"winningPlan": {"stage": "SHARD_MERGE", "shards": [
+        {"shardName": "a", "winningPlan": {"stage": "IXSCAN"}},
+        {"shardName": "b", "winningPlan": {"stage": "COLLSCAN"}}
+    ]}}}
+    assert scans_collection(plan_stages(explanation))
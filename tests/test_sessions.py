@@ -0,0 +1,24 @@
+import time
+from api.authentication import session_cache, make_session
+from api.database import SQLiteDatabase, MongoSchema, MAX_SESSIONS
+from api.session_claims import session_id, session_revocation_key
+from api.consts import FIELD_SESSIONS, FIELD_SESSION_DATA
+
+def test_sessions_pushed_out_by_the_cap_leave_the_cache(tmp_path):
+    database = SQLiteDatabase(str(tmp_path / "sessions.db"))
+    slot = database.create_user_slot(1, 5, "slot")
+    database.create_user("Member", "", "", 0, slot)
+    first = make_session(database, "Member", "first")
+    assert session_cache.get(database, first.data) is not None
+    for i in range(MAX_SESSIONS + 2):
+        make_session(database, "Member", f"session{i}")
+    assert database.get_session(first.data) is None
+    assert session_cache.get(database, first.data) is None
+    # Other workers and the signed claims learn about it through the revocation
+    assert session_revocation_key(session_id(first.data)) in database.list_revocations(time.time())
+
+def test_pushed_out_sessions_match_the_capped_push():
+    bucket = {FIELD_SESSIONS: [{FIELD_SESSION_DATA: str(i)} for i in range(MAX_SESSIONS)]}
+    assert MongoSchema.pushed_out_sessions(bucket) == ["0"]
+    assert MongoSchema.pushed_out_sessions({FIELD_SESSIONS: bucket[FIELD_SESSIONS][1:]}) == []
+    assert MongoSchema.pushed_out_sessions(None) == []
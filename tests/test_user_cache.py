@@ -0,0 +1,46 @@
+import asyncio
+from api.database import SQLiteDatabase
+from api.async_database import AsyncCachingDatabase, ThreadedAsyncDatabase
+from api.user_cache import CachingDatabase, USERS_GENERATION
+
+def fill(database, count: int) -> None:
+    for i in range(count):
+        slot = database.create_user_slot(1, 5, f"slot{i:02d}")
+        database.create_user(f"Member{i:02d}", "", "", 0, slot)
+
+def test_user_list_survives_writes_while_streaming(tmp_path):
+    database = CachingDatabase(SQLiteDatabase(str(tmp_path / "users.db")), 3600)
+    fill(database, 10)
+    database.create_user_slot(1, 5, "waiting")
+    entries = database.iter_user_list(10, True, True, 100)
+    first = next(entries)
+    database.remove_unfilled_users(["waiting"])
+    database.set_settings("Member05", 3)
+    names = [first.lookup_username] + [entry.lookup_username for entry in entries]
+    # The stream keeps reading the directory it started on
+    assert "waiting" in names and len(names) == 11
+    assert database.get_user_profile("waiting") is None
+    assert database.get_user_profile("member05").settings.value == 3
+
+def test_async_wrapper_matches_database_and_marks_users_changed(tmp_path):
+    path = str(tmp_path / "users.db")
+    inner = SQLiteDatabase(path)
+    fill(inner, 5)
+    other = CachingDatabase(SQLiteDatabase(path), 0)
+    async def run():
+        database = AsyncCachingDatabase(ThreadedAsyncDatabase(inner), 0)
+        assert await database.get_user_profiles(["member01", "nobody"]) == inner.get_user_profiles(["member01", "nobody"])
+        before = inner.get_generation(USERS_GENERATION)
+        user_ids = await database.create_user_slots([(1, 2, "fresh")])
+        assert (await database.get_user_profile("fresh")).user_id == user_ids[0]
+        assert await database.update_users({"Member02": {"permission_group": 9}}) == {"member02"}
+        assert await database.remove_unfilled_users(["fresh"]) == {"fresh"}
+        assert await database.disable_users(["Member03"]) == {"member03"}
+        assert inner.get_generation(USERS_GENERATION) == before + 4
+        assert await database.has_username("member03") and not await database.has_username("fresh")
+        return [entry async for entry in database.iter_user_list(10, True, True, 100)]
+    entries = asyncio.run(run())
+    assert entries == list(inner.iter_user_list(10, True, True, 100))
+    # A sync worker sharing the database picks the async writes up through the generation
+    assert other.get_user_profile("member02").permission_group == 9
+    assert other.get_user_profile("member03").user_id == inner.get_user_profile("member03").user_id